@@ -0,0 +1,213 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import asyncio
+import concurrent.futures
+import sys
+import tempfile
+
+from werkzeug.wsgi import FileWrapper
+
+
+class fileStream(FileWrapper):
+    """wsgi.file_wrapper which marks responses that are a file, so they are streamed without a thread"""
+
+    def __init__(self, file, buffer_size=8192):
+        # Parts of files such as Range responses are read in larger chunks than werkzeugs
+        super().__init__(file, asgiBooklist.chunkSize)
+
+
+class asgiBooklist:
+    """ASGI application which serves the booklist routes without a thread for each download
+
+    Each request is handled by the Flask app in a thread of the executor,
+    so searches and covers are made in the executor like they are with
+    waitress. Request bodies are read before the Flask app is called and
+    files and other response bodies are sent from the event loop a chunk
+    at a time, so slow clients only hold a thread while their request is
+    being handled instead of for the whole upload or download. Files are
+    sent with sendfile when the server supports the zerocopysend extension,
+    otherwise they are read a chunk at a time in the executor."""
+    # Bytes of a file read at a time
+    chunkSize = 256 * 1024
+    # Request bodies larger than this are kept in a temporary file
+    bodyMemorySize = 1024 * 1024
+
+    def __init__(self, app, threads=8):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="asgi")
+        # Responses whose bodies are being sent
+        self.streaming = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    self.executor.shutdown()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def run(self, function, *args):
+        """Run a blocking function in the executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def readBody(self, receive):
+        """Returns a file of the request body and its length, or None if the client disconnected
+
+        Bodies longer than the Flask app accepts are read but not kept,
+        their length is enough for it to refuse them"""
+        body = tempfile.SpooledTemporaryFile(self.bodyMemorySize)
+        maxLength = self.app.config["MAX_CONTENT_LENGTH"]
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None, 0
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if maxLength == None or size <= maxLength:
+                body.write(chunk)
+            if not message.get("more_body", False):
+                break
+        body.seek(0)
+        return body, size
+
+    def environ(self, scope, body, size):
+        """The WSGI environ of an ASGI http request"""
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+            "PATH_INFO": scope["path"].encode().decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": fileStream
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                name = "HTTP_" + name
+            environ[name] = environ[name] + "," + value if name in environ else value
+        # Chunked request bodies have been read so their length is known
+        environ.setdefault("CONTENT_LENGTH", str(size))
+        return environ
+
+    def callApp(self, environ):
+        """Call the Flask app, returns the status, headers, and body iterable"""
+        response = []
+        def startResponse(status, headers, excInfo=None):
+            response[:] = [status, headers]
+            return lambda data: response.append(data)
+        iterable = self.app(environ, startResponse)
+        status, headers, *written = response
+        length = next((int(value) for name, value in headers if name.lower() == "content-length"), None)
+        if written or (not isinstance(iterable, fileStream) and length != None and length <= self.chunkSize):
+            # Bodies such as JSON are already in memory, so they are read here instead
+            # of a chunk at a time in the executor while the response is being sent
+            try:
+                return int(status.split(" ")[0]), headers, written + list(iterable)
+            finally:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+        return int(status.split(" ")[0]), headers, iterable
+
+    async def http(self, scope, receive, send):
+        """Handle a request with the Flask app in the executor and send its response"""
+        body, size = await self.readBody(receive)
+        if body == None:
+            return
+        try:
+            status, headers, iterable = await self.run(self.callApp, self.environ(scope, body, size))
+        finally:
+            body.close()
+        # Servers can ignore what is sent after the client disconnects, so stop reading the body
+        disconnected = asyncio.Event()
+        async def waitForDisconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+        watcher = asyncio.create_task(waitForDisconnect())
+        self.streaming += 1
+        try:
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                    for name, value in headers]})
+            if scope["method"] == "HEAD":
+                pass
+            elif isinstance(iterable, fileStream):
+                # Ranges of files end before the end of the file
+                length = next((int(value) for name, value in headers if name.lower() == "content-length"), None)
+                await self.sendFile(scope, send, iterable.file, length, disconnected)
+            elif isinstance(iterable, list):
+                for chunk in iterable:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                iterator = iter(iterable)
+                while not disconnected.is_set():
+                    chunk = await self.run(next, iterator, None)
+                    if chunk == None:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except OSError:
+            # The client disconnected
+            pass
+        finally:
+            self.streaming -= 1
+            watcher.cancel()
+            if hasattr(iterable, "close"):
+                await self.run(iterable.close)
+
+    async def sendFile(self, scope, send, file, length, disconnected):
+        """Send length bytes of a file from its current position, or to the end if length is None"""
+        if "http.response.zerocopysend" in scope.get("extensions", {}) and hasattr(file, "fileno"):
+            message = {"type": "http.response.zerocopysend", "file": file, "more_body": True}
+            if length != None:
+                message["count"] = length
+            await send(message)
+            return
+        # Reading can wait for the disk, so it is done in the executor instead of the event loop
+        sent = 0
+        while not disconnected.is_set() and (length == None or sent < length):
+            size = self.chunkSize if length == None else min(self.chunkSize, length - sent)
+            chunk = await self.run(file.read, size)
+            if not chunk:
+                return
+            sent += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+def run(app, host, port, threads, listenSocket=None, requestMetrics=None):
+    """Serve a Flask app with uvicorn until it stops, returns False if uvicorn isnt installed"""
+    try:
+        import uvicorn
+    except ModuleNotFoundError:
+        return False
+    application = asgiBooklist(app, threads)
+    if requestMetrics:
+        requestMetrics.gauge("booklist_asgi_responses_streaming", "Responses being sent by the ASGI server",
+                             lambda: application.streaming)
+    if listenSocket:
+        uvicorn.run(application, fd=listenSocket.fileno(), lifespan="on", log_level="warning")
+    else:
+        print(f"Serving on http://{host}:{port}")
+        uvicorn.run(application, host=host, port=int(port), lifespan="on", log_level="warning")
+    return True
@@ -0,0 +1,135 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# URLs of static files in scripts, styles, and pages, such as /static/svg/new.svg
+staticUrl = re.compile(r"/static/([A-Za-z0-9_./+-]+\.[A-Za-z0-9]+)")
+
+
+def minifyJs(text):
+    """Remove indentation, blank lines, and lines which are only a comment
+
+    Line breaks are kept so semicolons are never needed, and lines after
+    a line ending with a backslash are inside a string so are unchanged"""
+    lines = []
+    continued = False
+    for line in text.splitlines():
+        if not continued:
+            line = line.strip()
+            if not line or line.startswith("//"):
+                continue
+        lines.append(line)
+        continued = line.endswith("\\")
+    return "\n".join(lines) + "\n"
+
+
+def minifyCss(text):
+    """Remove comments and whitespace which doesnt change the styles"""
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip() + "\n"
+
+
+def minifySvg(text):
+    """Remove comments and whitespace between elements"""
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.DOTALL)
+    return re.sub(r">\s+<", "><", text).strip()
+
+
+def minifyHtml(text):
+    """Remove indentation and blank lines"""
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip()) + "\n"
+
+
+# Minifier for each file extension
+minifiers = {".js": minifyJs, ".css": minifyCss, ".svg": minifySvg, ".html": minifyHtml}
+
+
+class asset:
+    """The body of a static file or page in each encoding which makes it smaller
+
+    version is a hash of the body, so URLs with ?v=version can be cached
+    forever and the ETag of each encoding changes with it."""
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        # {Content-Encoding: body}, identity is the uncompressed body
+        self.bodies = {"identity": body}
+        encoded = {"gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli:
+            encoded["br"] = brotli.compress(body, quality=11)
+        for encoding, encodedBody in encoded.items():
+            if len(encodedBody) < len(body):
+                self.bodies[encoding] = encodedBody
+
+    def encoding(self, acceptEncodings):
+        """The smallest encoding the client accepts, from the request.accept_encodings"""
+        accepted = [encoding for encoding in self.bodies
+                    if encoding == "identity" or acceptEncodings[encoding]]
+        return min(accepted, key=lambda encoding: len(self.bodies[encoding]))
+
+    def etag(self, encoding):
+        """The ETag of an encoding of the body"""
+        return self.version if encoding == "identity" else f"{self.version}-{encoding}"
+
+
+class assetStore:
+    """Every file in a static directory, minified and compressed when the server starts
+
+    References to other static files in scripts, styles, and pages are
+    rewritten to versioned URLs, so a file and everything it uses can be
+    cached forever and a change to any of them is downloaded on the next
+    page load. Files are only read when the store is made, so the server
+    must be restarted to send changes."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        # {path relative to directory: asset}
+        self.assets = {}
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            for filename in files:
+                paths.append(os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, "/"))
+        # Styles can use images and scripts can use either, so they are versioned first
+        order = {".css": 1, ".js": 2}
+        for path in sorted(paths, key=lambda path: (order.get(os.path.splitext(path)[1], 0), path)):
+            with open(os.path.join(directory, path), "rb") as file:
+                body = file.read()
+            self.assets[path] = self.build(path, body)
+
+    def build(self, path, body):
+        """Make an asset from the contents of a file or page"""
+        extension = os.path.splitext(path)[1]
+        if extension in minifiers:
+            body = self.rewrite(minifiers[extension](body.decode())).encode()
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if mimetype.startswith("text/") or mimetype == "application/javascript":
+            mimetype += "; charset=utf-8"
+        return asset(body, mimetype)
+
+    def url(self, path):
+        """The versioned URL of a static file"""
+        if path in self.assets:
+            return f"/static/{path}?v={self.assets[path].version}"
+        return f"/static/{path}"
+
+    def rewrite(self, text):
+        """Replace URLs of static files with their versioned URLs"""
+        return staticUrl.sub(lambda match: self.url(match.group(1)), text)
+
+    def get(self, path):
+        """The asset of a static file, or None if it isnt in the store"""
+        return self.assets.get(path)
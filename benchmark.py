@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import concurrent.futures
+import gc
+import gzip
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import asgi
+import covers
+import database
+import server
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class browserCache:
+    """A simple HTTP cache which behaves like a browsers for GET requests
+
+    Responses with immutable are reused without a request, others are
+    revalidated with If-None-Match or If-Modified-Since."""
+
+    def __init__(self, enabled=True, headers=None):
+        self.enabled = enabled
+        # Headers sent with every request, such as Accept-Encoding
+        self.headers = headers or {}
+        # {url: response}
+        self.responses = {}
+        self.requests = 0
+        self.notModified = 0
+        self.cacheHits = 0
+        self.bytes = 0
+
+    def get(self, client, url):
+        """GET a url through the cache, returns the response body"""
+        cached = self.responses.get(url)
+        if cached and cached.cache_control.immutable:
+            self.cacheHits += 1
+            return cached.data
+        headers = dict(self.headers)
+        if cached and cached.headers.get("ETag"):
+            headers["If-None-Match"] = cached.headers["ETag"]
+        elif cached and cached.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        response = client.get(url, headers=headers)
+        self.requests += 1
+        if response.status_code == 304:
+            self.notModified += 1
+            return cached.data
+        self.bytes += len(response.data)
+        if self.enabled:
+            self.responses[url] = response
+        return response.data
+
+    def results(self):
+        """Returns a dict of the requests made and bytes downloaded"""
+        return {
+            "requests": self.requests,
+            "notModified": self.notModified,
+            "cacheHits": self.cacheHits,
+            "bytes": self.bytes
+        }
+
+
+def coverImage(i):
+    """A small generated cover image"""
+    image = io.BytesIO()
+    Image.new("RGB", (300, 400), ((i * 37) % 256, (i * 91) % 256, (i * 53) % 256)).save(image, "JPEG")
+    return image.getvalue()
+
+
+def benchmarkCoverCaching(books=200, pageSize=20, visits=3):
+    """Bytes served for covers when scrolling a search result list several times
+
+    Each visit loads every page of the results and the preview cover of
+    each result, like the search results list does, with and without
+    a browser cache and with unversioned and versioned cover URLs"""
+    if not Image:
+        return {"skipped": "Pillow is not installed"}
+    dataDir = tempfile.mkdtemp()
+    try:
+        server.db = database.database(dataDir)
+        server.db.data = {}
+        for i in range(books):
+            bookID = server.db.bookAdd({"title": f"Benchmark Book {i}"})
+            server.db.coverAdd(bookID, coverImage(i))
+        server.db.searchCache.maxSize = 0
+        server.db.searchCache.clear()
+        client = server.booklist.test_client()
+
+        results = {}
+        for name, enabled, versioned in (("noCache", False, False),
+                                         ("revalidate", True, False),
+                                         ("versioned", True, True)):
+            cache = browserCache(enabled)
+            start = time.perf_counter()
+            for visit in range(visits):
+                offset = 0
+                while True:
+                    page = client.get(f"/api/search?q=&offset={offset}&limit={pageSize}").get_json()
+                    for book in page["books"]:
+                        url = f"/book/cover/{book['bookID']}/preview"
+                        if versioned:
+                            url += f"?v={book['coverVersion']}"
+                        cache.get(client, url)
+                    offset += pageSize
+                    if offset >= page["total"]:
+                        break
+            results[name] = {**cache.results(), "seconds": time.perf_counter() - start}
+        return results
+    finally:
+        shutil.rmtree(dataDir)
+
+
+def benchmarkFirstLoad(visits=3, bandwidth=1.6e6, roundTrip=0.15):
+    """Bytes and time to load the page and the scripts and styles it uses, on the first and later visits
+
+    slowNetworkSeconds estimates the load time with bandwidth bits per
+    second and roundTrip seconds for the page then its files in parallel"""
+    dataDir = tempfile.mkdtemp()
+    try:
+        server.db = database.database(dataDir)
+        server.db.data = {}
+        server.fileIcons = server.fileIconsDict()
+        # Like the server, the assets are built before the first request
+        server.staticAssets()
+        client = server.booklist.test_client()
+        results = {}
+        for name, headers in (("identity", {"Accept-Encoding": "identity"}),
+                              ("compressed", {"Accept-Encoding": "gzip, deflate, br"})):
+            cache = browserCache(True, headers)
+            for visit in range(visits):
+                previous = cache.results()
+                start = time.perf_counter()
+                page = cache.get(client, "/")
+                if cache.responses["/"].content_encoding == "gzip":
+                    page = gzip.decompress(page)
+                elif cache.responses["/"].content_encoding == "br":
+                    page = brotli.decompress(page)
+                page = page.decode()
+                for url in re.findall(r"(?:href|src)=\"(/static/[^\"]+)\"", page):
+                    cache.get(client, url)
+                seconds = time.perf_counter() - start
+                visitResults = {key: value - previous[key] for key, value in cache.results().items()}
+                visitResults["seconds"] = seconds
+                visitResults["slowNetworkSeconds"] = visitResults["bytes"] * 8 / bandwidth + roundTrip * (
+                    1 + bool(visitResults["requests"] > 1))
+                results.setdefault(name, {})["first" if visit == 0 else "repeat"] = visitResults
+        return results
+    finally:
+        server.db = None
+        shutil.rmtree(dataDir)
+
+
+def coverResizeTwoDecodes(originalImage, coverPath, previewPath):
+    """How covers were resized before covers.coverResize, decoding the upload for each size"""
+    fullCover = Image.open(io.BytesIO(originalImage)).convert("RGB")
+    fullCover.thumbnail((1200, 1600), Image.Resampling.LANCZOS)
+    fullCover.save(coverPath, "JPEG", quality=95)
+    Image.open(io.BytesIO(originalImage)).convert("RGB").resize(
+        (60, 80), Image.Resampling.LANCZOS).save(previewPath, "JPEG", quality=75)
+
+
+def memoryStatus(field):
+    """Returns a field of /proc/self/status in MiB, or None if it isnt Linux"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def coverResizeMeasure(method, originalImage, runs):
+    """Returns the CPU seconds per cover and the peak memory increase in MiB of a resize method
+
+    Run in a new process so other benchmarks dont affect the memory used"""
+    outputDir = tempfile.mkdtemp()
+    try:
+        # Reset the peak memory to the current memory, only on Linux
+        try:
+            with open("/proc/self/clear_refs", "w") as clearRefs:
+                clearRefs.write("5")
+        except OSError:
+            pass
+        memoryBefore = memoryStatus("VmRSS")
+        start = time.process_time()
+        for i in range(runs):
+            if method == "twoDecodes":
+                coverResizeTwoDecodes(originalImage, os.path.join(outputDir, "cover.jpg"),
+                                      os.path.join(outputDir, "coverPreview.jpg"))
+            else:
+                covers.coverResize(io.BytesIO(originalImage), {size: os.path.join(
+                    outputDir, covers.coverFilename(size)) for size in covers.coverSizes})
+        results = {"cpuSecondsPerCover": (time.process_time() - start) / runs}
+        if memoryBefore != None:
+            results["peakMemoryMiB"] = memoryStatus("VmHWM") - memoryBefore
+        return results
+    finally:
+        shutil.rmtree(outputDir)
+
+
+def benchmarkCoverResize(runs=5):
+    """CPU time and peak memory of resizing a phone photo sized JPEG and a PNG cover
+
+    twoDecodes is the original method which made a full size cover and a
+    preview, singleDecode makes every size in covers.coverSizes"""
+    if not Image:
+        return {"skipped": "Pillow is not installed"}
+    results = {}
+    for name, size, format in (("photoJpeg", (4032, 3024), "JPEG"), ("coverPng", (1000, 1500), "PNG")):
+        # Gradients so the image compresses like a photo rather than a flat colour
+        image = Image.merge("RGB", (Image.linear_gradient("L").resize(size),
+                                    Image.radial_gradient("L").resize(size),
+                                    Image.effect_noise(size, 32)))
+        originalImage = io.BytesIO()
+        image.save(originalImage, format, quality=90)
+        results[name] = {}
+        for method in ("twoDecodes", "singleDecode"):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[name][method] = executor.submit(
+                    coverResizeMeasure, method, originalImage.getvalue(), runs).result()
+    return results
+
+
+# Amounts of books in the catalogues the catalogue benchmarks are run with, changed with --sizes
+catalogueSizes = [1000, 10000]
+syllables = ["an", "bel", "cor", "da", "el", "fen", "gar", "hol", "is", "jor", "ka", "lin", "mor", "nes",
+             "or", "pel", "quin", "ra", "sel", "tor", "ul", "ven", "wyn", "yar", "zen", "the", "of", "ith"]
+genres = ["Fantasy", "Science Fiction", "Mystery", "Romance", "Horror", "History", "Biography",
+          "Programming", "Poetry", "Travel", "Cooking", "Philosophy"]
+languages = ["English"] * 12 + ["French", "German", "Spanish", "Japanese"]
+
+
+def catalogueWord(rng):
+    """A made up word, most words are short like in real titles"""
+    return "".join(rng.choice(syllables) for i in range(min(rng.randint(1, 4), rng.randint(1, 4))))
+
+
+def catalogue(size, seed=1984):
+    """Generate (bookID, book) for a synthetic catalogue of books, the same for the same seed
+
+    Authors write several books and some books are in series, descriptions
+    have a long tail of lengths, and books have covers and files which are
+    only in the data, there are no images or files in the data directory."""
+    rng = random.Random(seed)
+    authors = [" ".join(catalogueWord(rng).capitalize() for i in range(2)) for i in range(max(size // 5, 1))]
+    series = [catalogueWord(rng).capitalize() + " Saga" for i in range(max(size // 50, 1))]
+    publishers = [catalogueWord(rng).capitalize() + " Press" for i in range(50)]
+    for i in range(size):
+        book = {
+            "title": " ".join(catalogueWord(rng) for i in range(rng.randint(1, 6))).capitalize(),
+            "author": rng.choice(authors),
+            "series": rng.choice(series) if rng.random() < 0.2 else "",
+            "description": " ".join(catalogueWord(rng) for i in range(min(int(rng.lognormvariate(4, 1)), 600)))[:4096],
+            "isbn": "978" + "".join(rng.choice("0123456789") for i in range(10)),
+            "releaseDate": f"{rng.randint(1900, 2022)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}" if rng.random() < 0.8 else "",
+            "publisher": rng.choice(publishers),
+            "language": rng.choice(languages),
+            "genre": rng.choice(genres),
+            "files": {"count": 0},
+            "hasCover": rng.random() < 0.7,
+            "lastModified": 1600000000 + i * 60
+        }
+        book["coverVersion"] = f"{i:016x}" if book["hasCover"] else ""
+        for fileID in range(min(rng.randint(0, 3), rng.randint(0, 3))):
+            book["files"]["count"] += 1
+            extension = rng.choice(["epub", "pdf", "mobi", "mp3"])
+            book["files"][str(book["files"]["count"])] = {
+                "name": f"{catalogueWord(rng)}.{extension}",
+                "hashName": uuid.UUID(int=rng.getrandbits(128)).hex + "." + extension,
+                "type": extension,
+                "size": int(rng.lognormvariate(14, 1.5))
+            }
+        yield str(uuid.UUID(int=rng.getrandbits(128), version=4)), book
+
+
+def catalogueQueries(size, count=200, seed=451):
+    """Search queries for a catalogue of size: common words, rare words, authors, and typos"""
+    rng = random.Random(seed)
+    books = [book for bookID, book in catalogue(min(size, 1000))]
+    queries = []
+    for i in range(count):
+        book = rng.choice(books)
+        kind = i % 5
+        if kind == 0:
+            queries.append(rng.choice(book["title"].split(" ")))
+        elif kind == 1:
+            queries.append(" ".join(book["title"].lower().split(" ")[:2]))
+        elif kind == 2:
+            queries.append(book["author"])
+        elif kind == 3:
+            queries.append(rng.choice(syllables))
+        else:
+            queries.append(catalogueWord(rng) + catalogueWord(rng) + "x")
+    return queries
+
+
+def catalogueDatabase(dataDir, size, seed=1984):
+    """A database of a synthetic catalogue, books are added to the data directly so it is quick to make"""
+    db = database.database(dataDir)
+    db.data = dict(catalogue(size, seed))
+    return db
+
+
+def percentiles(seconds):
+    """Returns the percentiles of a list of durations in milliseconds"""
+    seconds = sorted(seconds)
+    percentile = lambda p: seconds[min(math.ceil(len(seconds) * p) - 1, len(seconds) - 1)] * 1000
+    return {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99),
+            "max": seconds[-1] * 1000, "mean": sum(seconds) / len(seconds) * 1000}
+
+
+def timed(function, *args):
+    """Returns how many seconds a function took"""
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmarkSearch(sizes=None):
+    """Latency percentiles of searching, filtering, and suggesting in synthetic catalogues
+
+    Index build times are the first search, and http is the whole /api/search
+    request through the Flask test client with the books in the response"""
+    results = {}
+    for size in sizes or catalogueSizes:
+        with tempfile.TemporaryDirectory() as dataDir:
+            server.db = db = catalogueDatabase(dataDir, size)
+            queries = catalogueQueries(size)
+            author = db.data[next(iter(db.data))]["author"]
+            result = {
+                "searchIndexSeconds": timed(db.bookSearchPage, "index", 0, 25),
+                "filterIndexSeconds": timed(db.bookSearchPage, None, 0, 25, {}, "title"),
+                "suggestIndexSeconds": timed(db.bookSuggest, "index")
+            }
+            # Without the cache, then every query again with the cache
+            db.searchCache.maxSize = 0
+            result["search"] = percentiles([timed(db.bookSearchPage, query, 0, 25) for query in queries])
+            db.searchCache.maxSize = len(queries)
+            for query in queries:
+                db.bookSearchPage(query, 0, 25)
+            result["searchCached"] = percentiles([timed(db.bookSearchPage, query, 0, 25) for query in queries])
+            result["filter"] = percentiles([timed(db.bookSearchPage, None, offset, 25, {"genre": [genre]}, "releaseDate", True)
+                                            for genre in genres for offset in (0, 100, 1000)]
+                                           + [timed(db.bookSearchPage, "the", 0, 25, {"author": [author]}, "title")
+                                              for i in range(20)])
+            result["facets"] = percentiles([timed(db.bookFacets, query, {}, ["genre", "language", "releaseYear"])
+                                            for query in queries[:50]])
+            # Each prefix of the queries like they are being typed
+            result["suggest"] = percentiles([timed(db.bookSuggest, query[:length]) for query in queries
+                                             for length in range(1, min(len(query), 8) + 1)])
+            db.searchCache.maxSize = 0
+            db.searchCache.clear()
+            client = server.booklist.test_client()
+            result["http"] = percentiles([timed(client.get, f"/api/search?q={query}") for query in queries])
+            results[size] = result
+            del db
+            server.db = None
+            gc.collect()
+    return results
+
+
+def benchmarkSaveLoad(sizes=None):
+    """Time to save every book, save after 1% of books are edited, and load a synthetic catalogue"""
+    results = {}
+    for size in sizes or catalogueSizes:
+        dataDir = tempfile.mkdtemp()
+        try:
+            db = catalogueDatabase(dataDir, size)
+            result = {"saveSeconds": timed(db.save)}
+            result["bytes"] = os.path.getsize(db.fullFilePath(db.dataFilename))
+            for bookID in list(db.data.keys())[::100]:
+                db.bookEdit(bookID, {"genre": "Edited"})
+            result["incrementalSaveSeconds"] = timed(db.save)
+            del db
+            gc.collect()
+            result["loadSeconds"] = timed(database.database(dataDir).load)
+            results[size] = result
+        finally:
+            shutil.rmtree(dataDir)
+    return results
+
+
+def catalogueMemory(size):
+    """Returns the MiB of memory used by a synthetic catalogue and each index
+
+    Run in a new process so other benchmarks dont affect the memory used"""
+    gc.collect()
+    memory = memoryStatus("VmRSS")
+    if memory == None:
+        return {"skipped": "Only measured on Linux"}
+    results = {}
+    with tempfile.TemporaryDirectory() as dataDir:
+        db = catalogueDatabase(dataDir, size)
+        for name, function in (("data", lambda: None),
+                               ("searchIndex", lambda: db.bookSearchPage("index", 0, 25)),
+                               ("filterIndex", lambda: db.bookSearchPage(None, 0, 25, {}, "title")),
+                               ("suggestIndex", lambda: db.bookSuggest("index"))):
+            function()
+            gc.collect()
+            results[name + "MiB"] = memoryStatus("VmRSS") - memory
+            memory += results[name + "MiB"]
+    results["totalMiB"] = sum(results.values())
+    return results
+
+
+def benchmarkMemory(sizes=None):
+    """Memory used by the books of synthetic catalogues and by each of their indexes"""
+    results = {}
+    for size in sizes or catalogueSizes:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[size] = executor.submit(catalogueMemory, size).result()
+    return results
+
+
+def benchmarkUpload(coverCount=40, fileMiB=64):
+    """Throughput of adding covers while uploading and with the cover queue, and of adding files"""
+    if not Image:
+        return {"skipped": "Pillow is not installed"}
+    dataDir = tempfile.mkdtemp()
+    try:
+        db = catalogueDatabase(dataDir, coverCount)
+        bookIDs = list(db.data.keys())
+        image = io.BytesIO()
+        Image.effect_noise((1500, 2000), 64).convert("RGB").save(image, "JPEG", quality=90)
+        results = {}
+        start = time.perf_counter()
+        for bookID in bookIDs:
+            db.coverAdd(bookID, image.getvalue())
+        results["coversPerSecond"] = coverCount / (time.perf_counter() - start)
+        db.coverQueue = queue = covers.coverQueue(db)
+        try:
+            start = time.perf_counter()
+            for bookID in bookIDs:
+                db.coverAdd(bookID, image.getvalue())
+            queue.join()
+            results["coverQueue"] = {"workers": queue.workers, "coversPerSecond": coverCount / (time.perf_counter() - start)}
+        finally:
+            queue.shutdown()
+            db.coverQueue = None
+        for size in (1, 16):
+            data = os.urandom(size * 1024 * 1024)
+            start = time.perf_counter()
+            for i in range(max(fileMiB // size, 1)):
+                db.fileAddStream(bookIDs[i % len(bookIDs)], f"{i}.bin", io.BytesIO(data))
+            results[f"files{size}MiB"] = {"MiBPerSecond": max(fileMiB // size, 1) * size / (time.perf_counter() - start)}
+        return results
+    finally:
+        shutil.rmtree(dataDir)
+
+
+def fileDownloads(url, ranges):
+    """Request a file once for each Range header in ranges, None is the whole file, returns the bytes received"""
+    import http.client
+    url = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    received = 0
+    for rangeHeader in ranges:
+        connection.request("GET", url.path, headers={"Range": rangeHeader} if rangeHeader else {})
+        response = connection.getresponse()
+        while True:
+            chunk = response.read(1024 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+    connection.close()
+    return received
+
+
+def fileServers(threads=4):
+    """Generate (name, start) of the servers which can be benchmarked, start serves the booklist
+    on a socket in a thread and returns a function which stops it"""
+    def startWaitress(listenSocket):
+        import waitress
+        waitressServer = waitress.create_server(server.booklist, sockets=[listenSocket], threads=threads)
+        thread = threading.Thread(target=waitressServer.run)
+        thread.start()
+        return lambda: (waitressServer.close(), thread.join())
+    def startAsgi(listenSocket):
+        import uvicorn
+        application = asgi.asgiBooklist(server.booklist, threads)
+        uvicornServer = uvicorn.Server(uvicorn.Config(application, lifespan="on", log_level="warning"))
+        thread = threading.Thread(target=uvicornServer.run, kwargs={"sockets": [listenSocket]})
+        thread.start()
+        while not uvicornServer.started:
+            time.sleep(0.01)
+        return lambda: (setattr(uvicornServer, "should_exit", True), thread.join())
+    for name, module, start in (("waitress", "waitress", startWaitress), ("asgi", "uvicorn", startAsgi)):
+        try:
+            __import__(module)
+        except ModuleNotFoundError:
+            continue
+        yield name, start
+
+
+def benchmarkFileServing(fileMiB=256, downloads=4):
+    """Server CPU time per GiB of a book file sent, as whole files, resumed downloads, and ranges
+
+    The client is another process, so the CPU time of this process is the
+    time the server spent sending the file"""
+    dataDir = tempfile.mkdtemp()
+    try:
+        server.db = db = database.database(dataDir)
+        db.data = {}
+        bookID = db.bookAdd({"title": "Benchmark File"})
+        size = fileMiB * 1024 * 1024
+        hashName = db.fileAddStream(bookID, "benchmark.bin", io.BytesIO(os.urandom(size)))
+        rng = random.Random(1984)
+        rangeStart = lambda: rng.randrange(size - 1024 * 1024)
+        # Each sends about downloads * fileMiB
+        cases = {
+            "whole": [None] * downloads,
+            "resume": [f"bytes={size // 2}-"] * downloads * 2,
+            "ranges": [f"bytes={start}-{start + 1024 * 1024 - 1}"
+                       for start in (rangeStart() for i in range(downloads * fileMiB))],
+            "multipleRanges": ["bytes=" + ",".join(f"{start}-{start + 1024 * 1024 - 1}"
+                                                   for start in (rangeStart() for j in range(4)))
+                               for i in range(downloads * fileMiB // 4)]
+        }
+        results = {}
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Start the client before it is timed
+            executor.submit(len, "").result()
+            for name, start in fileServers():
+                listenSocket = socket.create_server(("127.0.0.1", 0))
+                url = f"http://127.0.0.1:{listenSocket.getsockname()[1]}/book/file/{bookID}/{hashName}"
+                stop = start(listenSocket)
+                try:
+                    results[name] = {}
+                    for case, ranges in cases.items():
+                        wallStart, cpuStart = time.perf_counter(), time.process_time()
+                        received = executor.submit(fileDownloads, url, ranges).result()
+                        wall, cpu = time.perf_counter() - wallStart, time.process_time() - cpuStart
+                        results[name][case] = {"cpuSecondsPerGiB": cpu / received * 1024 ** 3,
+                                               "MiBPerSecond": received / 1024 ** 2 / wall}
+                finally:
+                    stop()
+                    listenSocket.close()
+        return results
+    finally:
+        server.db = None
+        shutil.rmtree(dataDir)
+
+
+def compareResults(previous, current, threshold=0.1, path=""):
+    """Returns a list of (path, previous, current) of the numbers which changed by more than threshold"""
+    changes = []
+    if isinstance(previous, dict) and isinstance(current, dict):
+        for key in previous.keys() & current.keys():
+            changes += compareResults(previous[key], current[key], threshold, f"{path}.{key}" if path else str(key))
+    elif (isinstance(previous, (int, float)) and isinstance(current, (int, float))
+          and not isinstance(previous, bool) and previous != 0):
+        if abs(current - previous) / abs(previous) > threshold:
+            changes.append((path, previous, current))
+    return changes
+
+
+benchmarks = {
+    "coverCaching": benchmarkCoverCaching,
+    "firstLoad": benchmarkFirstLoad,
+    "coverResize": benchmarkCoverResize,
+    "search": benchmarkSearch,
+    "saveLoad": benchmarkSaveLoad,
+    "memory": benchmarkMemory,
+    "upload": benchmarkUpload,
+    "fileServing": benchmarkFileServing
+}
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv:
+        print("Run benchmarks of the booklist")
+        print("Usage: ./benchmark.py [options]")
+        print("Options:")
+        print("  --help            Display this help and exit")
+        print("  --only NAME       Only run a benchmark, can be used more than once")
+        print("  --output FILE     Write the results as JSON to FILE")
+        print("  --sizes N,N       Amounts of books in the synthetic catalogues, default is 1000,10000")
+        print("  --compare FILE    Show the results which changed by more than 10% from a previous --output")
+        print("Benchmarks:")
+        for name in benchmarks:
+            print(f"  {name}")
+        exit()
+
+    if "--sizes" in sys.argv:
+        catalogueSizes = [int(size) for size in sys.argv[sys.argv.index("--sizes") + 1].split(",")]
+    only = [sys.argv[i + 1] for i, arg in enumerate(sys.argv[:-1]) if arg == "--only"]
+    results = {"environment": {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": int(time.time()),
+        "sizes": catalogueSizes
+    }}
+    for name, benchmark in benchmarks.items():
+        if only and name not in only:
+            continue
+        print(f"Running {name}", file=sys.stderr)
+        results[name] = benchmark()
+
+    # Sizes become strings in JSON, so results are the same as when they are read again
+    output = json.dumps(results, indent=4)
+    print(output)
+    if "--output" in sys.argv:
+        with open(sys.argv[sys.argv.index("--output") + 1], "w") as file:
+            file.write(output)
+    if "--compare" in sys.argv:
+        with open(sys.argv[sys.argv.index("--compare") + 1]) as file:
+            previous = json.load(file)
+        previous.pop("environment", None)
+        for path, before, after in compareResults(previous, json.loads(output)):
+            print(f"{path}: {before:.4g} -> {after:.4g} ({(after - before) / before:+.0%})", file=sys.stderr)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import codecs
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+from database import fileTooLarge
+
+
+class importer:
+    """Adds books from JSON Lines or CSV records, and their covers and files from a tar archive
+
+    Records are validated and added in batches, and a records cover and
+    files are paths in the archive which must come after the record, such
+    as the archives made by exportTar. Everything is read from streams so
+    the import is never all in memory, and the database is saved once when
+    the import is finished."""
+    batchSize = 500
+    # Most errors kept to be reported
+    maxErrors = 100
+
+    def __init__(self, db, maxFileSize=None):
+        self.db = db
+        self.maxFileSize = maxFileSize
+        self.added = 0
+        self.covers = 0
+        self.files = 0
+        self.errorCount = 0
+        self.errors = []
+        # Records read so far, used to say which record has an error
+        self.records = 0
+        # {archive path: [(bookID, filename or None for a cover)]}
+        self.pending = {}
+
+    def error(self, record, message):
+        """Record an error with a record, or with the import if record is None"""
+        self.errorCount += 1
+        if len(self.errors) < self.maxErrors:
+            self.errors.append({"record": record, "error": message})
+
+    def validate(self, record):
+        """Returns an error message if a record cant be added, or None if it can"""
+        if not isinstance(record, dict):
+            return "Record is not a JSON object"
+        if not isinstance(record.get("title"), str) or record["title"].strip() == "":
+            return "Record has no title"
+        for field in self.db.bookFields:
+            if field in record:
+                if not isinstance(record[field], str):
+                    return f"{field} is not a string"
+                if len(record[field].strip()) > self.db.maxLengths[field]:
+                    return f"{field} is longer than {self.db.maxLengths[field]} characters"
+        if not isinstance(record.get("cover", ""), str):
+            return "cover is not a path"
+        files = record.get("files", [])
+        if not isinstance(files, list) or not all(isinstance(file, str) or (
+                isinstance(file, dict) and isinstance(file.get("path"), str)) for file in files):
+            return "files is not a list of paths"
+        return None
+
+    def addRecords(self, records):
+        """Validate and add records in batches"""
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self.batchSize))
+            if not batch:
+                return
+            valid = []
+            for record in batch:
+                self.records += 1
+                message = self.validate(record)
+                if message:
+                    self.error(self.records, message)
+                else:
+                    valid.append(record)
+            with self.db.transaction():
+                for bookID, record in zip(self.db.bookAddMany(valid), valid):
+                    if not bookID:
+                        self.error(None, f"{record['title']} could not be added")
+                        continue
+                    self.added += 1
+                    if record.get("cover"):
+                        self.pending.setdefault(record["cover"], []).append((bookID, None))
+                    for file in record.get("files", []):
+                        if isinstance(file, str):
+                            file = {"path": file}
+                        self.pending.setdefault(file["path"], []).append(
+                            (bookID, file.get("name", os.path.basename(file["path"]))))
+
+    def addMember(self, path, stream):
+        """Add an archive member to the books whose records use it"""
+        for bookID, filename in self.pending.pop(path, []):
+            if filename == None:
+                if self.db.coverAdd(bookID, stream.read()):
+                    self.covers += 1
+                else:
+                    self.error(None, f"{path} is not an image")
+            else:
+                try:
+                    if self.db.fileAddStream(bookID, filename, stream, self.maxFileSize):
+                        self.files += 1
+                    else:
+                        self.error(None, f"{path} is empty")
+                except fileTooLarge:
+                    self.error(None, f"{path} is too large")
+            stream.seek(0)
+
+    def importStream(self, stream, format):
+        """Import a binary stream of "jsonl", "csv", or "tar" (which can be compressed)"""
+        with self.db.autosavePause():
+            try:
+                if format == "tar":
+                    self.importTar(stream)
+                else:
+                    self.addRecords(readRecords(stream, format))
+            except (tarfile.TarError, UnicodeDecodeError, csv.Error) as e:
+                self.error(None, f"Invalid {format}: {e}")
+            for path in self.pending:
+                self.error(None, f"{path} is not in the archive")
+            # Covers are made in parallel by the cover queue, wait for them before saving
+            if self.db.coverQueue:
+                self.db.coverQueue.join()
+            self.db.save()
+        return self.results()
+
+    def importTar(self, stream):
+        """Import records and the files they use from a tar archive, read in order without seeking"""
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                extension = member.name.rsplit(".", 1)[-1].lower()
+                if member.name not in self.pending and extension in ("jsonl", "csv"):
+                    self.addRecords(readRecords(archive.extractfile(member), extension))
+                elif member.name in self.pending:
+                    # Members can only be read once when streaming, so use a temporary file
+                    with tempFile(self.db) as file:
+                        source = archive.extractfile(member)
+                        for chunk in iter(lambda: source.read(self.db.uploadChunkSize), b""):
+                            file.write(chunk)
+                        file.seek(0)
+                        self.addMember(member.name, file)
+
+    def results(self):
+        """Returns a dict of what was imported and the errors"""
+        return {
+            "added": self.added,
+            "covers": self.covers,
+            "files": self.files,
+            "errorCount": self.errorCount,
+            "errors": self.errors
+        }
+
+
+def tempFile(db):
+    """An anonymous temporary file in the data directory, for archive members"""
+    os.makedirs(db.dataDir, exist_ok=True)
+    return tempfile.TemporaryFile(dir=db.dataDir)
+
+
+def readRecords(stream, format):
+    """Generate records from a binary stream of JSON Lines or CSV
+
+    CSV files have a column for each field, a cover column, and a files
+    column with paths seperated by |"""
+    lines = codecs.iterdecode(stream, "utf-8-sig")
+    if format == "csv":
+        for row in csv.DictReader(lines):
+            record = {key: value for key, value in row.items() if key != None and value != ""}
+            if "files" in record:
+                record["files"] = record["files"].split("|")
+            yield record
+    else:
+        for line in lines:
+            if line.strip() == "":
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield None
+
+
+def exportRecord(db, bookID, book):
+    """The record of a book for exporting, with the archive paths of its cover and files"""
+    record = {"bookID": bookID}
+    record.update({field: book[field] for field in db.bookFields if book.get(field)})
+    record["lastModified"] = book["lastModified"]
+    if book["hasCover"]:
+        record["cover"] = f"covers/{bookID}.jpg"
+    files = [{"name": file["name"], "path": f"files/{bookID}/{file['hashName']}"}
+             for fileID, file in book["files"].items() if fileID != "count"]
+    if files:
+        record["files"] = files
+    return record
+
+
+def exportBooks(db):
+    """Generate (bookID, book) for every book, oldest first
+
+    Only the bookIDs are copied, so books changed or deleted during the
+    export are exported as they are when they are reached"""
+    for bookID in list(db.data.keys()):
+        book = db.bookGet(bookID)
+        if book:
+            yield bookID, book
+
+
+def exportJsonl(db):
+    """Generate the JSON Lines of every book as bytes"""
+    for bookID, book in exportBooks(db):
+        yield (json.dumps(exportRecord(db, bookID, book)) + "\n").encode()
+
+
+class tarStream:
+    """File object for tarfile which keeps what is written until it is taken"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        """Returns and clears what has been written"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def exportTar(db, batchSize=1000):
+    """Generate a tar archive of every book as bytes
+
+    Every batchSize books there is a books-N.jsonl of the records followed
+    by their covers and files, so only a batch of records is in memory"""
+    stream = tarStream()
+    archive = tarfile.open(fileobj=stream, mode="w|")
+    books = exportBooks(db)
+    for batchNumber in itertools.count(1):
+        batch = list(itertools.islice(books, batchSize))
+        if not batch:
+            break
+        records = [exportRecord(db, bookID, book) for bookID, book in batch]
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        member = tarfile.TarInfo(f"books-{batchNumber}.jsonl")
+        member.size = len(data)
+        member.mtime = time.time()
+        archive.addfile(member, io.BytesIO(data))
+        yield stream.take()
+        for (bookID, book), record in zip(batch, records):
+            paths = []
+            if "cover" in record:
+                paths.append((db.bookFilePath(bookID, "cover.jpg"), record["cover"]))
+            for file, fileRecord in zip([file for fileID, file in book["files"].items() if fileID != "count"],
+                                        record.get("files", [])):
+                paths.append((db.filePath(bookID, file["hashName"]), fileRecord["path"]))
+            for path, name in paths:
+                try:
+                    with open(path, "rb") as file:
+                        member = archive.gettarinfo(fileobj=file, arcname=name)
+                        archive.addfile(member, file)
+                except FileNotFoundError:
+                    continue
+                yield stream.take()
+    archive.close()
+    yield stream.take()
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv or not ("--import" in sys.argv or "--export" in sys.argv):
+        print("Import or export books with JSON Lines, CSV, or tar archives")
+        print("Usage: ./bulk.py --import FILE [options]")
+        print("       ./bulk.py --export FILE [options]")
+        print("Options:")
+        print("  --help            Display this help and exit")
+        print("  --import FILE     Import a .jsonl, .csv, or .tar (can be compressed) file")
+        print("  --export FILE     Export every book to a .jsonl or .tar file")
+        print("  --data-dir DIR    Set the directory where data is stored")
+        print("  --sqlite          Use data.sqlite instead of data.json")
+        print("  --cover-workers N Processes for resizing covers, default is the amount of CPUs")
+        print("The server should not be running when importing without --sqlite")
+        exit()
+
+    if "--sqlite" in sys.argv:
+        from sqlitedb import sqliteDatabase
+        db = sqliteDatabase()
+        db.load()
+        # The server can be using data.sqlite at the same time
+        db.share()
+    else:
+        from database import database
+        db = database()
+        db.load()
+
+    if "--import" in sys.argv:
+        from covers import Image, coverQueue
+        filename = sys.argv[sys.argv.index("--import") + 1]
+        coverWorkers = None
+        if "--cover-workers" in sys.argv:
+            coverWorkers = int(sys.argv[sys.argv.index("--cover-workers") + 1])
+        if Image and coverWorkers != 0:
+            db.coverQueue = coverQueue(db, coverWorkers)
+        format = "tar"
+        for extension in ("jsonl", "csv"):
+            if filename.lower().endswith("." + extension):
+                format = extension
+        with open(filename, "rb") as file:
+            results = importer(db).importStream(file, format)
+        if db.coverQueue:
+            db.coverQueue.shutdown()
+        print(json.dumps(results, indent=4))
+    else:
+        filename = sys.argv[sys.argv.index("--export") + 1]
+        export = exportJsonl if filename.lower().endswith(".jsonl") else exportTar
+        with open(filename, "wb") as file:
+            for chunk in export(db):
+                file.write(chunk)
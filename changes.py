@@ -0,0 +1,131 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import bisect
+import collections
+
+
+class changeLog:
+    """Index of the latest change to each book, ordered by a sequence number
+
+    Every change is given the next sequence number, so a client which has
+    seen every change up to a sequence number only needs the books changed
+    after it. Deleted books are kept as tombstones so clients can remove
+    them, once there are more than maxTombstones the oldest are forgotten
+    and clients which havent seen them must fetch everything again.
+
+    The log is a list of (seq, bookID) in order of seq, so the changes
+    after a cursor are found with a binary search. Changing a book again
+    leaves its old entry in the log, these are skipped and removed once
+    there are more of them than current entries. Replayed changes can be
+    older than the newest, these are recorded out of order and everything
+    is sorted once, the next time the changes are read."""
+    maxTombstones = 10000
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove every change"""
+        self.seq = 0
+        # {bookID: (seq, deleted)} in order of seq
+        self.entries = collections.OrderedDict()
+        # [(seq, bookID)] in order of seq, including changes which are no longer the latest
+        self.log = []
+        self.tombstones = 0
+        # Changes up to this seq may have been forgotten
+        self.horizon = 0
+        # Whether replayed changes have left the entries out of order of seq
+        self.unsorted = False
+
+    def record(self, bookID, deleted=False, seq=None):
+        """Record a change to a book and return its seq
+
+        seq is given when replaying changes which already have one, they
+        are ignored if the book has a newer change"""
+        if seq == None:
+            self.seq += 1
+            seq = self.seq
+        else:
+            self.seq = max(self.seq, seq)
+            if bookID in self.entries and self.entries[bookID][0] >= seq:
+                return seq
+        if bookID in self.entries:
+            self.tombstones -= self.entries.pop(bookID)[1]
+        if seq < next(reversed(self.entries.values()), (0,))[0]:
+            # Only when replaying, sorted when the changes are next read
+            self.unsorted = True
+        self.entries[bookID] = (seq, deleted)
+        self.log.append((seq, bookID))
+        if len(self.log) > 2 * len(self.entries) + 1000:
+            self.rebuildLog()
+        self.tombstones += deleted
+        if not self.unsorted:
+            while self.tombstones > self.maxTombstones:
+                self.forgetTombstone()
+        return seq
+
+    def sort(self):
+        """Put the entries and log back in order of seq after changes were replayed out of order"""
+        if not self.unsorted:
+            return
+        self.entries = collections.OrderedDict(sorted(self.entries.items(), key=lambda item: item[1][0]))
+        self.rebuildLog()
+        self.unsorted = False
+        while self.tombstones > self.maxTombstones:
+            self.forgetTombstone()
+
+    def forgetTombstone(self):
+        """Forget the oldest tombstone"""
+        for bookID, (seq, deleted) in self.entries.items():
+            if deleted:
+                del self.entries[bookID]
+                self.tombstones -= 1
+                self.horizon = max(self.horizon, seq)
+                return
+
+    def rebuildLog(self):
+        """Make the log from the entries, without the changes which are no longer the latest"""
+        self.log = [(seq, bookID) for bookID, (seq, deleted) in self.entries.items()]
+
+    def since(self, cursor, limit=None):
+        """Returns the [(seq, bookID, deleted)] of changes after cursor, oldest first
+
+        The log is searched for the cursor and read until there are limit
+        changes, so a page takes time for its limit rather than every
+        change after the cursor"""
+        self.sort()
+        changes = []
+        index = bisect.bisect_right(self.log, cursor, key=lambda change: change[0])
+        while index < len(self.log) and (limit == None or len(changes) < limit):
+            seq, bookID = self.log[index]
+            index += 1
+            entry = self.entries.get(bookID)
+            if entry and entry[0] == seq:
+                changes.append((seq, bookID, entry[1]))
+        return changes
+
+    def reconcile(self, data):
+        """Record changes for books which were added or deleted without being recorded"""
+        for bookID in data:
+            if bookID not in self.entries or self.entries[bookID][1]:
+                self.record(bookID)
+        for bookID, (seq, deleted) in list(self.entries.items()):
+            if not deleted and bookID not in data:
+                self.record(bookID, True)
+
+    def dump(self):
+        """Returns the change log as a dict which can be saved as JSON"""
+        self.sort()
+        return {"seq": self.seq, "horizon": self.horizon,
+                "changes": [[seq, bookID, deleted] for bookID, (seq, deleted) in self.entries.items()]}
+
+    def load(self, dumped):
+        """Load a change log from dump()"""
+        self.clear()
+        for seq, bookID, deleted in dumped.get("changes", []):
+            self.entries[bookID] = (seq, deleted)
+            self.tombstones += deleted
+        self.rebuildLog()
+        self.seq = dumped.get("seq", 0)
+        self.horizon = dumped.get("horizon", 0)
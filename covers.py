@@ -0,0 +1,384 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import collections
+import concurrent.futures
+import hashlib
+import io
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import traceback
+import uuid
+
+from locks import keyedLocks
+
+try:
+    from PIL import Image, UnidentifiedImageError, features
+except ModuleNotFoundError:
+    Image = None
+    UnidentifiedImageError = None
+    features = None
+
+
+def workerStart():
+    """Ignore KeyboardInterrupt in the workers, the server finishes the queue when it stops"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# {size: (width, height, JPEG quality)} of the images made for each cover,
+# largest first. The full size cover "" keeps the aspect ratio of the
+# uploaded image, the other sizes are made from the size before them.
+coverSizes = {
+    "": (1200, 1600, 95),
+    "grid": (300, 400, 85),
+    "preview": (60, 80, 75)
+}
+
+
+def coverFilename(size=""):
+    """Filename of a size of cover, such as coverPreview.jpg"""
+    return f"cover{size.capitalize()}.jpg"
+
+
+def coverVersion(path):
+    """Hash of a full size cover, used to version its URLs, or "" if it doesnt exist
+
+    Every size is made from the same upload, so one hash versions them all.
+    A books lastModified cant be used as covers can change twice in a second."""
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()[:16]
+    except FileNotFoundError:
+        return ""
+
+
+def parseCoverSizes(text):
+    """Parse sizes such as "grid=300x400,preview=60x80" into a dict like coverSizes
+
+    The full size cover is always made, it can be changed with full=WIDTHxHEIGHT"""
+    sizes = {"": coverSizes[""]}
+    for coverSize in text.split(","):
+        name, dimensions = coverSize.strip().lower().split("=")
+        width, height = (int(dimension) for dimension in dimensions.split("x"))
+        name = "" if name == "full" else name
+        sizes[name] = (width, height, coverSizes.get(name, (0, 0, 85))[2])
+    return {"": sizes.pop(""), **dict(sorted(sizes.items(), key=lambda item: item[1][0] * item[1][1], reverse=True))}
+
+
+def coverResize(original, paths, sizes=coverSizes):
+    """Save each size of cover for an image
+
+    original is the path or a file object of the uploaded image, paths is
+    {size: path} to save each size in sizes to, returns False if it is not
+    an image. The image is only decoded once, and JPEGs are decoded at a
+    reduced scale when the full size cover is much smaller than them.
+    This is run in the cover worker processes so it must not use the database."""
+    sizes = list(sizes.items())
+    try:
+        with Image.open(original) as image:
+            # Full size book cover, fit inside its size
+            width, height, quality = sizes[0][1]
+            scale = min(width / image.width, height / image.height)
+            if scale < 1:
+                image.draft("RGB", (round(image.width * scale), round(image.height * scale)))
+            cover = image.convert("RGB")
+        cover.thumbnail((width, height), Image.Resampling.LANCZOS)
+        cover.save(paths[sizes[0][0]], "JPEG", quality=quality)
+        # Smaller covers, such as the 60x80 thumbnail
+        for size, (width, height, quality) in sizes[1:]:
+            cover = cover.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            cover.save(paths[size], "JPEG", quality=quality)
+    except UnidentifiedImageError:
+        return False
+    return True
+
+
+class coverQueue:
+    """Resizes uploaded covers in a pool of worker processes
+
+    The uploaded image is saved in the books directory and the request
+    returns straight away, when a worker has made each size of cover
+    they are moved into place and the books hasCover is set. Only the
+    latest upload for a book is used, older ones are discarded when they
+    finish. Finished jobs are handed to a thread of the queue, so the
+    executors thread which runs the done callbacks never waits for a books
+    lock or saves a book."""
+    # Amount of finished bookIDs to keep the status of
+    maxFinished = 1000
+
+    def __init__(self, db, workers=None):
+        """workers is the amount of processes, default is the amount of CPUs"""
+        self.db = db
+        self.workers = workers or os.cpu_count() or 1
+        # Spawn so the workers dont inherit the servers threads and locks
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=workerStart)
+        self.condition = threading.Condition()
+        # {bookID: (jobID, future)} for the latest upload of each book,
+        # future is None until it has been given to the workers
+        self.jobs = {}
+        # {bookID: "done" or "failed"}
+        self.finished = collections.OrderedDict()
+        # Jobs which havent finished, including ones which are no longer the latest
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        # (bookID, jobID, future) of jobs the workers have finished, None stops the finisher
+        self.finishedJobs = queue.Queue()
+        self.finisher = threading.Thread(target=self.finishJobs, name="coverQueue", daemon=True)
+        self.finisher.start()
+
+    def jobPath(self, bookID, jobID, name):
+        """Path of a file used by a job, they are renamed or deleted when it finishes"""
+        return self.db.bookFilePath(bookID, f"{name}.{jobID}")
+
+    def submit(self, bookID, originalImage):
+        """Queue image data to become a books cover
+
+        Returns False if the book doesnt exist or the data is not an image.
+        The books lock must not be held, it is used when the job finishes."""
+        if Image:
+            try:
+                # Only reads the header, the image is decoded by the worker
+                Image.open(io.BytesIO(originalImage))
+            except UnidentifiedImageError:
+                return False
+        jobID = uuid.uuid4().hex
+        with self.db.bookLock(bookID):
+            if not bookID in self.db.data:
+                return False
+            os.makedirs(self.db.bookFilePath(bookID), exist_ok=True)
+            with open(self.jobPath(bookID, jobID, "coverOriginal"), "wb") as file:
+                file.write(originalImage)
+            with self.condition:
+                self.jobs[bookID] = (jobID, None)
+                self.finished.pop(bookID, None)
+                self.pending += 1
+        try:
+            future = self.executor.submit(coverResize, self.jobPath(bookID, jobID, "coverOriginal"),
+                {size: self.jobPath(bookID, jobID, coverFilename(size)) for size in self.db.coverSizes},
+                self.db.coverSizes)
+        except Exception as e:
+            # A worker has crashed, the job fails so its files are cleaned up
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        with self.condition:
+            if self.jobs.get(bookID, (None,))[0] == jobID:
+                self.jobs[bookID] = (jobID, future)
+        future.add_done_callback(lambda future: self.finishedJobs.put((bookID, jobID, future)))
+        return True
+
+    def finishJobs(self):
+        """Finish each job the workers have finished, until None is queued"""
+        while True:
+            job = self.finishedJobs.get()
+            if job == None:
+                return
+            try:
+                self.jobFinished(*job)
+            except Exception:
+                traceback.print_exc()
+
+    def jobFinished(self, bookID, jobID, future):
+        """Move a finished jobs images into place if it is still the books latest upload"""
+        try:
+            success = future.result()
+        except Exception:
+            success = False
+        with self.db.bookLock(bookID):
+            with self.condition:
+                latest = self.jobs.get(bookID, (None,))[0] == jobID
+            if latest and success and bookID in self.db.data:
+                for size in self.db.coverSizes:
+                    os.replace(self.jobPath(bookID, jobID, coverFilename(size)),
+                               self.db.bookFilePath(bookID, coverFilename(size)))
+                book = self.db.bookCopy(bookID)
+                book["hasCover"] = True
+                book["coverVersion"] = coverVersion(self.db.bookFilePath(bookID, coverFilename()))
+                self.db.bookStore(bookID, book, ["hasCover", "coverVersion"], touch=True)
+                self.db.coverCache.remove(bookID)
+            for name in ["coverOriginal"] + [coverFilename(size) for size in self.db.coverSizes]:
+                try:
+                    os.remove(self.jobPath(bookID, jobID, name))
+                except FileNotFoundError:
+                    pass
+            with self.condition:
+                if success:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                if latest:
+                    del self.jobs[bookID]
+                    self.finished[bookID] = "done" if success else "failed"
+                    while len(self.finished) > self.maxFinished:
+                        self.finished.popitem(last=False)
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def cancel(self, bookID):
+        """Discard a books pending cover, the books lock must be held
+
+        The job still runs but its images are deleted when it finishes"""
+        with self.condition:
+            self.jobs.pop(bookID, None)
+            self.finished.pop(bookID, None)
+
+    def status(self, bookID):
+        """Returns "queued", "processing", "done", "failed", or None for a books latest upload"""
+        with self.condition:
+            if bookID in self.jobs:
+                future = self.jobs[bookID][1]
+                if future and (future.running() or future.done()):
+                    return "processing"
+                return "queued"
+            return self.finished.get(bookID)
+
+    def join(self):
+        """Wait for every queued cover to be finished"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+
+    def shutdown(self):
+        """Finish the queued covers and stop the workers"""
+        self.join()
+        self.executor.shutdown()
+        self.finishedJobs.put(None)
+        self.finisher.join()
+
+    def stats(self):
+        """Returns a dict of the amount of covers in each state"""
+        with self.condition:
+            running = sum(bool(future and future.running()) for jobID, future in self.jobs.values())
+            return {
+                "workers": self.workers,
+                "queued": len(self.jobs) - running,
+                "processing": running,
+                "completed": self.completed,
+                "failed": self.failed
+            }
+
+
+class derivativeCache:
+    """On-disk cache of covers resized to a width when they are requested
+
+    Cached covers are evicted least recently used first once they take up
+    more than maxBytes. A cached cover is named after the books coverVersion
+    so a changed cover is never served from the cache, and requests for
+    a cover which is being resized wait for it instead of resizing it again."""
+    # Widths are rounded up to a multiple of this so there are fewer to cache
+    widthStep = 100
+    formats = {"webp": ("WEBP", 80), "jpeg": ("JPEG", 85)}
+
+    def __init__(self, directory, maxBytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.resizeLock = keyedLocks()
+        # {filename: size} least recently used first, None until the directory is read
+        self.entries = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self):
+        """Read the cached covers from the directory, the lock must be held"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+            elif entry.is_file():
+                files.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+        for mtime, filename, size in sorted(files):
+            self.entries[filename] = size
+            self.bytes += size
+
+    def width(self, width, maxWidth):
+        """Round a requested width up to the widths which are cached"""
+        width = -(-max(width, 1) // self.widthStep) * self.widthStep
+        return min(width, maxWidth)
+
+    def get(self, bookID, version, sourcePath, width, format="jpeg"):
+        """Returns the path of a books cover resized to width, resizing it if it isnt cached
+
+        width must already be rounded with width(), format is "jpeg" or "webp".
+        Returns None if the source cover doesnt exist."""
+        filename = f"{bookID}-{version}-{width}.{format}"
+        path = os.path.join(self.directory, filename)
+        with self.lock:
+            if self.entries == None:
+                self.load()
+            if filename in self.entries:
+                self.entries.move_to_end(filename)
+                self.hits += 1
+                return path
+        # Only one thread resizes each cover, the others wait for it to be cached
+        with self.resizeLock(filename):
+            with self.lock:
+                if filename in self.entries:
+                    self.entries.move_to_end(filename)
+                    self.hits += 1
+                    return path
+                self.misses += 1
+            try:
+                with Image.open(sourcePath) as image:
+                    # Covers are never made larger than the full size cover
+                    width = min(width, image.width)
+                    height = round(image.height * width / image.width)
+                    image.draft("RGB", (width, height))
+                    cover = image.convert("RGB")
+            except FileNotFoundError:
+                return None
+            if cover.size != (width, height):
+                cover = cover.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            pillowFormat, quality = self.formats[format]
+            cover.save(path + ".tmp", pillowFormat, quality=quality)
+            os.replace(path + ".tmp", path)
+            self.add(filename, os.path.getsize(path))
+        return path
+
+    def add(self, filename, size):
+        """Add a cached cover and evict the least recently used covers if the cache is too large"""
+        with self.lock:
+            self.entries[filename] = size
+            self.bytes += size
+            while self.bytes > self.maxBytes and len(self.entries) > 1:
+                evicted, evictedSize = self.entries.popitem(last=False)
+                self.bytes -= evictedSize
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except FileNotFoundError:
+                    pass
+
+    def remove(self, bookID):
+        """Remove every cached cover of a book"""
+        with self.lock:
+            if self.entries == None:
+                return
+            for filename in [filename for filename in self.entries if filename.startswith(bookID + "-")]:
+                self.bytes -= self.entries.pop(filename)
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Returns a dict of the caches size and hit rate"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "covers": len(self.entries or {}),
+                "bytes": self.bytes,
+                "maxBytes": self.maxBytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": self.hits / requests if requests else 0
+            }
@@ -1,16 +1,26 @@
+#!/usr/bin/env python3
 # Copyright (c) 2022 JoeBlakeB
 # All Rights Reserved
 
+import contextlib
+import copy
 import hashlib
 import io
+import itertools
 import json
 import os
 import re
 import shutil
 import sys
+import threading
 import time
 import uuid
 
+from changes import changeLog
+from covers import coverFilename, coverResize, coverSizes, coverVersion, derivativeCache
+from locks import keyedLocks, readWriteLock
+from search import filterIndex, searchCache, searchIndex, suggestIndex
+
 try:
     from PIL import Image, UnidentifiedImageError
 except ModuleNotFoundError:
@@ -19,8 +29,14 @@ except ModuleNotFoundError:
     print("Warning: Pillow is not installed, uploaded images will not be resized.")
 
 
+class fileTooLarge(Exception):
+    """Raised when a file being added is larger than the maximum size"""
+
+
 class database:
     dataFilename = "data.json"
+    journalFilename = "data.journal"
+    changesFilename = "changes.json"
     bookFields = ("title", "author", "series", "description", "isbn", "releaseDate", "publisher", "language", "genre")
     maxLengths = {
         "title": 192,
@@ -34,12 +50,34 @@ class database:
         "genre": 128
     }
     
-    # Vars for autosave
+    # Vars for autosave, changes are saved once there have been none for
+    # autosaveDebounce seconds, or autosaveMaxDelay seconds after the first
     shutdown = False
     dataChanged = False
+    autosaveDebounce = 2
+    autosaveMaxDelay = 30
+    # Amount of autosavePause blocks running
+    autosavePauses = 0
+    # Journaled storage appends each change to the journal instead of
+    # saving everything, the journal is compacted into data.json when it
+    # has enough records or has not been compacted for long enough
+    journaled = False
+    journalCompactRecords = 1000
+    journalCompactInterval = 300
+    journalRecords = 0
+    journalFile = None
+    # Increased on every change, cached search results are for a single generation
+    generation = 0
+    # Bytes read at a time when adding a file from a stream
+    uploadChunkSize = 1024 * 1024
+    # covers.coverQueue to resize covers in worker processes, None to resize them while uploading
+    coverQueue = None
+    # {size: (width, height, JPEG quality)} of each image made from a cover
+    coverSizes = coverSizes
     
     fullFilePath = lambda self, filename : os.path.join(self.dataDir, filename)
     bookFilePath = lambda self, bookID, filename="" : os.path.join(self.dataDir, "books", bookID, filename)
+    blobPath = lambda self, blob="" : os.path.join(self.dataDir, "blobs", blob[:2], blob)
 
     def __init__(self, dataDir=None):
         """Set the data directory for the database"""
@@ -50,9 +88,44 @@ class database:
                 self.dataDir = sys.argv[sys.argv.index("--data-dir") + 1]
             else:
                 self.dataDir = os.path.join(os.path.dirname(__file__), "data")
+        self.searchIndex = searchIndex(self.bookFields)
+        self.filterIndex = filterIndex()
+        self.suggestIndex = suggestIndex()
+        self.searchCache = searchCache()
+        self.changes = changeLog()
+        self.coverCache = derivativeCache(self.fullFilePath("coverCache"))
+        self.journalLock = threading.Lock()
+        self.pauseLock = threading.Lock()
+        self.lastSave = time.time()
+        # Books are replaced instead of changed in place so they can be read
+        # and serialized without a lock. Replacing a book or using the search
+        # index needs the read/write lock, and changes to a book hold the
+        # books lock so they are made one at a time and none are lost
+        self.lock = readWriteLock()
+        self.bookLock = keyedLocks()
+        self.saveLock = threading.Lock()
+        self.suggestLock = threading.Lock()
+        # Held while the search index is built, so only searches wait for it
+        self.searchIndexLock = threading.Lock()
+        self.dirtyBookIDs = set()
+        self.firstChange = self.lastChange = 0
+        # {bookID: serialized book} from the last save of savedData
+        self.savedData = None
+        self.savedBooks = {}
+        self.saveStats = {"saves": 0, "lastDuration": 0, "lastBytes": 0,
+                          "lastBooksSerialized": 0, "totalDuration": 0, "totalBytes": 0}
+        # Files are stored once in the blob store by their SHA-256, blobRefs
+        # counts how many files of blobRefsData use each blob. Adding and
+        # removing a blob holds its lock so it isnt removed while being added
+        self.blobRefsData = None
+        self.blobRefs = {}
+        self.blobLock = keyedLocks()
 
     def load(self):
-        """Load the database"""
+        """Load the database
+
+        The journal is replayed on top of whichever snapshot is loaded,
+        replaying records that are already in the snapshot is harmless"""
         os.makedirs(self.dataDir, exist_ok=True)
 
         filename = self.fullFilePath(self.dataFilename)
@@ -60,45 +133,300 @@ class database:
         try:
             # Load database
             with open(filename, "r") as dataFile:
-                self.data = json.loads(dataFile.read())
+                data = json.loads(dataFile.read())
         except:
             try:
                 # Cannot load database, try backup
                 with open(filename + ".bak", "r") as dataFile:
-                    self.data = json.loads(dataFile.read())
+                    data = json.loads(dataFile.read())
             except:
                 # Cannot load backup either
-                self.data = {}
+                data = {}
+
+        self.changes.clear()
+        for changesFilename in (self.fullFilePath(self.changesFilename), self.fullFilePath(self.changesFilename) + ".bak"):
+            try:
+                with open(changesFilename, "r") as changesFile:
+                    self.changes.load(json.loads(changesFile.read()))
+                break
+            except:
+                continue
+
+        journalFilename = self.fullFilePath(self.journalFilename)
+        self.journalRecords = 0
+        for journal in (journalFilename + ".bak", journalFilename):
+            records = self.journalReplay(data, journal)
+            if journal == journalFilename:
+                self.journalRecords = records
+        # Books changed without being in the change log, such as after a crash
+        self.changes.reconcile(data)
+        # Sort the replayed changes once rather than for each one out of order
+        self.changes.sort()
+        self.data = data
+
+    def journalReplay(self, data, filename):
+        """Apply the records in a journal file to data, returns the amount of records"""
+        records = 0
+        try:
+            with open(filename, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Incomplete record from a crash while writing
+                        continue
+                    if "delete" in record:
+                        data.pop(record["delete"], None)
+                    else:
+                        data.setdefault(record["id"], {}).update(record["set"])
+                    if "seq" in record:
+                        self.changes.record(record.get("id", record.get("delete")), "delete" in record, record["seq"])
+                    records += 1
+        except FileNotFoundError:
+            pass
+        return records
+
+    def journalWrite(self, bookID, keys=None, seq=None):
+        """Append a books current values to the journal
+
+        keys is the list of the books keys that changed, or None for all
+        of them, the record is a delete if the book no longer exists, and
+        seq is the changes sequence number in the change log"""
+        if not self.journaled:
+            return
+        if bookID in self.data:
+            book = self.data[bookID]
+            record = {"id": bookID, "set": {key: book[key] for key in (keys or book.keys())}}
+        else:
+            record = {"delete": bookID}
+        if seq != None:
+            record["seq"] = seq
+        with self.journalLock:
+            if self.journalFile == None:
+                self.journalFile = open(self.fullFilePath(self.journalFilename), "a")
+            self.journalFile.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.journalFile.flush()
+            self.journalRecords += 1
 
     def save(self):
-        """Save the database"""
-        self.dataChanged = False
-        filename = self.fullFilePath(self.dataFilename)
+        """Save the database
+
+        Only books which changed since the last save are serialized, the
+        file is written to a temporary file which replaces data.json so
+        there is always a complete data.json, and the previous data.json
+        is kept as data.json.bak. Saving includes every change in the
+        journal, so the journal becomes the backup journal for data.json.bak"""
+        with self.saveLock:
+            startTime = time.time()
+            filename = self.fullFilePath(self.dataFilename)
+
+            # Snapshot which books exist and which changed
+            with self.lock.read():
+                books = dict(self.data.items())
+                changes = self.changes.dump()
+                dirtyBookIDs = self.dirtyBookIDs
+                self.dirtyBookIDs = set()
+                self.dataChanged = False
+            if self.savedData is not self.data:
+                self.savedData = self.data
+                self.savedBooks = {}
+            for bookID in list(self.savedBooks.keys()):
+                if bookID not in books:
+                    del self.savedBooks[bookID]
+            serialized = 0
+            for bookID, book in books.items():
+                if bookID in dirtyBookIDs or bookID not in self.savedBooks:
+                    self.savedBooks[bookID] = (f"    {json.dumps(bookID)}: "
+                        + json.dumps(book, indent=4).replace("\n", "\n    "))
+                    serialized += 1
+            # The same as json.dumps(books, indent=4)
+            if books:
+                dataBytes = ("{\n" + ",\n".join(self.savedBooks[bookID] for bookID in books) + "\n}").encode()
+            else:
+                dataBytes = b"{}"
+
+            # The change log is saved first so it is never older than data.json,
+            # a change recorded for a book which wasnt saved is only an extra change
+            self.saveFile(self.fullFilePath(self.changesFilename), json.dumps(changes, separators=(",", ":")).encode())
+
+            # Write and sync a temporary file, then replace data.json with it
+            with open(filename + ".tmp", "wb") as dataFile:
+                dataFile.write(dataBytes)
+                dataFile.flush()
+                os.fsync(dataFile.fileno())
+            if os.path.exists(filename):
+                try:
+                    os.remove(filename + ".bak")
+                except: pass
+                try:
+                    os.link(filename, filename + ".bak")
+                except OSError:
+                    shutil.copyfile(filename, filename + ".bak")
+            os.replace(filename + ".tmp", filename)
+            self.syncDataDir()
 
+            with self.journalLock:
+                journalFilename = self.fullFilePath(self.journalFilename)
+                if self.journalFile != None:
+                    self.journalFile.close()
+                    self.journalFile = None
+                if os.path.exists(journalFilename):
+                    os.replace(journalFilename, journalFilename + ".bak")
+                self.journalRecords = 0
+            self.lastSave = time.time()
+
+            duration = self.lastSave - startTime
+            self.saveStats["saves"] += 1
+            self.saveStats["lastDuration"] = duration
+            self.saveStats["lastBytes"] = len(dataBytes)
+            self.saveStats["lastBooksSerialized"] = serialized
+            self.saveStats["totalDuration"] += duration
+            self.saveStats["totalBytes"] += len(dataBytes)
+
+    def saveFile(self, filename, data):
+        """Replace a file with data so it is never incomplete, keeping the previous file as a backup"""
+        with open(filename + ".tmp", "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
         if os.path.exists(filename):
-            try:
-                os.remove(filename + ".bak")
-            except: pass
-            os.rename(filename, filename + ".bak")
+            os.replace(filename, filename + ".bak")
+        os.replace(filename + ".tmp", filename)
 
-        with open(filename, "w") as dataFile:
-            dataFile.write(json.dumps(self.data, indent=4))
+    def syncDataDir(self):
+        """Sync the data directory so renamed files are on disk"""
+        if os.name == "posix":
+            directory = os.open(self.dataDir, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
 
     def autosave(self):
-        """Autosave the data if it has changed"""
+        """Autosave the data once changes have stopped, or once they have waited too long
+
+        When journaled, compact the journal if it is due"""
         while not self.shutdown:
-            if self.dataChanged:
+            now = time.time()
+            if self.autosavePauses:
+                pass
+            elif self.journaled:
+                if self.journalRecords >= self.journalCompactRecords or (self.journalRecords
+                        and now - self.lastSave >= self.journalCompactInterval):
+                    self.save()
+            elif self.dataChanged and (now - self.lastChange >= self.autosaveDebounce
+                                       or now - self.firstChange >= self.autosaveMaxDelay):
                 self.save()
-            time.sleep(2)
-            
-    def modified(self, bookID=False):
+            time.sleep(0.25)
+
+    @contextlib.contextmanager
+    def autosavePause(self):
+        """Dont autosave until the block is finished, for changes which are saved once at the end"""
+        with self.pauseLock:
+            self.autosavePauses += 1
+        try:
+            yield
+        finally:
+            with self.pauseLock:
+                self.autosavePauses -= 1
+
+    def modified(self):
         """Recognise that data has changed
 
         Set dataChanged to true to autosave the database, and
-        Update the lastModified variable if bookID is specified"""
+        invalidate cached search results"""
+        self.lastChange = time.time()
+        if not self.dataChanged:
+            self.firstChange = self.lastChange
         self.dataChanged = True
-        if bookID:
-            self.data[bookID]["lastModified"] = int(time.time())
+        self.generation += 1
+
+    def bookStore(self, bookID, book, keys=None, touch=False):
+        """Store a new or changed book
+
+        All changes to books are stored with this so storage backends only
+        need to override it and bookRemove, keys is the list of the books
+        keys that changed or None for all of them, and touch=True updates
+        the books lastModified. Stored books must not be changed in place,
+        change a copy from bookCopy and store that instead"""
+        if touch:
+            book["lastModified"] = int(time.time())
+            if keys != None:
+                keys = [*keys, "lastModified"]
+        with self.lock.write():
+            oldBook = self.data.get(bookID)
+            if self.blobRefsData is self.data:
+                self.blobRefsUpdate(oldBook, book)
+            self.data[bookID] = book
+            self.dirtyBookIDs.add(bookID)
+            if self.searchIndex.data is self.data and (
+                    keys == None or any(key in self.bookFields for key in keys)):
+                self.searchIndex.update(bookID, book, oldBook)
+            if self.filterIndex.data is self.data:
+                self.filterIndex.update(bookID, book)
+            if self.suggestIndex.data is self.data and (
+                    keys == None or any(key in suggestIndex.suggestFields for key in keys)):
+                self.suggestIndex.update(bookID, book)
+            seq = self.changes.record(bookID)
+            self.modified()
+        self.journalWrite(bookID, keys, seq)
+
+    def bookCopy(self, bookID):
+        """Returns a copy of a book which can be changed and then stored"""
+        return copy.deepcopy(self.data[bookID])
+
+    def bookRemove(self, bookID):
+        """Remove a book from the data"""
+        with self.lock.write():
+            if self.blobRefsData is self.data:
+                self.blobRefsUpdate(self.data[bookID], None)
+            if self.searchIndex.data is self.data:
+                self.searchIndex.remove(bookID, self.data[bookID])
+            del self.data[bookID]
+            self.dirtyBookIDs.discard(bookID)
+            if self.filterIndex.data is self.data:
+                self.filterIndex.remove(bookID)
+            if self.suggestIndex.data is self.data:
+                self.suggestIndex.remove(bookID)
+            seq = self.changes.record(bookID, True)
+            self.modified()
+        self.journalWrite(bookID, seq=seq)
+
+    def bookBlobs(self, book):
+        """Returns a list of the blobs used by a books files"""
+        if not book:
+            return []
+        files = book.get("files", {})
+        return [files[fileID]["blob"] for fileID in list(files.keys())[1:] if "blob" in files[fileID]]
+
+    def blobRefsUpdate(self, oldBook, newBook):
+        """Update the blob reference counts for a book being replaced"""
+        for blob in self.bookBlobs(oldBook):
+            self.blobRefs[blob] -= 1
+            if self.blobRefs[blob] == 0:
+                del self.blobRefs[blob]
+        for blob in self.bookBlobs(newBook):
+            self.blobRefs[blob] = self.blobRefs.get(blob, 0) + 1
+
+    def blobReferences(self, blob):
+        """Returns the amount of files which use a blob"""
+        # Count every reference if the data has been loaded or replaced
+        if self.blobRefsData is not self.data:
+            with self.lock.write():
+                if self.blobRefsData is not self.data:
+                    self.blobRefs = {}
+                    for book in list(self.data.values()):
+                        self.blobRefsUpdate(None, book)
+                    self.blobRefsData = self.data
+        return self.blobRefs.get(blob, 0)
+
+    def blobRelease(self, blob):
+        """Delete a blob if it is no longer used by any files"""
+        with self.blobLock(blob):
+            if self.blobReferences(blob) == 0:
+                try:
+                    os.remove(self.blobPath(blob))
+                except: pass
 
     def bookAdd(self, bookData):
         """Takes a dict with book data and returns the new book ID"""
@@ -107,7 +435,7 @@ class database:
             return False
         
         # Generate book dict with all fields
-        newBook = {"files": {"count": 0}, "hasCover": False, "lastModified": 0}
+        newBook = {"files": {"count": 0}, "hasCover": False, "coverVersion": "", "lastModified": 0}
         for field in self.bookFields:
             if field in bookData:
                 newBook[field] = bookData[field].strip()[:self.maxLengths[field]]
@@ -118,8 +446,7 @@ class database:
         bookID = None
         while bookID in self.data or bookID == None:
             bookID = str(uuid.uuid4())
-        self.data[bookID] = newBook
-        self.modified()
+        self.bookStore(bookID, newBook)
         return bookID
 
     def bookEdit(self, bookID, newData):
@@ -127,17 +454,21 @@ class database:
         if "title" in newData:
             if newData["title"].strip() == "":
                 del newData["title"]
-        for field in self.bookFields:
-            if field in newData:
-                self.data[bookID][field] = newData[field].strip()[:self.maxLengths[field]]
-        self.modified(bookID)
+        with self.bookLock(bookID):
+            book = self.bookCopy(bookID)
+            for field in self.bookFields:
+                if field in newData:
+                    book[field] = newData[field].strip()[:self.maxLengths[field]]
+            self.bookStore(bookID, book, [field for field in self.bookFields if field in newData], touch=True)
 
-    def bookGet(self, bookID, search=False):
+    def bookGet(self, bookID, search=False, fields=None):
         """Returns the book data if it exists, or False if it doesnt
         
-        search=True to limit data returned"""
+        search=True to limit data returned, or fields to only return those keys"""
         if bookID in self.data:
             book = self.data[bookID]
+            if fields != None:
+                return {field: book[field] for field in fields if field in book}
             if not search:
                 return book
             else:
@@ -145,75 +476,260 @@ class database:
                     "title": book["title"],
                     "author": book["author"],
                     "hasCover": book["hasCover"],
+                    "coverVersion": book.get("coverVersion", ""),
                     "lastModified": book["lastModified"]
                 }
         return False
 
+    def bookDataValid(self, bookData):
+        """Returns a bool for if a dict of book data can be used to add or edit a book"""
+        return isinstance(bookData, dict) and all(
+            isinstance(bookData[field], str) for field in self.bookFields if field in bookData)
+
+    def bookGetMany(self, bookIDs, fields=None):
+        """Returns {bookID: book} for each of the bookIDs that exist
+
+        fields to only return those keys of each book"""
+        books = {}
+        for bookID in bookIDs:
+            book = self.bookGet(bookID, fields=fields)
+            if book != False:
+                books[bookID] = book
+        return books
+
+    def bookAddMany(self, booksData):
+        """Add a list of books, returns a list of the new book IDs, or False for books not added"""
+        with self.transaction():
+            return [self.bookAdd(bookData) if self.bookDataValid(bookData) else False
+                    for bookData in booksData]
+
+    def bookEditMany(self, booksData):
+        """Edit books from {bookID: newData}, returns {bookID: bool} for if each was edited"""
+        results = {}
+        with self.transaction():
+            for bookID, newData in booksData.items():
+                results[bookID] = bookID in self.data and self.bookDataValid(newData)
+                if results[bookID]:
+                    self.bookEdit(bookID, newData)
+        return results
+
+    def bookDeleteMany(self, bookIDs):
+        """Delete a list of books, returns {bookID: bool} for if each was deleted"""
+        results = {}
+        with self.transaction():
+            for bookID in bookIDs:
+                results[bookID] = bookID in self.data
+                self.bookDelete(bookID)
+        return results
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group changes so storage backends can commit them together"""
+        yield
+
+    def afterCommit(self, function):
+        """Call a function once the changes made so far are committed, such as deleting files they dont use
+
+        Storage backends with transactions call it after the commit, and not
+        at all if they are rolled back, here changes are made straight away"""
+        function()
+
     def bookDelete(self, bookID):
         """Delete a book and its files"""
-        bookPath = self.bookFilePath(bookID)
-        if os.path.exists(bookPath):
-            shutil.rmtree(bookPath)
-        self.modified()
-        del self.data[bookID]
-    
+        with self.bookLock(bookID):
+            if not bookID in self.data:
+                return
+            if self.coverQueue:
+                self.coverQueue.cancel(bookID)
+            self.coverCache.remove(bookID)
+            blobs = set(self.bookBlobs(self.data[bookID]))
+            bookPath = self.bookFilePath(bookID)
+            self.bookRemove(bookID)
+        # The covers, files, and blobs are only deleted once removing the book cant be rolled back
+        def deleteFiles():
+            if os.path.exists(bookPath):
+                shutil.rmtree(bookPath)
+            for blob in blobs:
+                self.blobRelease(blob)
+        self.afterCommit(deleteFiles)
+
+    def changesSince(self, cursor, limit=None):
+        """Returns the [(seq, bookID, deleted)] of changes after cursor, oldest first, and
+        a bool for if changes after the cursor have been forgotten, which means the
+        changes are all of them since 0"""
+        with self.lock.read():
+            reset = cursor < self.changes.horizon
+            return self.changes.since(0 if reset else cursor, limit), reset
+
     def bookSearch(self, query):
         """Returns an ordered list of bookIDs for if the query"""
-        # Get a number for how much a book matches a query
-        # {bookID: int} - higher is more relevant
+        return self.bookRank(query.lower())[0]
+
+    def bookRank(self, query, count=None):
+        """Returns the ordered bookIDs for a lowercase query and the total amount of results
+
+        count limits the bookIDs to the most relevant results"""
+        # Rebuild the index if the data has been loaded or replaced
+        if self.searchIndex.data is not self.data:
+            self.searchIndexBuild()
+        with self.lock.read():
+            return self.searchIndex.search(query, count)
+
+    def searchIndexBuild(self):
+        """Build the search index if the data has been loaded or replaced
+
+        The index is built from a copy of the data without the write lock,
+        then the changes made while it was being built are added with the
+        write lock and it replaces the old index, so other requests dont
+        wait for it. The server starts this in a thread once it has loaded"""
+        with self.searchIndexLock:
+            while self.searchIndex.data is not self.data:
+                with self.lock.read():
+                    data = self.data
+                    snapshot = dict(data)
+                    seq = self.changes.seq
+                index = searchIndex(self.bookFields)
+                for bookID, book in snapshot.items():
+                    index.update(bookID, book)
+                with self.lock.write():
+                    # Start again if the data was replaced or changes were forgotten
+                    if self.data is not data or self.changes.horizon > seq:
+                        continue
+                    added = 0
+                    for changeSeq, bookID, deleted in self.changes.since(seq):
+                        if bookID not in snapshot:
+                            added += bookID in data
+                        elif bookID in data:
+                            index.update(bookID, data[bookID], snapshot[bookID])
+                        else:
+                            index.remove(bookID, snapshot[bookID])
+                    # Books added since the copy are at the end of data, add them in the same order
+                    for bookID in list(itertools.islice(reversed(data.keys()), added))[::-1]:
+                        index.update(bookID, data[bookID])
+                    index.data = data
+                    self.searchIndex = index
+                    self.searchCache.clear()
+
+    def bookIDsNewest(self):
+        """Returns an iterator of every bookID, newest first"""
+        return reversed(self.data.keys())
+
+    def bookSearchPage(self, query, offset, limit, filters=None, sort=None, reverse=False):
+        """Returns a page of the ordered bookIDs for a query and the total amount of results
+
+        No query returns all books, newest first
+        limit=None to return every result after offset
+        filters and sort are the same as bookFilterPage"""
+        if filters or sort:
+            return self.bookFilterPage(query, offset, limit, filters or {}, sort, reverse)
+        end = None if limit is None else offset + limit
+        if query == None or query == "":
+            bookIDs = itertools.islice(self.bookIDsNewest(), offset, end)
+            return list(bookIDs), len(self.data)
         query = query.lower()
-        results = {}
-        for bookID in list(self.data.keys())[::-1]:
-            relevance = 0
-            for fieldName, field in self.data[bookID].items():
-                # skip fields that dont need to be checked
-                if fieldName in ("files", "hasCover", "lastModified"):
-                    continue
-                field = field.lower()
-                # query in field - +wordLength per word
-                # except description which is wordLength divided by 4
-                for queryWord in query.split(" "):
-                    relevance += int(queryWord in field) * (len(queryWord)
-                                / (1 + (3 * bool(fieldName == "description"))))
-                # field in query - +15 per field
-                relevance += int(field in query and len(field) != 0) * 15
-            results[bookID] = relevance
-            
-        # Order the list of results
-        resultsOrdered = []
-        minRelevancy = len(query) * 0.75
-
-        for bookID, relevance in sorted(results.items(), 
-                key=lambda item: item[1], reverse=True):
-            if relevance > minRelevancy:
-                resultsOrdered.append(bookID)
-            else:
-                break
+        cached = self.searchCache.get(query, self.generation, end)
+        if cached:
+            bookIDs, total = cached
+        else:
+            # Rank only the first page of a new query, but rank every
+            # result once more pages are requested so they are just a slice
+            generation = self.generation
+            bookIDs, total = self.bookRank(query, end if offset == 0 else None)
+            self.searchCache.put(query, generation, bookIDs, total)
+        return bookIDs[offset:end], total
+
+    def bookFilterPage(self, query, offset, limit, filters, sort=None, reverse=False):
+        """Returns a page of the bookIDs which match the query and filters and the total amount of them
+
+        filters is {field: [values]} for the fields in filterIndex.filterFields,
+        where a books field must be one of the values ignoring case, and
+        {"releaseDate": (start, end)} where start and end are inclusive and can
+        be a prefix such as a year, or None. sort is one of filterIndex.sortFields,
+        or None for by relevance, or newest first with no query. Books without
+        a value for the sort field are always last"""
+        end = None if limit is None else offset + limit
+        if query:
+            bookIDs = self.bookSearchPage(query, 0, None)[0]
+        self.filterIndexRebuild()
+        with self.lock.read():
+            books = self.filterIndex.match(filters)
+            if not query:
+                return self.filterIndex.page(books, sort, reverse, offset, limit)
+            bookIDs = [bookID for bookID in bookIDs if bookID in self.filterIndex.keys
+                       and (books == None or bookID in books)]
+            if sort:
+                bookIDs = self.filterIndex.sortBookIDs(bookIDs, sort, reverse)
+            return bookIDs[offset:end], len(bookIDs)
+
+    def bookFacets(self, query, filters, fields, limit=10):
+        """Returns {field: [(value, count)]} of the most common values of fields
+        in the books which match the query and filters
+
+        fields are from filterIndex.facetFields, filters are the same as bookFilterPage"""
+        if query:
+            bookIDs = self.bookSearchPage(query, 0, None)[0]
+        self.filterIndexRebuild()
+        with self.lock.read():
+            books = self.filterIndex.match(filters)
+            if query:
+                books = {bookID for bookID in bookIDs if books == None or bookID in books}
+            return self.filterIndex.facets(books, fields, limit)
 
-        return resultsOrdered
+    def bookSuggest(self, query, limit=10):
+        """Returns [(value, field, amount of books, edits)] of the titles, authors,
+        and series which match a query that is being typed
+
+        The last word can be the start of a word, and words can have a typo"""
+        if self.suggestIndex.data is not self.data:
+            with self.lock.write():
+                if self.suggestIndex.data is not self.data:
+                    self.suggestIndexRebuild()
+        # Suggesting can update the prefix cache, so only one thread suggests at once
+        with self.lock.read(), self.suggestLock:
+            return self.suggestIndex.suggest(query, limit)
+
+    def suggestIndexRebuild(self):
+        """Index every book for suggestions, the write lock must be held"""
+        self.suggestIndex.rebuild(self.data)
+
+    def filterIndexRebuild(self):
+        """Rebuild the filter index if the data has been loaded or replaced"""
+        if self.filterIndex.data is not self.data:
+            with self.lock.write():
+                if self.filterIndex.data is not self.data:
+                    self.filterIndex.rebuild(self.data)
 
     def coverAdd(self, bookID, originalImage):
-        """Take an images binary data and save it as the book covers images"""
-        os.makedirs(self.bookFilePath(bookID), exist_ok=True)
-        if Image:
-            try:
-                # Full size book cover (maximum of 1200x1600)
-                fullCover = Image.open(io.BytesIO(originalImage)).convert("RGB")
-                fullCover.thumbnail((1200, 1600), Image.Resampling.LANCZOS)
-                fullCover.save(self.bookFilePath(bookID, "cover.jpg"), "JPEG", quality=95)
-                # Book cover thumbnail (60x80)
-                Image.open(io.BytesIO(originalImage)).convert("RGB").resize(
-                    (60, 80), Image.Resampling.LANCZOS).save(
-                    self.bookFilePath(bookID, "coverPreview.jpg"), "JPEG", quality=75)
-            except UnidentifiedImageError:
+        """Take an images binary data and save it as the book covers images
+
+        If there is a cover queue the images are made in the background
+        and hasCover is set when they are done"""
+        if self.coverQueue:
+            return self.coverQueue.submit(bookID, originalImage)
+        with self.bookLock(bookID):
+            if not bookID in self.data:
                 return False
-        # If PIL is not installed, just save original image and have no thumbnail
-        else:
-            with open(self.bookFilePath(bookID, "cover.jpg"), "wb") as file:
-                file.write(originalImage)
-        self.data[bookID]["hasCover"] = True
-        self.modified(bookID)
-        return True
+            os.makedirs(self.bookFilePath(bookID), exist_ok=True)
+            if Image:
+                if not coverResize(io.BytesIO(originalImage), {size: self.bookFilePath(
+                        bookID, coverFilename(size)) for size in self.coverSizes}, self.coverSizes):
+                    return False
+            # If PIL is not installed, just save original image and have no thumbnail
+            else:
+                with open(self.bookFilePath(bookID, "cover.jpg"), "wb") as file:
+                    file.write(originalImage)
+            book = self.bookCopy(bookID)
+            book["hasCover"] = True
+            book["coverVersion"] = coverVersion(self.bookFilePath(bookID, coverFilename()))
+            self.bookStore(bookID, book, ["hasCover", "coverVersion"], touch=True)
+            self.coverCache.remove(bookID)
+            return True
+
+    def coverStatus(self, bookID):
+        """Returns the status of a books latest cover upload, or None if there isnt one"""
+        if self.coverQueue:
+            return self.coverQueue.status(bookID)
+        return None
 
     def coverExists(self, bookID):
         """Returns a bool for if a book has a cover"""
@@ -222,14 +738,22 @@ class database:
         return False
 
     def coverDelete(self, bookID):
-        """Delete a books cover and cover preview, and update hasCover"""
-        for fileName in ["cover.jpg", "coverPreview.jpg"]:
-            try:
-                os.remove(self.bookFilePath(bookID, fileName))
-            except: pass
-        self.data[bookID]["hasCover"] = os.path.exists(self.bookFilePath(bookID, "cover.jpg"))
-        self.modified(bookID)
-        return not self.data[bookID]["hasCover"]
+        """Delete every size of a books cover, and update hasCover"""
+        with self.bookLock(bookID):
+            if not bookID in self.data:
+                return False
+            if self.coverQueue:
+                self.coverQueue.cancel(bookID)
+            self.coverCache.remove(bookID)
+            for fileName in [coverFilename(size) for size in self.coverSizes]:
+                try:
+                    os.remove(self.bookFilePath(bookID, fileName))
+                except: pass
+            book = self.bookCopy(bookID)
+            book["hasCover"] = os.path.exists(self.bookFilePath(bookID, "cover.jpg"))
+            book["coverVersion"] = coverVersion(self.bookFilePath(bookID, "cover.jpg"))
+            self.bookStore(bookID, book, ["hasCover", "coverVersion"], touch=True)
+            return not book["hasCover"]
 
     def safeFilename(self, filename):
         """Make a filename safe for the URL"""
@@ -248,61 +772,178 @@ class database:
 
     def fileAdd(self, bookID, filename, data):
         """Save a file and store metadata in database"""
+        return self.fileAddStream(bookID, filename, io.BytesIO(data))
+
+    def fileAddStream(self, bookID, filename, stream, maxSize=None):
+        """Save a file from a stream and store metadata in database
+
+        The stream is written to a temporary file one chunk at a time
+        while it is hashed, so the file is never all in memory, then moved
+        into the blob store unless the blob store already has the file.
+        Raises fileTooLarge if the stream is over maxSize bytes"""
         # Exit if book does not exist
         if not bookID in self.data:
             return False
-        # Store data
         filename = self.safeFilename(filename)
-        hashName = hashlib.md5(data).hexdigest()
         fileType = filename.split(".")[-1]
-        self.data[bookID]["files"]["count"] += 1
-        fileID = str(self.data[bookID]["files"]["count"])
-        hashName += "." + fileID + "." + fileType
-        if "." in filename:
-            fileType = "." + fileType
-        os.makedirs(self.bookFilePath(bookID), exist_ok=True)
-        with open(self.bookFilePath(bookID, hashName), "wb") as file:
-            file.write(data)
-        self.data[bookID]["files"][fileID] = {
-            "name": filename,
-            "hashName": hashName,
-            "type": fileType,
-            "size": len(data)
-        }
-        self.modified()
-        return hashName
+        os.makedirs(self.blobPath(), exist_ok=True)
+        tempFilename = os.path.join(self.blobPath(), f".upload.{uuid.uuid4()}.tmp")
+        try:
+            md5 = hashlib.md5()
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(tempFilename, "wb") as file:
+                while True:
+                    chunk = stream.read(self.uploadChunkSize)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if maxSize != None and size > maxSize:
+                        raise fileTooLarge(filename)
+                    md5.update(chunk)
+                    sha256.update(chunk)
+                    file.write(chunk)
+            if size == 0:
+                return False
+
+            blob = sha256.hexdigest()
+            with self.bookLock(bookID), self.blobLock(blob):
+                # Exit if book was deleted while uploading
+                if not bookID in self.data:
+                    return False
+                if not os.path.exists(self.blobPath(blob)):
+                    os.makedirs(self.blobPath(blob[:2]), exist_ok=True)
+                    os.replace(tempFilename, self.blobPath(blob))
+                # Store data
+                book = self.bookCopy(bookID)
+                book["files"]["count"] += 1
+                fileID = str(book["files"]["count"])
+                hashName = md5.hexdigest() + "." + fileID + "." + fileType
+                if "." in filename:
+                    fileType = "." + fileType
+                book["files"][fileID] = {
+                    "name": filename,
+                    "hashName": hashName,
+                    "type": fileType,
+                    "size": size,
+                    "blob": blob
+                }
+                self.bookStore(bookID, book, ["files"])
+                return hashName
+        finally:
+            try:
+                os.remove(tempFilename)
+            except: pass
 
     def fileGet(self, bookID, hashName):
         """Get full file from hash"""
         if bookID in self.data:
-            for fileID in list(self.data[bookID]["files"].keys())[1:]:
-                if self.data[bookID]["files"][fileID]["hashName"] == hashName:
-                    return {**self.data[bookID]["files"][fileID], "fileID": fileID}
+            files = self.data[bookID]["files"]
+            for fileID in list(files.keys())[1:]:
+                if files[fileID]["hashName"] == hashName:
+                    return {**files[fileID], "fileID": fileID}
         return False
 
+    def filePath(self, bookID, hashName):
+        """Returns the path a books file is stored at, or False if the book doesnt have the file
+
+        Files added before the blob store are still in the books directory"""
+        file = self.fileGet(bookID, hashName)
+        if not file:
+            return False
+        if "blob" in file:
+            return self.blobPath(file["blob"])
+        return self.bookFilePath(bookID, hashName)
+
     def fileRename(self, bookID, hashName, newFilename):
         """Change a files name in database"""
-        file = self.fileGet(bookID, hashName)
-        if file:
-            fileType = file["type"]
-            if not newFilename.endswith(fileType):
-                newFilename += fileType
-            newFilename = self.safeFilename(newFilename)
-            self.data[bookID]["files"][file["fileID"]]["name"] = newFilename
-            return True
-        self.modified()
-        return False
+        with self.bookLock(bookID):
+            file = self.fileGet(bookID, hashName)
+            if file:
+                fileType = file["type"]
+                if not newFilename.endswith(fileType):
+                    newFilename += fileType
+                newFilename = self.safeFilename(newFilename)
+                book = self.bookCopy(bookID)
+                book["files"][file["fileID"]]["name"] = newFilename
+                self.bookStore(bookID, book, ["files"])
+                return True
+            return False
 
     def fileDelete(self, bookID, hashName):
         """Delete a file from filesystem and database"""
-        file = self.fileGet(bookID, hashName)
-        if file:
-            filename = self.bookFilePath(bookID, hashName)
-            try:
-                os.remove(filename)
-            except: pass
-            if not os.path.exists(filename):
-                del self.data[bookID]["files"][file["fileID"]]
+        with self.bookLock(bookID):
+            file = self.fileGet(bookID, hashName)
+            if file and "blob" in file:
+                book = self.bookCopy(bookID)
+                del book["files"][file["fileID"]]
+                self.bookStore(bookID, book, ["files"])
+                self.blobRelease(file["blob"])
                 return True
-        self.modified()
-        return False
+            elif file:
+                filename = self.bookFilePath(bookID, hashName)
+                try:
+                    os.remove(filename)
+                except: pass
+                if not os.path.exists(filename):
+                    book = self.bookCopy(bookID)
+                    del book["files"][file["fileID"]]
+                    self.bookStore(bookID, book, ["files"])
+                    return True
+            return False
+
+    def dedupe(self):
+        """Move files stored in book directories into the blob store
+
+        Returns the amount of files moved and the bytes saved by files
+        which were already in the blob store"""
+        moved = 0
+        bytesSaved = 0
+        for bookID in list(self.data.keys()):
+            with self.bookLock(bookID):
+                if not bookID in self.data:
+                    continue
+                for fileID in list(self.data[bookID]["files"].keys())[1:]:
+                    book = self.bookCopy(bookID)
+                    files = book["files"]
+                    filename = self.bookFilePath(bookID, files[fileID]["hashName"])
+                    if "blob" in files[fileID] or not os.path.exists(filename):
+                        continue
+                    sha256 = hashlib.sha256()
+                    with open(filename, "rb") as file:
+                        for chunk in iter(lambda: file.read(self.uploadChunkSize), b""):
+                            sha256.update(chunk)
+                    blob = sha256.hexdigest()
+                    with self.blobLock(blob):
+                        if os.path.exists(self.blobPath(blob)):
+                            bytesSaved += os.path.getsize(filename)
+                            os.remove(filename)
+                        else:
+                            os.makedirs(self.blobPath(blob[:2]), exist_ok=True)
+                            os.replace(filename, self.blobPath(blob))
+                        files[fileID]["blob"] = blob
+                        self.bookStore(bookID, book, ["files"])
+                    moved += 1
+        return moved, bytesSaved
+
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv or not "--dedupe" in sys.argv:
+        print("Usage: ./database.py --dedupe [options]")
+        print("Move files stored in each books directory into the deduplicated blob store")
+        print("Options:")
+        print("  --help            Display this help and exit")
+        print("  --data-dir DIR    Set the directory where data is stored")
+        print("  --sqlite          Use data.sqlite instead of data.json")
+        exit()
+
+    if "--sqlite" in sys.argv:
+        from sqlitedb import sqliteDatabase
+        db = sqliteDatabase()
+    else:
+        db = database()
+    db.load()
+    moved, bytesSaved = db.dedupe()
+    db.save()
+    print(f"Moved {moved} files into the blob store, saving {bytesSaved} bytes")
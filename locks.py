@@ -0,0 +1,113 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import contextlib
+import threading
+import zlib
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+
+class readWriteLock:
+    """A lock which can be held by many readers or a single writer
+
+    Waiting writers stop new readers from starting so that a steady
+    stream of searches cannot stop changes from being made. The lock is
+    not reentrant, a thread holding it must not try to acquire it again."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writersWaiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        """Hold the lock for reading"""
+        with self.condition:
+            while self.writer or self.writersWaiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Hold the lock for writing"""
+        with self.condition:
+            self.writersWaiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writersWaiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class keyedLocks:
+    """A lock for each key, such as a lock for each bookID
+
+    Locks only exist while they are held or waited for."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {key: [lock, threads using it]}
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        """Hold the lock for key"""
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = [threading.Lock(), 0]
+            self.locks[key][1] += 1
+            lock = self.locks[key][0]
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                self.locks[key][1] -= 1
+                if self.locks[key][1] == 0:
+                    del self.locks[key]
+
+
+class processLocks:
+    """keyedLocks which are also held across processes using the same data directory
+
+    Each key is locked with a POSIX record lock on a byte of a lock file
+    chosen by the keys hash. Record locks belong to the whole process, so
+    the threads of a process take turns using each byte with keyedLocks.
+    Keys which share a byte share a lock, so a thread must not hold two
+    of these locks at once."""
+    # Bytes of the lock file which can be locked, so few keys share a byte
+    lockBytes = 2 ** 30
+
+    def __init__(self, path):
+        self.path = path
+        self.threadLocks = keyedLocks()
+        # Never closed, closing any file descriptor of the lock file releases every lock on it
+        self.file = open(path, "a+b")
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        """Hold the lock for key"""
+        offset = zlib.crc32(str(key).encode()) % self.lockBytes
+        with self.threadLocks(offset):
+            fcntl.lockf(self.file, fcntl.LOCK_EX, 1, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN, 1, offset)
@@ -0,0 +1,213 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import bisect
+import collections
+import functools
+import os
+import re
+import sys
+import threading
+import time
+
+# Upper bounds in seconds of the histogram buckets, database methods take
+# fractions of a millisecond and uploads can take seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Database methods which are timed by instrument
+timedMethods = ("bookGet", "bookGetMany", "bookAdd", "bookAddMany", "bookEdit", "bookEditMany",
+                "bookDelete", "bookDeleteMany", "bookSearchPage", "bookFacets", "bookSuggest",
+                "changesSince", "coverAdd", "fileAdd", "fileAddStream", "fileGet", "save", "load")
+
+
+class histogram:
+    """Counts of durations in each bucket, and their sum"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Not cumulative, the last is for durations over the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, seconds):
+        """Add a duration"""
+        index = bisect.bisect_left(buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def cumulative(self):
+        """Returns ([(upper bound, count at or below it)], sum, count) like Prometheus buckets"""
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        results = []
+        cumulative = 0
+        for bound, bucketCount in zip(buckets + ("+Inf",), counts):
+            cumulative += bucketCount
+            results.append((bound, cumulative))
+        return results, total, count
+
+
+def formatLabels(labels, extra=()):
+    """Format a tuple of (name, value) as Prometheus labels such as {method="GET"}"""
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f"{name}=\"{escape(value)}\"" for name, value in labels) + "}"
+
+
+class metrics:
+    """Latency histograms and gauges shown in the Prometheus text format
+
+    Histograms are created the first time a set of labels is observed,
+    gauges are functions which are called when the metrics are rendered so
+    they cost nothing between scrapes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {name: help}
+        self.histogramHelp = {}
+        # {name: {labels tuple: histogram}}
+        self.histograms = {}
+        # {name: (help, type, function)}, function returns a number,
+        # {labels tuple: number}, or None when the metric isnt available
+        self.gauges = {}
+
+    def describe(self, name, help):
+        """Set the help of a histogram"""
+        self.histogramHelp[name] = help
+
+    def observe(self, name, seconds, **labels):
+        """Add a duration to the histogram with these labels"""
+        labels = tuple(labels.items())
+        histograms = self.histograms.get(name)
+        if histograms == None or labels not in histograms:
+            with self.lock:
+                histograms = self.histograms.setdefault(name, {})
+                histograms.setdefault(labels, histogram())
+        histograms[labels].observe(seconds)
+
+    def gauge(self, name, help, function, type="gauge"):
+        """Add a metric whose value is from calling function, type is "gauge" or "counter" """
+        self.gauges[name] = (help, type, function)
+
+    def timer(self, name, function, **labels):
+        """Wrap a function so every call is added to a histogram"""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start, **labels)
+        return timed
+
+    def instrument(self, db, methods=timedMethods):
+        """Time the methods of a database, only this instance is changed"""
+        self.describe("booklist_database_seconds", "Time taken by database methods")
+        for method in methods:
+            setattr(db, method, self.timer("booklist_database_seconds", getattr(db, method), method=method))
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            histograms = {name: dict(labelled) for name, labelled in self.histograms.items()}
+        for name, labelled in sorted(histograms.items()):
+            lines.append(f"# HELP {name} {self.histogramHelp.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, values in sorted(labelled.items()):
+                cumulative, total, count = values.cumulative()
+                for bound, bucketCount in cumulative:
+                    lines.append(f"{name}_bucket{formatLabels(labels, (('le', bound),))} {bucketCount}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {total}")
+                lines.append(f"{name}_count{formatLabels(labels)} {count}")
+        for name, (help, type, function) in sorted(self.gauges.items()):
+            value = function()
+            if value == None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            if isinstance(value, dict):
+                for labels, labelledValue in sorted(value.items()):
+                    lines.append(f"{name}{formatLabels(labels)} {labelledValue}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def frameStack(frame):
+    """A frame and its callers in the folded format, outermost first, such as main;run;bookSearch"""
+    stack = []
+    while frame != None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class sampler:
+    """Sampling profiler which saves where slow requests spent their time
+
+    While requests are being handled a thread records the stack of each of
+    their threads every interval, when a request takes longer than
+    slowSeconds its samples are saved as a .folded file which can be made
+    into a flame graph with flamegraph.pl or opened in speedscope. Only the
+    latest maxProfiles files are kept."""
+    interval = 0.005
+    maxProfiles = 100
+
+    def __init__(self, directory, slowSeconds):
+        self.directory = directory
+        self.slowSeconds = slowSeconds
+        self.lock = threading.Lock()
+        # {thread ident: Counter of stacks} of the threads handling requests
+        self.samples = {}
+        self.thread = None
+        self.saved = 0
+
+    def start(self):
+        """Start sampling the current thread for a request"""
+        with self.lock:
+            self.samples[threading.get_ident()] = collections.Counter()
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self, name, seconds):
+        """Stop sampling the current thread, saving the samples if the request was slow
+
+        Returns the path of the saved profile or None"""
+        with self.lock:
+            samples = self.samples.pop(threading.get_ident(), None)
+        if not samples or seconds < self.slowSeconds:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "-", name).strip("-")
+        path = os.path.join(self.directory, f"{time.time_ns()}-{name}-{round(seconds * 1000)}ms.folded")
+        with open(path, "w") as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+        with self.lock:
+            self.saved += 1
+        profiles = sorted(filename for filename in os.listdir(self.directory) if filename.endswith(".folded"))
+        for filename in profiles[:-self.maxProfiles]:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+        return path
+
+    def run(self):
+        """Sample every thread handling a request until the program stops"""
+        ownIdent = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, samples in self.samples.items():
+                    if ident != ownIdent and ident in frames:
+                        samples[frameStack(frames[ident])] += 1
@@ -0,0 +1,713 @@
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import array
+import bisect
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+
+class searchIndex:
+    """In-memory inverted index of the searchable book fields
+
+    Fields are split into tokens on spaces, a query word never contains
+    a space so it is a substring of a field only if it is a substring of
+    one of the fields tokens. Each distinct token is indexed by its n-grams
+    so the tokens containing a query word can be found without a scan.
+
+    Only the fields of the books in data are kept, so updating or removing
+    a book needs the book that was indexed. Postings of a single book are
+    the bookID instead of a set, as most tokens are only in one book, and
+    n-grams have an array of token numbers instead of a set of tokens."""
+    gramSize = 3
+
+    def __init__(self, fieldNames):
+        """Create an empty index for the fields in fieldNames"""
+        self.fieldNames = fieldNames
+        self.clear()
+
+    def clear(self):
+        """Remove everything from the index"""
+        # The dict the index was built from, used to check if it is stale
+        self.data = None
+        # {fieldName: {token: bookID or set(bookIDs)}}
+        self.postings = {fieldName: {} for fieldName in self.fieldNames}
+        # {token: token number}, and the token and amount of book fields using each number
+        self.tokens = {}
+        self.tokenList = []
+        self.tokenCounts = array.array("I")
+        # Numbers of removed tokens which can be used again
+        self.freeTokens = []
+        # {ngram: array(token numbers)} of the ngrams of gramSize
+        self.grams = {}
+        # Tokens shorter than gramSize
+        self.shortTokens = set()
+        # {hash of a lowercase field: {bookID: amount of fields}} for the whole field bonus
+        self.values = {}
+        # {length: amount of values} so only useful substrings of a query are checked
+        self.valueLengths = {}
+        # {bookID: int} - insertion order, used to break ties in relevance
+        self.order = {}
+        self.nextOrder = 0
+
+    def rebuild(self, data):
+        """Index every book in data"""
+        self.clear()
+        for bookID, book in list(data.items()):
+            self.update(bookID, book)
+        self.data = data
+
+    def bookFields(self, book):
+        """Returns {fieldName: lowercase field} of the fields of a book which are indexed"""
+        return {fieldName: book[fieldName].lower() for fieldName in self.fieldNames
+                if isinstance(book.get(fieldName), str) and book[fieldName] != ""}
+
+    def tokenGrams(self, token):
+        """Returns the n-grams of gramSize in a token"""
+        return {token[i:i + self.gramSize] for i in range(len(token) - self.gramSize + 1)}
+
+    def update(self, bookID, book, oldBook=None):
+        """Add a book to the index, or reindex it if it is already indexed as oldBook"""
+        if bookID in self.order:
+            self.removeFields(bookID, oldBook)
+        else:
+            self.order[bookID] = self.nextOrder
+            self.nextOrder += 1
+
+        for fieldName, field in self.bookFields(book).items():
+            postings = self.postings[fieldName]
+            for token in set(field.split(" ")):
+                books = postings.get(token)
+                if books == None:
+                    postings[token] = bookID
+                elif isinstance(books, set):
+                    books.add(bookID)
+                elif books != bookID:
+                    postings[token] = {books, bookID}
+                if token in self.tokens:
+                    self.tokenCounts[self.tokens[token]] += 1
+                else:
+                    self.addToken(token)
+            values = self.values.setdefault(hash(field), {})
+            values[bookID] = values.get(bookID, 0) + 1
+            self.valueLengths[len(field)] = self.valueLengths.get(len(field), 0) + 1
+
+    def remove(self, bookID, book):
+        """Remove a book which was indexed as book from the index"""
+        if bookID in self.order:
+            self.removeFields(bookID, book)
+            del self.order[bookID]
+
+    def removeFields(self, bookID, book):
+        """Remove the postings of the fields a book was indexed with"""
+        for fieldName, field in self.bookFields(book).items():
+            postings = self.postings[fieldName]
+            for token in set(field.split(" ")):
+                books = postings[token]
+                if isinstance(books, set):
+                    books.discard(bookID)
+                    if len(books) == 1:
+                        postings[token] = next(iter(books))
+                else:
+                    del postings[token]
+                number = self.tokens[token]
+                self.tokenCounts[number] -= 1
+                if self.tokenCounts[number] == 0:
+                    self.removeToken(token)
+            self.valueLengths[len(field)] -= 1
+            if self.valueLengths[len(field)] == 0:
+                del self.valueLengths[len(field)]
+            values = self.values[hash(field)]
+            values[bookID] -= 1
+            if values[bookID] == 0:
+                del values[bookID]
+                if not values:
+                    del self.values[hash(field)]
+
+    def addToken(self, token):
+        """Give a new token a number and add it to its n-grams"""
+        if self.freeTokens:
+            number = self.freeTokens.pop()
+            self.tokenList[number] = token
+            self.tokenCounts[number] = 1
+        else:
+            number = len(self.tokenList)
+            self.tokenList.append(token)
+            self.tokenCounts.append(1)
+        self.tokens[token] = number
+        if len(token) < self.gramSize:
+            self.shortTokens.add(token)
+        for gram in self.tokenGrams(token):
+            self.grams.setdefault(gram, array.array("I")).append(number)
+
+    def removeToken(self, token):
+        """Remove a token which is no longer used by any book"""
+        number = self.tokens.pop(token)
+        self.tokenList[number] = None
+        self.freeTokens.append(number)
+        self.shortTokens.discard(token)
+        for gram in self.tokenGrams(token):
+            self.grams[gram].remove(number)
+            if not self.grams[gram]:
+                del self.grams[gram]
+
+    def tokensContaining(self, word):
+        """Returns the set of indexed tokens which contain word"""
+        if len(word) < self.gramSize:
+            # Every token at least as long as a gram contains a gram which contains word
+            tokens = {token for token in self.shortTokens if word in token}
+            for gram, numbers in self.grams.items():
+                if word in gram:
+                    tokens.update(self.tokenList[number] for number in numbers)
+            return tokens
+        # Every token containing word is in the tokens of each of its n-grams, so check the fewest
+        grams = [self.grams.get(word[i:i + self.gramSize]) for i in range(len(word) - self.gramSize + 1)]
+        if None in grams:
+            return set()
+        return {self.tokenList[number] for number in min(grams, key=len) if word in self.tokenList[number]}
+
+    def score(self, query):
+        """Returns {bookID: relevance} for every book with a relevance above 0
+
+        query must already be lowercase"""
+        results = {}
+        # query in field - +wordLength per word
+        # except description which is wordLength divided by 4
+        for queryWord in query.split(" "):
+            if queryWord == "":
+                continue
+            tokens = self.tokensContaining(queryWord)
+            if not tokens:
+                continue
+            for fieldName, postings in self.postings.items():
+                books = set()
+                for token in postings.keys() & tokens:
+                    bookIDs = postings[token]
+                    if isinstance(bookIDs, set):
+                        books |= bookIDs
+                    else:
+                        books.add(bookIDs)
+                relevance = len(queryWord) / (1 + (3 * bool(fieldName == "description")))
+                for bookID in books:
+                    results[bookID] = results.get(bookID, 0) + relevance
+        # field in query - +15 per field
+        substrings = {query[start:start + length] for length in self.valueLengths
+                      for start in range(len(query) - length + 1)}
+        for substring in substrings:
+            for bookID, count in self.values.get(hash(substring), {}).items():
+                # Fields are only kept by the hash, so check it is the same field
+                if substring in self.bookFields(self.data[bookID]).values():
+                    results[bookID] = results.get(bookID, 0) + count * 15
+        return results
+
+    def search(self, query, count=None):
+        """Returns an ordered list of bookIDs for the query and the total amount of results
+
+        count limits the list to the most relevant results"""
+        query = query.lower()
+        return rank([(relevance, self.order[bookID], bookID)
+                     for bookID, relevance in self.score(query).items()], query, count)
+
+
+class filterIndex:
+    """In-memory secondary indexes of the books for filtering and sorting
+
+    Categorical fields have a hash index of each lowercase value to the
+    books with it, and sortable fields have a list of (value, order, bookID)
+    which is kept sorted as books change, so a page of books sorted by a
+    field, or every book by an author, is found without reading every book.
+    Books without a value for a sortable field are kept seperately so they
+    are always last."""
+    filterFields = ("author", "series", "genre", "language", "publisher")
+    sortFields = ("title", "releaseDate", "lastModified")
+    # Fields which can be counted with facets, releaseYear is the year of releaseDate
+    facetFields = filterFields + ("releaseYear",)
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove everything from the index"""
+        # The dict the index was built from, used to check if it is stale
+        self.data = None
+        # {bookID: ({filterField: value}, {sortField: value})} of what each book is indexed by
+        self.keys = {}
+        # {facetField: {lowercase value: set(bookIDs)}}
+        self.values = {field: {} for field in self.facetFields}
+        # {sortField: [(value, order, bookID)]} in order of value
+        self.sorted = {field: [] for field in self.sortFields}
+        # {sortField: [(order, bookID)]} of books without a value, in order of order
+        self.empty = {field: [] for field in self.sortFields}
+        # {bookID: int} - insertion order, the order books are in without sorting
+        self.order = {}
+        self.nextOrder = 0
+
+    def rebuild(self, data):
+        """Index every book in data"""
+        self.clear()
+        for bookID, book in list(data.items()):
+            self.update(bookID, book)
+        for entries in (*self.sorted.values(), *self.empty.values()):
+            entries.sort()
+        self.data = data
+
+    def bookKeys(self, book):
+        """Returns the values a book is indexed by"""
+        filterValues = {field: book.get(field, "").lower() for field in self.filterFields}
+        filterValues["releaseYear"] = book.get("releaseDate", "")[:4]
+        sortValues = {
+            "title": book.get("title", "").lower(),
+            "releaseDate": book.get("releaseDate", ""),
+            "lastModified": book.get("lastModified", 0)
+        }
+        return filterValues, sortValues
+
+    def update(self, bookID, book):
+        """Add a book to the index, or reindex it if it is already indexed"""
+        keys = self.bookKeys(book)
+        if bookID in self.keys:
+            if self.keys[bookID] == keys:
+                return
+            self.removeKeys(bookID)
+        else:
+            self.order[bookID] = self.nextOrder
+            self.nextOrder += 1
+        order = self.order[bookID]
+        filterValues, sortValues = keys
+        for field, value in filterValues.items():
+            if value != "":
+                self.values[field].setdefault(value, set()).add(bookID)
+        for field, value in sortValues.items():
+            entries, entry = ((self.empty[field], (order, bookID)) if value == ""
+                              else (self.sorted[field], (value, order, bookID)))
+            if self.data == None:
+                # Rebuilding, the lists are sorted at the end
+                entries.append(entry)
+            else:
+                bisect.insort(entries, entry)
+        self.keys[bookID] = keys
+
+    def remove(self, bookID):
+        """Remove a book from the index"""
+        if bookID in self.keys:
+            self.removeKeys(bookID)
+            del self.keys[bookID]
+            del self.order[bookID]
+
+    def removeKeys(self, bookID):
+        """Remove a book from the hash and sorted indexes"""
+        order = self.order[bookID]
+        filterValues, sortValues = self.keys[bookID]
+        for field, value in filterValues.items():
+            if value != "":
+                books = self.values[field][value]
+                books.discard(bookID)
+                if not books:
+                    del self.values[field][value]
+        for field, value in sortValues.items():
+            entries, entry = ((self.empty[field], (order, bookID)) if value == ""
+                              else (self.sorted[field], (value, order, bookID)))
+            del entries[bisect.bisect_left(entries, entry)]
+
+    def match(self, filters):
+        """Returns the set of bookIDs which match every filter, or None if there are no filters
+
+        filters is {filterField: [values]} where a book matches if it has
+        any of the values, and {"releaseDate": (start, end)} where start and
+        end are inclusive and can be a prefix such as a year, or None"""
+        matches = []
+        for field, values in filters.items():
+            if field == "releaseDate":
+                start, end = values
+                entries = self.sorted[field]
+                first = 0 if start == None else bisect.bisect_left(entries, (start,))
+                last = len(entries) if end == None else bisect.bisect_left(entries, (end + "\uffff",))
+                matches.append({bookID for value, order, bookID in entries[first:last]})
+            else:
+                books = set()
+                for value in values:
+                    books |= self.values[field].get(value.lower(), set())
+                matches.append(books)
+        if not matches:
+            return None
+        # Intersect the smallest first
+        matches.sort(key=len)
+        books = set(matches[0])
+        for match in matches[1:]:
+            if not books:
+                break
+            books &= match
+        return books
+
+    def facets(self, books, fields, limit=10):
+        """Returns {facetField: [(value, count)]} of the most common values of fields in books
+
+        books is the set of bookIDs to count, or None for every book which
+        is counted with the size of each values postings. Values are in the
+        case of one of the books with them, the same value with a different
+        case is counted together"""
+        facets = {}
+        for field in fields:
+            if books == None:
+                counts = {value: len(bookIDs) for value, bookIDs in self.values[field].items()}
+            else:
+                counts = collections.Counter(self.keys[bookID][0][field] for bookID in books if bookID in self.keys)
+                counts.pop("", None)
+            top = heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+            facets[field] = [(self.facetValue(field, value), count) for value, count in top]
+        return facets
+
+    def facetValue(self, field, value):
+        """Returns a lowercase facet value in the case it is in a book"""
+        if field == "releaseYear":
+            return value
+        bookID = next(iter(self.values[field][value]))
+        return self.data[bookID][field] if self.data != None and bookID in self.data else value
+
+    def sortBookIDs(self, bookIDs, field=None, reverse=False):
+        """Sort bookIDs by a sort field, or by newest first if field is None
+
+        Books without a value are last, books with the same value are in the same direction by order"""
+        if field == None:
+            return sorted(bookIDs, key=self.order.__getitem__, reverse=True)
+        books = [(self.keys[bookID][1][field], self.order[bookID], bookID) for bookID in bookIDs]
+        empty = sorted((book[1:] for book in books if book[0] == ""), reverse=reverse)
+        books = sorted((book for book in books if book[0] != ""), reverse=reverse)
+        return [book[-1] for book in books] + [book[-1] for book in empty]
+
+    def page(self, books, field=None, reverse=False, offset=0, limit=None):
+        """Returns a page of bookIDs sorted like sortBookIDs and the total amount of them
+
+        books is the set of bookIDs from match, or None for every book.
+        If there are few books they are sorted, otherwise the sorted index is
+        read in order until the page is found"""
+        end = None if limit is None else offset + limit
+        total = len(self.keys) if books == None else len(books)
+        if books != None and (field == None or len(books) * 16 < len(self.keys)):
+            return self.sortBookIDs(books, field, reverse)[offset:end], total
+        if field == None:
+            ordered = reversed(self.order)
+        else:
+            sortedEntries = reversed(self.sorted[field]) if reverse else iter(self.sorted[field])
+            emptyEntries = reversed(self.empty[field]) if reverse else iter(self.empty[field])
+            ordered = (entry[-1] for entries in (sortedEntries, emptyEntries) for entry in entries)
+        if books != None:
+            ordered = (bookID for bookID in ordered if bookID in books)
+        return list(itertools.islice(ordered, offset, end)), total
+
+
+class suggestIndex:
+    """In-memory index of the titles, authors, and series of the books for search as you type
+
+    Each distinct lowercase value of the fields is a suggestion, and the
+    tokens of the values are kept in a sorted list so the tokens starting
+    with the word being typed are a range found with a binary search. Typos
+    are found with a deletion index, every token is indexed by the strings
+    made by deleting one of its characters so the tokens within one edit of
+    a word are found without comparing it to every token. The most common
+    suggestions for short prefixes are cached as they match the most values."""
+    suggestFields = ("title", "author", "series")
+    # Most edits between a word and a token, and the shortest word which can have them
+    maxDistance = 1
+    minFuzzyLength = 4
+    # Prefixes up to this length have their suggestions cached
+    cachedPrefixLength = 3
+    maxLimit = 25
+    # Suggestions kept for each cached prefix, more than maxLimit so values can become less common
+    cachedDepth = 100
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove everything from the index"""
+        # The dict the index was built from, used to check if it is stale
+        self.data = None
+        # {bookID: {(field, lowercase value)}} of the values each book is counted in
+        self.books = {}
+        # {(field, lowercase value): [value, amount of books]}
+        self.values = {}
+        # {token: set((field, lowercase value))}
+        self.tokens = {}
+        self.sortedTokens = []
+        # {token or token with a character deleted: set(tokens)}
+        self.deletes = {}
+        # {prefix: [[(field, lowercase value)], complete]} of the most common values with
+        # a token starting with prefix in order of prefixRank, complete is if they are every value
+        self.prefixCache = {}
+
+    def rebuild(self, data, books=None):
+        """Index every book in data, or in books which is an iterable of (bookID, book) if given"""
+        self.clear()
+        for bookID, book in (list(data.items()) if books == None else books):
+            self.update(bookID, book)
+        self.sortedTokens.sort()
+        self.data = data
+
+    def tokenDeletes(self, token):
+        """Returns the token and every string made by deleting one of its characters"""
+        return {token} | {token[:i] + token[i + 1:] for i in range(len(token))}
+
+    def update(self, bookID, book):
+        """Add a book to the index, or reindex it if it is already indexed"""
+        keys = {(field, book.get(field, "").lower()) for field in self.suggestFields if book.get(field, "")}
+        oldKeys = self.books.get(bookID, set())
+        for key in oldKeys - keys:
+            self.removeValue(key)
+        for key in keys - oldKeys:
+            if key in self.values:
+                self.values[key][1] += 1
+            else:
+                self.values[key] = [book[key[0]], 1]
+                for token in set(key[1].split(" ")) - {""}:
+                    if token not in self.tokens:
+                        self.tokens[token] = set()
+                        if self.data == None:
+                            # Rebuilding, the tokens are sorted at the end
+                            self.sortedTokens.append(token)
+                        else:
+                            bisect.insort(self.sortedTokens, token)
+                        for delete in self.tokenDeletes(token):
+                            self.deletes.setdefault(delete, set()).add(token)
+                    self.tokens[token].add(key)
+            self.prefixCacheUpdate(key, True)
+        self.books[bookID] = keys
+
+    def remove(self, bookID):
+        """Remove a book from the index"""
+        for key in self.books.pop(bookID, set()):
+            self.removeValue(key)
+
+    def removeValue(self, key):
+        """Remove a book from the count of a value, and the value once no books have it"""
+        self.values[key][1] -= 1
+        self.prefixCacheUpdate(key, False)
+        if self.values[key][1] > 0:
+            return
+        del self.values[key]
+        for token in set(key[1].split(" ")) - {""}:
+            self.tokens[token].discard(key)
+            if not self.tokens[token]:
+                del self.tokens[token]
+                del self.sortedTokens[bisect.bisect_left(self.sortedTokens, token)]
+                for delete in self.tokenDeletes(token):
+                    self.deletes[delete].discard(token)
+                    if not self.deletes[delete]:
+                        del self.deletes[delete]
+
+    def prefixRank(self, key):
+        """Sort key of a value with no edits, the most common first"""
+        return (-self.values[key][1], key[1], self.suggestFields.index(key[0]))
+
+    def prefixCacheUpdate(self, key, increased):
+        """Keep the cached suggestions in order when the amount of books with a value changes
+
+        The cached values are the start of the ranking, so a changed value is
+        moved to its new place if it is before the last cached value, and
+        dropped if it is after it. A prefix is forgotten once too few
+        values are left to know its most common values."""
+        if not self.prefixCache:
+            return
+        prefixes = {token[:length] for token in key[1].split(" ") if token
+                    for length in range(1, self.cachedPrefixLength + 1)}
+        for prefix in prefixes:
+            if prefix not in self.prefixCache:
+                continue
+            cached, complete = self.prefixCache[prefix]
+            if key in cached:
+                cached.remove(key)
+            elif not increased:
+                continue
+            if self.values[key][1] > 0 and (complete or (cached and self.prefixRank(key) < self.prefixRank(cached[-1]))):
+                bisect.insort(cached, key, key=self.prefixRank)
+                if len(cached) > self.cachedDepth:
+                    del cached[self.cachedDepth:]
+                    self.prefixCache[prefix][1] = False
+            if not self.prefixCache[prefix][1] and len(cached) < self.maxLimit:
+                del self.prefixCache[prefix]
+
+    def tokensStarting(self, prefix):
+        """Returns the tokens which start with prefix"""
+        start = bisect.bisect_left(self.sortedTokens, prefix)
+        end = bisect.bisect_left(self.sortedTokens, prefix + "\uffff", start)
+        return self.sortedTokens[start:end]
+
+    def tokensNear(self, word):
+        """Returns {token: edits} of the tokens within maxDistance edits of word"""
+        if len(word) < self.minFuzzyLength:
+            return {}
+        candidates = set()
+        for delete in self.tokenDeletes(word):
+            candidates |= self.deletes.get(delete, set())
+        tokens = {}
+        for token in candidates:
+            distance = editDistance(word, token, self.maxDistance)
+            if distance <= self.maxDistance:
+                tokens[token] = distance
+        return tokens
+
+    def suggest(self, query, limit=10):
+        """Returns [(value, field, amount of books, edits)] of the values which match what is being typed
+
+        Every word must be a token of the value or within maxDistance edits
+        of one, and the last word can also be the start of a token. The
+        values with the fewest edits are first, then the most common."""
+        limit = min(limit, self.maxLimit)
+        words = query.lower().split()
+        if not words:
+            return []
+        typing = not query[-1].isspace()
+        if len(words) == 1 and typing and len(words[0]) <= self.cachedPrefixLength:
+            if words[0] not in self.prefixCache:
+                values = self.matchWord(words[0], True)
+                self.prefixCache[words[0]] = [heapq.nsmallest(self.cachedDepth, values, key=self.prefixRank),
+                                              len(values) <= self.cachedDepth]
+            return [(self.values[key][0], key[0], self.values[key][1], 0) for key in self.prefixCache[words[0]][0][:limit]]
+        candidates = None
+        for i, word in enumerate(words):
+            values = self.matchWord(word, typing and i == len(words) - 1)
+            if candidates == None:
+                candidates = values
+            else:
+                candidates = {key: candidates[key] + distance for key, distance in values.items() if key in candidates}
+            if not candidates:
+                return []
+        return self.rankValues(candidates, limit)
+
+    def matchWord(self, word, prefix):
+        """Returns {(field, lowercase value): edits} of the values with a token matching word"""
+        tokens = self.tokensNear(word)
+        if word in self.tokens:
+            tokens[word] = 0
+        if prefix:
+            tokens.update({token: 0 for token in self.tokensStarting(word)})
+        values = {}
+        for token, distance in tokens.items():
+            for key in self.tokens[token]:
+                if values.get(key, distance + 1) > distance:
+                    values[key] = distance
+        return values
+
+    def rankValues(self, values, limit):
+        """Returns the suggestions for the most relevant of {(field, lowercase value): edits}"""
+        top = heapq.nsmallest(limit, values.items(), key=lambda item: (
+            item[1], -self.values[item[0]][1], item[0][1], self.suggestFields.index(item[0][0])))
+        return [(self.values[key][0], key[0], self.values[key][1], distance) for key, distance in top]
+
+
+def editDistance(a, b, maxDistance):
+    """Returns the optimal string alignment distance between a and b, where swapping
+    two characters next to each other is one edit, or maxDistance + 1 if it is more"""
+    if abs(len(a) - len(b)) > maxDistance:
+        return maxDistance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > maxDistance:
+            return maxDistance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], maxDistance + 1)
+
+
+class searchCache:
+    """LRU cache of ranked search results keyed by the lowercase query
+
+    Entries are only valid for the generation of the database they were
+    ranked in, the database increases its generation whenever it changes."""
+
+    def __init__(self, maxSize=128, ttl=300):
+        """maxSize is the amount of queries kept, ttl is how many seconds they are kept for"""
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, query, generation, end):
+        """Returns the cached (bookIDs, total) for a query if it contains the results up to end
+
+        end=None if every result is needed"""
+        with self.lock:
+            entry = self.entries.get(query)
+            if entry != None:
+                entryGeneration, created, bookIDs, total = entry
+                if entryGeneration != generation or time.monotonic() - created > self.ttl:
+                    del self.entries[query]
+                elif len(bookIDs) == total or (end != None and end <= len(bookIDs)):
+                    self.entries.move_to_end(query)
+                    self.hits += 1
+                    return bookIDs, total
+            self.misses += 1
+            return None
+
+    def put(self, query, generation, bookIDs, total):
+        """Cache the ranked bookIDs for a query, which may only be the first part of the results"""
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            self.entries[query] = (generation, time.monotonic(), bookIDs, total)
+            self.entries.move_to_end(query)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached results"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns a dict of the caches size and hit rate"""
+        requests = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxSize": self.maxSize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / requests if requests else 0
+        }
+
+
+def relevance(fields, query):
+    """Returns how relevant a book is to a lowercase query
+
+    fields is a dict of the books lowercase fields, this scores a single
+    book with the same rules as searchIndex for storage without the index"""
+    result = 0
+    queryWords = query.split(" ")
+    for fieldName, field in fields.items():
+        if field == "":
+            continue
+        # query in field - +wordLength per word
+        # except description which is wordLength divided by 4
+        for queryWord in queryWords:
+            result += int(queryWord in field) * (len(queryWord)
+                      / (1 + (3 * bool(fieldName == "description"))))
+        # field in query - +15 per field
+        result += int(field in query) * 15
+    return result
+
+
+def rank(results, query, count=None):
+    """Order (relevance, order, bookID) results by relevance then order, newest first
+
+    Returns the bookIDs of the results above the minimum relevance for the
+    query and the amount of them, count limits the bookIDs to the most
+    relevant results which are selected with a heap instead of a sort"""
+    minRelevancy = len(query) * 0.75
+    results = [result for result in results if result[0] > minRelevancy]
+    total = len(results)
+    if count is None or count >= total:
+        results.sort(reverse=True)
+    else:
+        results = heapq.nlargest(count, results)
+    return [bookID for relevance, order, bookID in results], total
@@ -2,26 +2,122 @@
 # Copyright (c) 2022 JoeBlakeB
 # All Rights Reserved
 
+import assets
+import bulk
 import flask
+import logging
+import metrics
 import os
+import signal
+import socket
 import sys
 import threading
 import time
 import traceback
+import zlib
 
-from database import database
+from covers import Image, coverFilename, coverQueue, features, parseCoverSizes
+from database import database, fileTooLarge
+from search import filterIndex
+from sqlitedb import sqliteDatabase
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import ClosingIterator
 
-booklist = flask.Flask(__name__, template_folder=".")
+# Static files are sent by sendStatic from the asset store instead of Flask
+booklist = flask.Flask(__name__, template_folder=".", static_folder=None)
 booklist.config['MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024
 booklist.url_map.strict_slashes = False
+webpSupported = bool(features and features.check("webp"))
+# Most books that can be used in a single batch request
+batchMaxSize = 1000
+# Longest search or suggest query, longer ones are cut to this length
+maxQueryLength = 256
+# Most byte ranges in a single request, requests for more are sent the whole file
+maxRanges = 16
+# Bytes of a file read at a time when it isnt sent by the server
+fileChunkSize = 256 * 1024
+# Import formats for each request Content-Type
+importFormats = {"application/x-ndjson": "jsonl", "application/jsonl": "jsonl", "text/csv": "csv"}
+# Keys of a book which can be requested with fields
+bookKeys = database.bookFields + ("files", "hasCover", "coverVersion", "lastModified")
+
+# assets.assetStore of the static folder, made by staticAssets when it is first used
+assetStore = None
+assetStoreLock = threading.Lock()
+# {bodyClasses: assets.asset} of the rendered index page
+indexPages = {}
+
+# Request latency, database timers, and the gauges shown at /metrics
+requestMetrics = metrics.metrics()
+requestMetrics.describe("booklist_request_seconds", "Time taken to respond to requests")
+requestsInProgress = 0
+requestsLock = threading.Lock()
+# metrics.sampler which saves profiles of slow requests, None unless --profile-slow
+profiler = None
+# The waitress server, None when using werkzeug
+waitressServer = None
+
+
+@booklist.before_request
+def beforeRequest():
+    """Start timing the request"""
+    global requestsInProgress
+    flask.g.requestStart = time.perf_counter()
+    with requestsLock:
+        requestsInProgress += 1
+    if profiler:
+        profiler.start()
+
 
 @booklist.after_request
 def afterRequest(response):
-    """Add server to user agent"""
+    """Add server to user agent, and add the time taken to the requests routes histogram"""
     response.headers["Server"] = f"AppAssignmentBooklist Python/{sys.version.split()[0]}"
+    if "requestStart" in flask.g:
+        # Rules rather than paths so there is a histogram for each route instead of each book
+        route = flask.request.url_rule.rule if flask.request.url_rule else "unmatched"
+        seconds = time.perf_counter() - flask.g.requestStart
+        requestMetrics.observe("booklist_request_seconds", seconds,
+            method=flask.request.method, route=route, status=response.status_code)
+        if profiler:
+            profiler.stop(f"{flask.request.method} {route}", seconds)
     return response
 
 
+@booklist.teardown_request
+def teardownRequest(exception):
+    """Count the request as finished even if it raised an exception"""
+    global requestsInProgress
+    if "requestStart" in flask.g:
+        with requestsLock:
+            requestsInProgress -= 1
+
+
+def waitressStats(stat):
+    """Returns a function for a gauge of the waitress servers queue and threads"""
+    def gauge():
+        if not waitressServer:
+            return None
+        dispatcher = waitressServer.task_dispatcher
+        return {"queued": len(dispatcher.queue), "threads": len(dispatcher.threads),
+                "busy": dispatcher.active_count}[stat]
+    return gauge
+
+
+requestMetrics.gauge("booklist_requests_in_progress", "Requests currently being handled", lambda: requestsInProgress)
+requestMetrics.gauge("booklist_waitress_queue_depth", "Requests waiting for a waitress thread", waitressStats("queued"))
+requestMetrics.gauge("booklist_waitress_threads", "Waitress threads", waitressStats("threads"))
+requestMetrics.gauge("booklist_waitress_threads_busy", "Waitress threads handling a request", waitressStats("busy"))
+requestMetrics.gauge("booklist_books", "Books in the database", lambda: len(db.data))
+requestMetrics.gauge("booklist_search_cache_hits_total", "Search cache hits", lambda: db.searchCache.hits, "counter")
+requestMetrics.gauge("booklist_search_cache_misses_total", "Search cache misses", lambda: db.searchCache.misses, "counter")
+requestMetrics.gauge("booklist_cover_cache_bytes", "Bytes of covers resized with ?w=", lambda: db.coverCache.bytes)
+requestMetrics.gauge("booklist_cover_queue", "Covers waiting to be resized and being resized", lambda: {
+    (("state", state),): db.coverQueue.stats()[state] for state in ("queued", "processing")} if db.coverQueue else None)
+requestMetrics.gauge("booklist_saves_total", "Times the data has been saved", lambda: db.saveStats["saves"], "counter")
+requestMetrics.gauge("booklist_save_seconds_total", "Time spent saving", lambda: db.saveStats["totalDuration"], "counter")
+
+
 @booklist.route("/", methods=["GET"])
 def sendIndex():
     """Send the booklist page with body classes added based on cookies and user agent."""
@@ -39,38 +135,255 @@ def sendIndex():
     else:
         bodyClasses += " breezeColorScheme"
 
-    return flask.render_template("index.html", bodyClasses=bodyClasses)
+    # The page only changes with the body classes, so each is rendered once
+    page = indexPages.get(bodyClasses)
+    if page == None:
+        page = staticAssets().build("index.html", flask.render_template(
+            "index.html", bodyClasses=bodyClasses).encode())
+        indexPages[bodyClasses] = page
+    response = sendAsset(page)
+    response.vary.update(("Cookie", "User-Agent"))
+    return response
+
+
+def staticAssets():
+    """The asset store of the static folder, it is made the first time it is needed"""
+    global assetStore
+    if assetStore == None:
+        with assetStoreLock:
+            if assetStore == None:
+                indexPages.clear()
+                assetStore = assets.assetStore(os.path.join(os.path.dirname(__file__), "static"))
+    return assetStore
+
+
+def sendAsset(asset, immutable=False):
+    """Send the smallest encoding of an asset which the client accepts"""
+    encoding = asset.encoding(flask.request.accept_encodings)
+    etag = asset.etag(encoding)
+    if notModified(etag):
+        response = notModifiedResponse(etag, immutable=immutable)
+    else:
+        response = cacheControl(flask.Response(asset.bodies[encoding], content_type=asset.mimetype), immutable)
+        response.set_etag(etag)
+        if encoding != "identity":
+            response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    return response
 
 
 @booklist.route("/static/<path:path>", methods=["GET"])
 def sendStatic(path):
-    """Send all files in the static folder"""
-    return flask.send_from_directory("static", path)
+    """Send all files in the static folder
+
+    Files are sent minified and compressed from the asset store, and
+    cached forever when the URL has their current ?v=version"""
+    asset = staticAssets().get(path)
+    if asset == None:
+        return flask.abort(404)
+    return sendAsset(asset, flask.request.args.get("v") == asset.version)
+
+
+def notModified(etag, lastModified=None):
+    """Returns a bool for if the requests conditional headers show the client has the current version"""
+    if flask.request.if_none_match:
+        return flask.request.if_none_match.contains(etag)
+    if lastModified != None and flask.request.if_modified_since:
+        return int(lastModified) <= flask.request.if_modified_since.timestamp()
+    return False
+
+
+def notModifiedResponse(etag, lastModified=None, immutable=False):
+    """A 304 response with the same validators and caching as the full response"""
+    response = flask.Response(status=304)
+    response.set_etag(etag)
+    if lastModified != None:
+        response.last_modified = lastModified
+    return cacheControl(response, immutable)
+
+
+def cacheControl(response, immutable=False):
+    """Cache immutable responses for a year, and make clients revalidate anything else"""
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 
 @booklist.route("/book/cover/<bookID>", defaults={"size": ""}, methods=["GET"])
-@booklist.route("/book/cover/<bookID>/preview", defaults={"size": "Preview"}, methods=["GET"])
+@booklist.route("/book/cover/<bookID>/<size>", methods=["GET"])
 def bookCover(bookID, size):
-    """Sends the cover of a book"""
-    if db.coverExists(bookID):
-        coverFilename = db.bookFilePath(bookID, f"cover{size}.jpg")
-        if os.path.exists(coverFilename):
-            return flask.send_file(coverFilename, download_name=db.safeFilename(
-                db.bookGet(bookID)['title']) + f"_cover{size}.jpg")
+    """Sends a size of the cover of a book, such as /book/cover/<bookID>/preview
+
+    ?w=width resizes the full size cover to a width when it is requested,
+    these are kept in the cover cache.
+    The books coverVersion is a hash of the cover, so it is used for its
+    ETag, and if the URL is versioned with ?v=coverVersion it can be cached
+    forever. Covers from before coverVersion use the books lastModified"""
+    if not size in db.coverSizes:
+        return flask.abort(404)
+    book = db.bookGet(bookID)
+    if book and book["hasCover"]:
+        version = book.get("coverVersion") or str(book["lastModified"])
+        etag = f"{bookID}-{version}{size}"
+        immutable = flask.request.args.get("v") == version
+        # Resize the full size cover to a width, as WebP if the browser accepts it
+        width = flask.request.args.get("w", type=int)
+        if width and size == "" and Image:
+            width = db.coverCache.width(width, db.coverSizes[""][0])
+            format = "jpeg"
+            if webpSupported and flask.request.accept_mimetypes["image/webp"]:
+                format = "webp"
+            etag = f"{bookID}-{version}-{width}.{format}"
+            if notModified(etag, book["lastModified"]):
+                response = notModifiedResponse(etag, book["lastModified"], immutable)
+            else:
+                coverPath = db.coverCache.get(bookID, version,
+                    db.bookFilePath(bookID, coverFilename()), width, format)
+                if not coverPath:
+                    return flask.send_file("static/images/bookCoverPlaceholder.png"), 404
+                response = cacheControl(flask.send_file(coverPath, download_name=db.safeFilename(
+                    book['title']) + f"_cover.{format}", etag=etag, last_modified=book["lastModified"]),
+                    immutable)
+            response.vary.add("Accept")
+            return response
+        if notModified(etag, book["lastModified"]):
+            return notModifiedResponse(etag, book["lastModified"], immutable)
+        # Covers from before a size was added use the next larger size
+        sizes = list(db.coverSizes)
+        for coverSize in reversed(sizes[:sizes.index(size) + 1]):
+            coverPath = db.bookFilePath(bookID, coverFilename(coverSize))
+            if os.path.exists(coverPath):
+                return cacheControl(flask.send_file(coverPath, download_name=db.safeFilename(
+                    book['title']) + "_" + coverFilename(size), etag=etag, last_modified=book["lastModified"]),
+                    immutable)
     # If book doesnt exist or if book doesnt have cover
-    return flask.send_file(f"static/images/bookCoverPlaceholder{size}.png"), 404
+    placeholder = f"static/images/bookCoverPlaceholder{size.capitalize()}.png"
+    if not os.path.exists(placeholder):
+        placeholder = "static/images/bookCoverPlaceholder.png"
+    return flask.send_file(placeholder), 404
 
 
 @booklist.route("/book/file/<bookID>/<hashName>", methods=["GET"])
 def bookFile(bookID, hashName):
-    """Sends a books file"""
+    """Sends a books file
+
+    The contents of a hashName never change but the filename can, so
+    the ETag is the hashName and a checksum of the filename"""
     book = db.fileGet(bookID, hashName)
-    filePath = db.bookFilePath(bookID, hashName)
-    if book and os.path.exists(filePath):
-        return flask.send_file(filePath, download_name=book["name"])
+    if book:
+        etag = f"{hashName}-{zlib.crc32(book['name'].encode()):08x}"
+        if notModified(etag):
+            return notModifiedResponse(etag)
+        filePath = db.filePath(bookID, hashName)
+        if os.path.exists(filePath):
+            return cacheControl(sendFileRanges(filePath, book["name"], etag))
     return flask.abort(404)
 
 
+def requestRanges(length, etag):
+    """Returns the [(start, stop)] byte ranges of a file the request wants, sorted and with overlaps merged
+
+    None means the whole file, when there is no Range header, If-Range
+    isnt the current ETag, or there are more than maxRanges. An empty
+    list means none of the ranges are in the file"""
+    units, _, specs = flask.request.headers.get("Range", "").partition("=")
+    specs = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    if units.strip().lower() != "bytes" or not specs or len(specs) > maxRanges:
+        return None
+    # Files have no Last-Modified, so only a strong ETag can match
+    ifRange = flask.request.headers.get("If-Range")
+    if ifRange != None and ifRange.strip() != f"\"{etag}\"":
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = (part.strip() for part in spec.partition("-"))
+        # Invalid Range headers are ignored
+        if not dash or not (first or last) or not all(
+                part.isascii() and part.isdigit() for part in (first, last) if part):
+            return None
+        if first and last and int(last) < int(first):
+            return None
+        if not first:
+            start, stop = max(length - int(last), 0), length
+        else:
+            start, stop = int(first), min(int(last) + 1, length) if last else length
+        if start < stop:
+            ranges.append((start, stop))
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def fileChunks(file, start, stop):
+    """Generate the bytes of a file from start to stop"""
+    file.seek(start)
+    while start < stop:
+        chunk = file.read(min(fileChunkSize, stop - start))
+        if not chunk:
+            return
+        start += len(chunk)
+        yield chunk
+
+
+def multipartRanges(file, ranges, length, contentType, boundary):
+    """Returns a multipart/byteranges body of the ranges of a file, and its length"""
+    heads = [(f"--{boundary}\r\nContent-Type: {contentType}\r\n"
+              f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n").encode() for start, stop in ranges]
+    end = f"--{boundary}--\r\n".encode()
+    def body():
+        for head, (start, stop) in zip(heads, ranges):
+            yield head
+            yield from fileChunks(file, start, stop)
+            yield b"\r\n"
+        yield end
+    length = sum(len(head) + stop - start + 2 for head, (start, stop) in zip(heads, ranges)) + len(end)
+    return ClosingIterator(body(), file.close), length
+
+
+def sendFileRanges(path, downloadName, etag):
+    """Send a file, or the byte ranges of it the request wants
+
+    The whole file and single ranges are given to the servers
+    wsgi.file_wrapper from the start of the range, so waitress and the
+    ASGI server send them without a thread and stop at the Content-Length.
+    Multiple ranges are sent as multipart/byteranges."""
+    length = os.path.getsize(path)
+    ranges = requestRanges(length, etag)
+    if ranges == []:
+        response = flask.Response(status=416)
+        response.content_range = ContentRange("bytes", None, None, length)
+        response.accept_ranges = "bytes"
+        return response
+    file = open(path, "rb")
+    response = flask.send_file(file, download_name=downloadName, etag=etag, conditional=False)
+    response.accept_ranges = "bytes"
+    if ranges != None and len(ranges) > 1:
+        boundary = os.urandom(12).hex()
+        response.response, response.content_length = multipartRanges(
+            file, ranges, length, response.content_type, boundary)
+        response.content_type = f"multipart/byteranges; boundary={boundary}"
+        response.status_code = 206
+        return response
+    start, stop = ranges[0] if ranges else (0, length)
+    if ranges:
+        response.content_range = ContentRange("bytes", start, stop, length)
+        response.status_code = 206
+    response.content_length = stop - start
+    file.seek(start)
+    if "wsgi.file_wrapper" not in flask.request.environ:
+        # werkzeugs FileWrapper would read to the end of the file
+        response.response = ClosingIterator(fileChunks(file, start, stop), file.close)
+    return response
+
+
 def fileIconsDict():
     """Generate the fileIcons dict for file icon filenames"""
     fileIcons = {}
@@ -85,9 +398,7 @@ def fileIconsDict():
 @booklist.route("/fileicon/<fileType>.svg", methods=["GET"])
 def fileIcon(fileType):
     """Sends a icon for a specific filetype"""
-    if fileType in fileIcons:
-        return flask.send_file("static/svg/" + fileIcons[fileType])
-    return flask.send_file("static/svg/filetype-unknown.svg")
+    return sendAsset(staticAssets().get("svg/" + fileIcons.get(fileType, "filetype-unknown.svg")))
 
 
 @booklist.route("/api/get/<bookID>", methods=["GET"])
@@ -139,6 +450,142 @@ def apiDelete(bookID):
     return {"deleted": True}
 
 
+def batchRequest(key, type):
+    """Returns the list or dict at key in the requests JSON, or None if it is invalid or too large"""
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get(key), type):
+        return None
+    if len(data[key]) == 0 or len(data[key]) > batchMaxSize:
+        return None
+    return data[key]
+
+
+def requestFields(fields):
+    """Returns the list of book keys in fields, or None if there are invalid keys
+
+    fields is a list, or a string of keys seperated by commas"""
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    if not isinstance(fields, list) or not all(field in bookKeys for field in fields):
+        return None
+    return fields
+
+
+@booklist.route("/api/batch/get", methods=["POST"])
+def apiBatchGet():
+    """Respond with the data of many books
+
+    JSON: {"bookIDs": [bookIDs], "fields": [optional keys of each book to send]}"""
+    bookIDs = batchRequest("bookIDs", list)
+    fields = flask.request.get_json(silent=True)
+    fields = fields.get("fields") if isinstance(fields, dict) else None
+    if fields != None:
+        fields = requestFields(fields)
+        if fields == None:
+            return {"success": False}, 422
+    if bookIDs == None or not all(isinstance(bookID, str) for bookID in bookIDs):
+        return {"success": False}, 422
+    books = db.bookGetMany(bookIDs, fields)
+    return flask.jsonify({"books": books, "missing": [bookID for bookID in bookIDs if not bookID in books]})
+
+
+@booklist.route("/api/batch/new", methods=["POST"])
+def apiBatchNew():
+    """Create many books, respond with the bookID of each, or false if it wasnt created
+
+    JSON: {"books": [book data]}"""
+    books = batchRequest("books", list)
+    if books == None:
+        return {"success": False}, 422
+    return {"success": True, "bookIDs": db.bookAddMany(books)}
+
+
+@booklist.route("/api/batch/edit", methods=["PUT"])
+def apiBatchEdit():
+    """Edit the metadata of many books, respond with if each book was edited
+
+    JSON: {"books": {bookID: book data}}"""
+    books = batchRequest("books", dict)
+    if books == None:
+        return {"success": False}, 422
+    return {"success": True, "edited": db.bookEditMany(books)}
+
+
+@booklist.route("/api/batch/delete", methods=["DELETE"])
+def apiBatchDelete():
+    """Delete many books, respond with if each book was deleted
+
+    JSON: {"bookIDs": [bookIDs]}"""
+    bookIDs = batchRequest("bookIDs", list)
+    if bookIDs == None or not all(isinstance(bookID, str) for bookID in bookIDs):
+        return {"success": False}, 422
+    return {"success": True, "deleted": db.bookDeleteMany(bookIDs)}
+
+
+@booklist.route("/api/import", methods=["POST"])
+def apiImport():
+    """Import books from the request body, which is streamed and not all kept in memory
+
+    URL Parameters:
+    format = "jsonl", "csv", or "tar", default is from the Content-Type"""
+    format = flask.request.args.get("format")
+    if format == None:
+        format = importFormats.get(flask.request.mimetype, "tar")
+    if not format in ("jsonl", "csv", "tar"):
+        return {"success": False}, 422
+    results = bulk.importer(db, booklist.config['MAX_CONTENT_LENGTH']).importStream(flask.request.stream, format)
+    return {"success": True, **results}
+
+
+@booklist.route("/api/export", methods=["GET"])
+def apiExport():
+    """Stream every book as JSON Lines, or as a tar archive with their covers and files
+
+    URL Parameters:
+    format = "jsonl" or "tar", default is jsonl"""
+    format = flask.request.args.get("format", "jsonl")
+    if format == "jsonl":
+        response = flask.Response(bulk.exportJsonl(db), mimetype="application/x-ndjson")
+    elif format == "tar":
+        response = flask.Response(bulk.exportTar(db), mimetype="application/x-tar")
+    else:
+        return {"success": False}, 422
+    response.headers["Content-Disposition"] = f"attachment; filename=booklist.{format}"
+    return response
+
+
+@booklist.route("/api/changes", methods=["GET"])
+def apiChanges():
+    """Respond with the books added, edited, or deleted since a cursor, oldest first
+
+    URL Parameters:
+    since = int, cursor from the previous response, default 0 for every book
+    limit = int, amount of changes to return, default 100, max 1000
+    fields = keys of each book to return seperated by commas, default every key"""
+    since = flask.request.args.get("since", default=0, type=int)
+    limit = flask.request.args.get("limit", default=100, type=int)
+    fields = flask.request.args.get("fields")
+    if fields != None:
+        fields = requestFields(fields)
+        if fields == None:
+            return {"success": False}, 422
+    if limit <= 0 or limit > batchMaxSize:
+        limit = 100
+    # One more than the limit is fetched to know if there are more changes
+    changes, reset = db.changesSince(max(since, 0), limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+    books = db.bookGetMany([bookID for seq, bookID, deleted in changes if not deleted], fields)
+    return flask.jsonify({
+        "changes": [{"seq": seq, "bookID": bookID, "deleted": deleted or bookID not in books,
+                     **({"book": books[bookID]} if bookID in books else {})}
+                    for seq, bookID, deleted in changes],
+        "cursor": changes[-1][0] if changes else (0 if reset else since),
+        "more": more,
+        "reset": reset
+    })
+
+
 @booklist.route("/api/search", methods=["GET"])
 def apiSearch():
     """Search for books based on a query
@@ -146,38 +593,103 @@ def apiSearch():
     URL Parameters:
     q = string, search query, default ""
     offset = int, books to skip, default 0
-    limit = int, amount of books to return, default 25, max 100"""
+    limit = int, amount of books to return, default 25, max 100
+    fields = keys of each book to return seperated by commas, default title,author,hasCover,coverVersion,lastModified
+    author, series, genre, language, publisher = only books with this value, can be used more than once
+    releaseDateFrom, releaseDateTo = only books released in this range, such as 1990 or 1990-05-21
+    sort = title, releaseDate, or lastModified, - before it for descending, default relevance
+    facets = fields to count the most common values of in every result seperated by commas,
+             author, series, genre, language, publisher, or releaseYear
+    facetLimit = int, amount of values to count for each facet, default 10, max 100"""
     searchStartTime = time.time()
     # Get parameters
     query = flask.request.args.get("q")
-    if query == None or query == "":
-        bookIDs = list(db.data.keys())[::-1]
-    else:
-        bookIDs = db.bookSearch(query)
+    if query != None:
+        query = query[:maxQueryLength]
     offset = flask.request.args.get("offset", default=0, type=int)
     limit = flask.request.args.get("limit", default=25, type=int)
+    fields = flask.request.args.get("fields")
+    if fields != None:
+        fields = requestFields(fields)
+        if fields == None:
+            return {"success": False}, 422
+    filters = {field: flask.request.args.getlist(field) for field in filterIndex.filterFields
+               if flask.request.args.getlist(field)}
+    releaseDates = (flask.request.args.get("releaseDateFrom"), flask.request.args.get("releaseDateTo"))
+    if releaseDates != (None, None):
+        filters["releaseDate"] = releaseDates
+    sort = flask.request.args.get("sort")
+    if sort != None and sort.lstrip("-") not in filterIndex.sortFields:
+        return {"success": False}, 422
+    facets = flask.request.args.get("facets")
+    if facets != None:
+        facets = facets.split(",")
+        if not all(facet in filterIndex.facetFields for facet in facets):
+            return {"success": False}, 422
+    facetLimit = flask.request.args.get("facetLimit", default=10, type=int)
+    if facetLimit <= 0 or facetLimit > 100:
+        facetLimit = 10
     if offset < 0:
         offset = 0
     if limit < 0 or offset > 100:
         limit = 25
+    # Only the requested page of results is ranked
+    pageOfBookIDs, total = db.bookSearchPage(query, offset, limit, filters,
+                                             sort and sort.lstrip("-"), bool(sort and sort.startswith("-")))
 
     # Get book metadata
-    pageOfBookIDs = bookIDs[offset:offset+limit]
     books = []
     for bookID in pageOfBookIDs:
-        books.append({"bookID": bookID, **db.bookGet(bookID, search=True)})
+        books.append({"bookID": bookID, **db.bookGet(bookID, search=True, fields=fields)})
+    if facets:
+        facetCounts = {field: [{"value": value, "count": count} for value, count in values]
+                       for field, values in db.bookFacets(query, filters, facets, facetLimit).items()}
     
     # Return books and information about query
     response = {
         "time": int(((time.time() - searchStartTime) * 1000) + 1),
         "first": offset + 1,
         "last":  offset + len(books),
-        "total": len(bookIDs),
+        "total": total,
         "books": books
     }
+    if facets:
+        response["facets"] = facetCounts
     return response
 
 
+@booklist.route("/api/suggest", methods=["GET"])
+def apiSuggest():
+    """Suggest titles, authors, and series while a query is being typed
+
+    URL Parameters:
+    q = string, the query so far, the last word can be the start of a word and words can have a typo
+    limit = int, amount of suggestions to return, default 10, max 25"""
+    suggestStartTime = time.time()
+    query = flask.request.args.get("q", "")[:maxQueryLength]
+    limit = flask.request.args.get("limit", default=10, type=int)
+    if limit <= 0 or limit > 25:
+        limit = 10
+    suggestions = [{"value": value, "field": field, "count": count, "edits": edits}
+                   for value, field, count, edits in db.bookSuggest(query, limit)]
+    return {"time": int(((time.time() - suggestStartTime) * 1000) + 1), "suggestions": suggestions}
+
+
+@booklist.route("/api/stats", methods=["GET"])
+def apiStats():
+    """Respond with statistics about the server for tuning its settings"""
+    stats = {"searchCache": db.searchCache.stats(), "coverCache": db.coverCache.stats(), "save": db.saveStats}
+    if db.coverQueue:
+        stats["covers"] = db.coverQueue.stats()
+    return stats
+
+
+@booklist.route("/metrics", methods=["GET"])
+def sendMetrics():
+    """Send the request latency, database timers, and server gauges for Prometheus"""
+    return flask.Response(requestMetrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @booklist.route("/api/cover/<bookID>/upload", methods=["PUT"])
 def apiCoverUpload(bookID):
     """Upload a cover image for a book, file is sent as raw data."""
@@ -187,10 +699,20 @@ def apiCoverUpload(bookID):
     if data:
         success = db.coverAdd(bookID, data)
         if success:
-            return {"success": True}
+            return {"success": True, "status": db.coverStatus(bookID) or "done"}
     return {"success": False}, 422
 
 
+@booklist.route("/api/cover/<bookID>/status", methods=["GET"])
+def apiCoverStatus(bookID):
+    """Respond with the status of a books latest cover upload."""
+    book = db.bookGet(bookID)
+    if not book:
+        return {"success": False}, 404
+    return {"status": db.coverStatus(bookID), "hasCover": book["hasCover"],
+            "coverVersion": book.get("coverVersion", "")}
+
+
 @booklist.route("/api/cover/<bookID>/delete", methods=["DELETE"])
 def apiCoverDelete(bookID):
     """Deletes a books cover image."""
@@ -205,16 +727,18 @@ def apiCoverDelete(bookID):
 
 @booklist.route("/api/file/upload/<bookID>/<filename>", methods=["POST"])
 def apiFileUpload(bookID, filename):
-    """Uploads a books file."""
+    """Uploads a books file.
+
+    The request body is streamed to disk so it is never all in memory."""
     if not db.bookGet(bookID):
         return {"success": False, "hashName": None}, 404
-    data = flask.request.get_data()
-    if len(data) > booklist.config['MAX_CONTENT_LENGTH']:
+    try:
+        hashName = db.fileAddStream(bookID, filename, flask.request.stream,
+                                    booklist.config['MAX_CONTENT_LENGTH'])
+    except fileTooLarge:
         return {"success": False, "hashName": None}, 413
-    if data:
-        hashName = db.fileAdd(bookID, filename, data)
-        if hashName:
-            return {"success": True, "hashName": hashName}
+    if hashName:
+        return {"success": True, "hashName": hashName}
     return {"success": False, "hashName": None}, 422
 
 
@@ -245,6 +769,148 @@ def apiFileDelete(bookID, hashName):
         return {"deleted": False}, 404
 
 
+def serve(host, port, threads, autosave, useWaitress, listenSocket=None, worker=None, workers=1, useAsgi=False):
+    """Load the database from the options in argv and serve the booklist until KeyboardInterrupt
+
+    listenSocket and worker are given to the worker processes of preforkServe"""
+    global db, fileIcons, profiler, waitressServer
+    if "--sqlite" in sys.argv:
+        db = sqliteDatabase()
+    else:
+        db = database()
+    db.journaled = "--journal" in sys.argv
+    if "--autosave-debounce" in sys.argv:
+        db.autosaveDebounce = float(sys.argv[sys.argv.index("--autosave-debounce") + 1])
+    if "--autosave-max-delay" in sys.argv:
+        db.autosaveMaxDelay = float(sys.argv[sys.argv.index("--autosave-max-delay") + 1])
+    if "--search-cache-size" in sys.argv:
+        db.searchCache.maxSize = int(sys.argv[sys.argv.index("--search-cache-size") + 1])
+    if "--search-cache-ttl" in sys.argv:
+        db.searchCache.ttl = float(sys.argv[sys.argv.index("--search-cache-ttl") + 1])
+    # Workers share the CPUs for resizing covers
+    coverWorkers = max((os.cpu_count() or 1) // workers, 1)
+    if "--cover-workers" in sys.argv:
+        coverWorkers = int(sys.argv[sys.argv.index("--cover-workers") + 1])
+    if "--cover-sizes" in sys.argv:
+        db.coverSizes = parseCoverSizes(sys.argv[sys.argv.index("--cover-sizes") + 1])
+    if "--cover-cache-size" in sys.argv:
+        db.coverCache.maxBytes = int(float(sys.argv[sys.argv.index("--cover-cache-size") + 1]) * 1024 * 1024)
+    if worker != None:
+        # Each worker has its own part of the cover cache, they cant see what the others evict
+        db.coverCache.directory = os.path.join(db.coverCache.directory, f"worker{worker}")
+        db.coverCache.maxBytes //= workers
+    if Image and coverWorkers != 0:
+        db.coverQueue = coverQueue(db, coverWorkers)
+    requestMetrics.instrument(db)
+    if "--profile-slow" in sys.argv:
+        profiler = metrics.sampler(db.fullFilePath("profiles"),
+                                   float(sys.argv[sys.argv.index("--profile-slow") + 1]))
+    db.load()
+    # Other workers and ./bulk.py can use data.sqlite at the same time
+    if isinstance(db, sqliteDatabase):
+        db.share()
+    else:
+        # Build the search index before the first search needs it, without stopping other requests
+        threading.Thread(target=db.searchIndexBuild, daemon=True).start()
+    fileIcons = fileIconsDict()
+    staticAssets()
+    if autosave:
+        autosaveThread = threading.Thread(target=db.autosave)
+        autosaveThread.start()
+
+    # Run server
+    try:
+        # The servers are imported here as they are optional, and serve is also used without __main__
+        if useAsgi:
+            import asgi
+            asgi.run(booklist, host, port, threads, listenSocket, requestMetrics)
+        elif useWaitress:
+            # Like waitress.serve, but keeping the server so /metrics can see its queue
+            import waitress
+            logging.basicConfig()
+            if listenSocket:
+                waitressServer = waitress.create_server(booklist, sockets=[listenSocket], threads=threads)
+            else:
+                waitressServer = waitress.create_server(booklist, host=host, port=port, threads=threads)
+            if not worker:
+                waitressServer.print_listen("Serving on http://{}:{}")
+            waitressServer.run()
+        else:
+            booklist.run(host=host, port=port)
+    except:
+        traceback.print_exc()
+
+    # Shut down, the workers are sent another KeyboardInterrupt by preforkServe when it gets one
+    if worker != None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if db.coverQueue:
+        db.coverQueue.shutdown()
+    if autosave:
+        db.shutdown = True
+        autosaveThread.join()
+    db.save()
+
+
+def preforkServe(workers, host, port, threads, autosave, useAsgi=False):
+    """Serve with worker processes which accept connections from the same socket
+
+    Each worker has its own GIL so searches use every CPU, the workers
+    share data.sqlite which is created or migrated before they start.
+    Workers which crash are restarted, and every worker is stopped with
+    KeyboardInterrupt or SIGTERM."""
+    setupDatabase = sqliteDatabase()
+    setupDatabase.load()
+    setupDatabase.connection().close()
+    del setupDatabase
+
+    listenSocket = socket.create_server((host, int(port)), backlog=1024)
+    print(f"Serving on http://{host}:{port} with {workers} workers")
+    # {pid: (worker number, time it started)}
+    children = {}
+
+    def start(worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            exitCode = 0
+            try:
+                serve(host, port, threads, autosave, True, listenSocket, worker, workers, useAsgi)
+            except:
+                traceback.print_exc()
+                exitCode = 1
+            os._exit(exitCode)
+        children[pid] = (worker, time.monotonic())
+
+    def stop(signalNumber, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in range(workers):
+            start(worker)
+        while children:
+            pid, status = os.wait()
+            worker, started = children.pop(pid)
+            if status != 0:
+                # Workers which fail straight away would fail again
+                if time.monotonic() - started < 5:
+                    print(f"Worker {worker} failed to start, stopping")
+                    break
+                print(f"Worker {worker} exited with status {status}, restarting it")
+                start(worker)
+    except KeyboardInterrupt:
+        pass
+    # The workers finish their requests and covers before exiting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
 if __name__ == "__main__":
     if "--help" in sys.argv:
         print("Joe Baker's APP Assignment BookList")
@@ -255,8 +921,33 @@ if __name__ == "__main__":
         print("  --host HOST       Set the servers host IP")
         print("  --port PORT       Set the servers port")
         print("  --werkzeug        Use werkzeug instead of waitress")
+        print("  --threads N       Amount of threads for waitress or uvicorn, default 8")
+        print("  --asgi            Use uvicorn, which sends files without using a thread")
+        print("  --workers N       Serve with N processes sharing data.sqlite, needs --sqlite")
+        print("                    and waitress or uvicorn, default 1")
         print("  --data-dir DIR    Set the directory where data is stored")
         print("  --no-autosave     Only save data.json when the server stops")
+        print("  --autosave-debounce SECONDS")
+        print("                    Wait for changes to stop for this long before saving")
+        print("  --autosave-max-delay SECONDS")
+        print("                    Dont wait longer than this after a change to save")
+        print("  --sqlite          Store data in data.sqlite instead of data.json,")
+        print("                    data.json is migrated if data.sqlite doesnt exist")
+        print("  --journal         Append changes to data.journal instead of saving")
+        print("                    all of data.json, which is only saved periodically")
+        print("  --cover-workers N Processes for resizing covers, default is the amount")
+        print("                    of CPUs, 0 to resize them while uploading")
+        print("  --cover-sizes NAME=WIDTHxHEIGHT,...")
+        print("                    Sizes of cover to make, default grid=300x400,preview=60x80")
+        print("  --cover-cache-size MB")
+        print("                    Maximum size of the covers resized with ?w=, default 256")
+        print("  --search-cache-size N")
+        print("                    Amount of search queries to cache results for")
+        print("  --search-cache-ttl SECONDS")
+        print("                    How long search results are cached for")
+        print("  --profile-slow SECONDS")
+        print("                    Save flame graph samples of requests slower than this")
+        print("                    in data/profiles")
         exit()
 
     # Get host and port from argv or use the defaults
@@ -267,6 +958,12 @@ if __name__ == "__main__":
     if "--port" in sys.argv:
         port = sys.argv[sys.argv.index("--port") + 1]
     autosave = not ("--no-autosave" in sys.argv)
+    threads = 8
+    if "--threads" in sys.argv:
+        threads = int(sys.argv[sys.argv.index("--threads") + 1])
+    workers = 1
+    if "--workers" in sys.argv:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
 
     # Use waitress as the WSGI server if it is installed,
     # but use built-in if it isnt, or if --werkzeug argument.
@@ -277,26 +974,19 @@ if __name__ == "__main__":
             useWaitress = True
         except:
             print("Waitress is not installed, using built-in WSGI server (werkzeug).")
-
-    # Startup
-    db = database()
-    db.load()
-    fileIcons = fileIconsDict()
-    if autosave:
-        autosaveThread = threading.Thread(target=db.autosave)
-        autosaveThread.start()
-
-    # Run server
-    try:
-        if useWaitress:
-            waitress.serve(booklist, host=host, port=port, threads=8)
-        else:
-            booklist.run(host=host, port=port)
-    except:
-        traceback.print_exc()
-
-    # Shut down
-    if autosave:
-        db.shutdown = True
-        autosaveThread.join()
-    db.save()
+    useAsgi = False
+    if "--asgi" in sys.argv:
+        try:
+            import asgi
+            import uvicorn
+            useAsgi = True
+        except ModuleNotFoundError:
+            print("Uvicorn is not installed, not using --asgi.")
+    if workers > 1 and not ((useWaitress or useAsgi) and "--sqlite" in sys.argv and hasattr(os, "fork")):
+        print("--workers needs --sqlite, waitress, and an OS with fork, using one process.")
+        workers = 1
+
+    if workers > 1:
+        preforkServe(workers, host, port, threads, autosave, useAsgi)
+    else:
+        serve(host, port, threads, autosave, useWaitress, useAsgi=useAsgi)
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 JoeBlakeB
+# All Rights Reserved
+
+import collections
+import collections.abc
+import contextlib
+import itertools
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import search
+from database import database
+from locks import processLocks
+
+
+class sqliteBooks(collections.abc.Mapping):
+    """Read only mapping of bookID to book dicts stored in SQLite
+
+    Used as the data of sqliteDatabase so the database methods which only
+    read books work the same, changes must be stored with bookStore."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, bookID):
+        book = self.db.sql("SELECT * FROM books WHERE bookID = ?", (bookID,)).fetchone()
+        if book == None:
+            raise KeyError(bookID)
+        return self.db.bookFromRow(book)
+
+    def __contains__(self, bookID):
+        return self.db.sql("SELECT 1 FROM books WHERE bookID = ?", (bookID,)).fetchone() != None
+
+    def __iter__(self):
+        for row in self.db.sql("SELECT bookID FROM books ORDER BY seq"):
+            yield row[0]
+
+    def __reversed__(self):
+        for row in self.db.sql("SELECT bookID FROM books ORDER BY seq DESC"):
+            yield row[0]
+
+    def __len__(self):
+        return self.db.sql("SELECT COUNT(*) FROM books").fetchone()[0]
+
+
+class sqliteDatabase(database):
+    """The database stored in SQLite instead of data.json
+
+    Books and files are stored in indexed tables and are only read when
+    they are needed, so memory use and startup time do not depend on the
+    size of the library. Every change is committed when it is made."""
+    sqliteFilename = "data.sqlite"
+    # SQLite variables allowed in a single query
+    maxVariables = 900
+    # Set by share when other processes use the same database
+    shared = False
+    # More changes than this from other processes rebuild the suggestions instead of updating them
+    syncRebuildChanges = 1000
+    # Fields with a lowercase copy in the <field>Lower column for filtering and sorting, lowercased
+    # in Python like the in-memory indexes as SQLites NOCASE and lower() only change ASCII letters
+    lowerFields = search.filterIndex.filterFields + ("title",)
+
+    def __init__(self, dataDir=None):
+        super().__init__(dataDir)
+        self.connections = threading.local()
+        self.fts = True
+        # Changes up to this seq are in the search cache and suggestions
+        self.syncedSeq = 0
+        # (generation, set of lengths) of the values in fieldValues
+        self.valueLengths = (None, set())
+        self.syncLock = threading.Lock()
+
+    def connection(self):
+        """Returns the SQLite connection for the current thread"""
+        if not hasattr(self.connections, "connection"):
+            connection = sqlite3.connect(self.fullFilePath(self.sqliteFilename), timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self.connections.connection = connection
+        return self.connections.connection
+
+    def sql(self, query, parameters=()):
+        """Execute an SQL query and return the cursor"""
+        return self.connection().execute(query, parameters)
+
+    def load(self):
+        """Open the database, creating it if it doesnt exist
+
+        An existing data.json is migrated if there is no SQLite database yet.
+        It is migrated into another file which replaces data.sqlite once
+        every book is in it, so if the migration is stopped part way it is
+        started again the next time instead of leaving books out."""
+        os.makedirs(self.dataDir, exist_ok=True)
+        if (not os.path.exists(self.fullFilePath(self.sqliteFilename))
+                and os.path.exists(self.fullFilePath(self.dataFilename))):
+            print(f"Migrating {self.fullFilePath(self.dataFilename)} to SQLite")
+            migrating = sqliteDatabase(self.dataDir)
+            migrating.sqliteFilename = self.sqliteFilename + ".migrating"
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(migrating.fullFilePath(migrating.sqliteFilename + suffix)):
+                    os.remove(migrating.fullFilePath(migrating.sqliteFilename + suffix))
+            migrating.createTables()
+            migrating.data = sqliteBooks(migrating)
+            migrating.migrate()
+            # Closing the only connection moves the write-ahead log into the file
+            migrating.connection().close()
+            os.replace(migrating.fullFilePath(migrating.sqliteFilename), self.fullFilePath(self.sqliteFilename))
+        self.createTables()
+        self.data = sqliteBooks(self)
+
+    def createTables(self):
+        """Create the tables and indexes which dont exist yet, and update ones from older versions"""
+        fields = ", ".join(f"{field} TEXT NOT NULL DEFAULT ''" for field in self.bookFields
+                           + tuple(field + "Lower" for field in self.lowerFields))
+        with self.connection() as connection:
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS books (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                bookID TEXT NOT NULL UNIQUE,
+                {fields},
+                hasCover INTEGER NOT NULL DEFAULT 0,
+                coverVersion TEXT NOT NULL DEFAULT '',
+                lastModified INTEGER NOT NULL DEFAULT 0,
+                fileCount INTEGER NOT NULL DEFAULT 0)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                bookID TEXT NOT NULL,
+                fileID INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                hashName TEXT NOT NULL,
+                type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                blob TEXT,
+                PRIMARY KEY (bookID, fileID))""")
+            # Databases from before cover versions dont have the coverVersion column
+            columns = [column["name"] for column in connection.execute("PRAGMA table_info(books)")]
+            if "coverVersion" not in columns:
+                connection.execute("ALTER TABLE books ADD COLUMN coverVersion TEXT NOT NULL DEFAULT ''")
+            # Databases from before the lowercase columns were filtered with NOCASE indexes
+            if "titleLower" not in columns:
+                for field in self.lowerFields:
+                    connection.execute(f"DROP INDEX IF EXISTS books{field.capitalize()}")
+                    connection.execute(f"ALTER TABLE books ADD COLUMN {field}Lower TEXT NOT NULL DEFAULT ''")
+                connection.executemany(
+                    f"UPDATE books SET {', '.join(field + 'Lower = ?' for field in self.lowerFields)} WHERE seq = ?",
+                    [(*(row[field].lower() for field in self.lowerFields), row["seq"])
+                     for row in connection.execute(f"SELECT seq, {', '.join(self.lowerFields)} FROM books")])
+            # Databases from before the blob store dont have the blob column
+            if not any(column["name"] == "blob" for column in connection.execute("PRAGMA table_info(files)")):
+                connection.execute("ALTER TABLE files ADD COLUMN blob TEXT")
+            connection.execute("CREATE INDEX IF NOT EXISTS filesHashName ON files (hashName)")
+            connection.execute("CREATE INDEX IF NOT EXISTS filesBlob ON files (blob)")
+            # Lowercase fields for search, the rowid is the books seq
+            try:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS booksSearch USING fts5("
+                                   f"{', '.join(self.bookFields)}, tokenize = 'trigram')")
+            except sqlite3.OperationalError:
+                # SQLite without FTS5 or the trigram tokenizer, search by scanning instead
+                self.fts = False
+                connection.execute(f"CREATE TABLE IF NOT EXISTS booksSearch ({', '.join(self.bookFields)})")
+            # Whole lowercase fields, for the bonus when a query contains a field
+            connection.execute("CREATE TABLE IF NOT EXISTS fieldValues (value TEXT NOT NULL, seq INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS fieldValuesValue ON fieldValues (value)")
+            connection.execute("CREATE INDEX IF NOT EXISTS fieldValuesSeq ON fieldValues (seq)")
+            # Indexes for filtering and sorting
+            for field in self.lowerFields:
+                connection.execute(f"CREATE INDEX IF NOT EXISTS books{field.capitalize()}Lower ON books ({field}Lower)")
+            for field in ("releaseDate", "lastModified"):
+                connection.execute(f"CREATE INDEX IF NOT EXISTS books{field[0].upper() + field[1:]} ON books ({field})")
+            # The latest change to each book, a book gets a new seq when it changes
+            connection.execute("""CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                bookID TEXT NOT NULL UNIQUE,
+                deleted INTEGER NOT NULL DEFAULT 0)""")
+            connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)")
+            # Databases from before the change feed have books without changes
+            connection.execute("INSERT INTO changes (bookID) SELECT bookID FROM books WHERE "
+                               "bookID NOT IN (SELECT bookID FROM changes) ORDER BY seq")
+            self.syncedSeq = connection.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def migrate(self):
+        """Copy every book in data.json, along with the journal and backups, into SQLite"""
+        jsonDatabase = database(self.dataDir)
+        jsonDatabase.load()
+        with self.connection():
+            for bookID, book in jsonDatabase.data.items():
+                self.bookStore(bookID, book, commit=False)
+        return len(jsonDatabase.data)
+
+    def share(self):
+        """Allow other processes to use the database at the same time, the database must be loaded
+
+        Books and blobs are locked across processes so changes made by
+        copying a book and storing it dont overwrite each others, and
+        changes committed by other processes are found with sync"""
+        self.shared = True
+        self.bookLock = processLocks(self.fullFilePath("books.lock"))
+        self.blobLock = processLocks(self.fullFilePath("blobs.lock"))
+
+    def sync(self):
+        """Apply the changes committed by other processes to the search cache and suggestions
+
+        data_version only changes when another connection commits, so
+        checking it is cheap when nothing has changed. Changes this process
+        made are applied again, which doesnt change the suggestions."""
+        if not self.shared:
+            return
+        version = self.sql("PRAGMA data_version").fetchone()[0]
+        if version == getattr(self.connections, "dataVersion", None):
+            return
+        self.connections.dataVersion = version
+        with self.syncLock:
+            changes, reset = self.changesSince(self.syncedSeq)
+            if not changes:
+                return
+            self.syncedSeq = changes[-1][0]
+            self.generation += 1
+            if reset or len(changes) > self.syncRebuildChanges:
+                self.suggestIndex.data = None
+            elif self.suggestIndex.data is self.data:
+                books = {bookID: self.data.get(bookID) for seq, bookID, deleted in changes}
+                with self.lock.write():
+                    for bookID, book in books.items():
+                        if book:
+                            self.suggestIndex.update(bookID, book)
+                        else:
+                            self.suggestIndex.remove(bookID)
+
+    def save(self):
+        """Every change is already committed"""
+        self.dataChanged = False
+
+    def autosave(self):
+        """Every change is already committed so there is nothing to autosave"""
+        return
+
+    def bookFromRow(self, row):
+        """Convert a row of the books table to a book dict"""
+        book = {field: row[field] for field in self.bookFields}
+        book["hasCover"] = bool(row["hasCover"])
+        book["coverVersion"] = row["coverVersion"]
+        book["lastModified"] = row["lastModified"]
+        book["files"] = {"count": row["fileCount"]}
+        for file in self.sql("SELECT * FROM files WHERE bookID = ? ORDER BY fileID", (row["bookID"],)):
+            book["files"][str(file["fileID"])] = {
+                "name": file["name"],
+                "hashName": file["hashName"],
+                "type": file["type"],
+                "size": file["size"]
+            }
+            if file["blob"] != None:
+                book["files"][str(file["fileID"])]["blob"] = file["blob"]
+        return book
+
+    def bookStore(self, bookID, book, keys=None, touch=False, commit=True):
+        """Store a new or changed book in SQLite
+
+        commit=False to leave committing to the caller"""
+        if touch:
+            book["lastModified"] = int(time.time())
+        connection = self.connection()
+        try:
+            row = connection.execute("SELECT seq FROM books WHERE bookID = ?", (bookID,)).fetchone()
+            values = {field: book.get(field, "") for field in self.bookFields}
+            values.update({field + "Lower": str(book.get(field, "")).lower() for field in self.lowerFields})
+            values.update({
+                "bookID": bookID,
+                "hasCover": int(bool(book.get("hasCover", False))),
+                "coverVersion": book.get("coverVersion", ""),
+                "lastModified": book.get("lastModified", 0),
+                "fileCount": book.get("files", {}).get("count", 0)
+            })
+            if row == None:
+                connection.execute(f"INSERT INTO books ({', '.join(values)}) "
+                                   f"VALUES ({', '.join('?' * len(values))})", tuple(values.values()))
+                seq = connection.execute("SELECT seq FROM books WHERE bookID = ?", (bookID,)).fetchone()[0]
+            else:
+                seq = row[0]
+                connection.execute(f"UPDATE books SET {', '.join(key + ' = ?' for key in values)} "
+                                   "WHERE seq = ?", (*values.values(), seq))
+
+            if row == None or keys == None or "files" in keys:
+                connection.execute("DELETE FROM files WHERE bookID = ?", (bookID,))
+                connection.executemany(
+                    "INSERT INTO files (bookID, fileID, name, hashName, type, size, blob) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(bookID, int(fileID), file["name"], file["hashName"], file["type"], file["size"], file.get("blob"))
+                     for fileID, file in list(book.get("files", {}).items())[1:]])
+
+            if row == None or keys == None or any(key in self.bookFields for key in keys):
+                fields = {field: str(book.get(field, "")).lower() for field in self.bookFields}
+                connection.execute("DELETE FROM booksSearch WHERE rowid = ?", (seq,))
+                connection.execute(f"INSERT INTO booksSearch (rowid, {', '.join(fields)}) "
+                                   f"VALUES (?, {', '.join('?' * len(fields))})", (seq, *fields.values()))
+                connection.execute("DELETE FROM fieldValues WHERE seq = ?", (seq,))
+                connection.executemany("INSERT INTO fieldValues (value, seq) VALUES (?, ?)",
+                                       [(field, seq) for field in fields.values() if field != ""])
+            connection.execute("REPLACE INTO changes (bookID, deleted) VALUES (?, 0)", (bookID,))
+            if commit and not self.inTransaction():
+                connection.commit()
+        except:
+            connection.rollback()
+            raise
+        if self.suggestIndex.data is self.data:
+            with self.lock.write():
+                self.suggestIndex.update(bookID, book)
+        self.modified()
+
+    def bookRemove(self, bookID):
+        """Remove a book from SQLite"""
+        connection = self.connection()
+        try:
+            row = connection.execute("SELECT seq FROM books WHERE bookID = ?", (bookID,)).fetchone()
+            if row != None:
+                connection.execute("DELETE FROM booksSearch WHERE rowid = ?", (row[0],))
+                connection.execute("DELETE FROM fieldValues WHERE seq = ?", (row[0],))
+            connection.execute("DELETE FROM files WHERE bookID = ?", (bookID,))
+            connection.execute("DELETE FROM books WHERE bookID = ?", (bookID,))
+            connection.execute("REPLACE INTO changes (bookID, deleted) VALUES (?, 1)", (bookID,))
+            # Forget the oldest tombstones, clients which havent seen them must fetch everything
+            forgotten = connection.execute("SELECT seq FROM changes WHERE deleted = 1 ORDER BY seq DESC "
+                                           "LIMIT 1 OFFSET ?", (self.changes.maxTombstones,)).fetchone()
+            if forgotten != None:
+                connection.execute("DELETE FROM changes WHERE deleted = 1 AND seq <= ?", (forgotten[0],))
+                connection.execute("REPLACE INTO settings (key, value) VALUES ('changesHorizon', ?)", (forgotten[0],))
+            if not self.inTransaction():
+                connection.commit()
+        except:
+            connection.rollback()
+            raise
+        if self.suggestIndex.data is self.data:
+            with self.lock.write():
+                self.suggestIndex.remove(bookID)
+        self.modified()
+
+    def inTransaction(self):
+        """Returns a bool for if the current thread is in a transaction()"""
+        return getattr(self.connections, "transaction", False)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commit every change made in the block at once, or none of them if it fails"""
+        if self.inTransaction():
+            yield
+            return
+        connection = self.connection()
+        self.connections.transaction = True
+        self.connections.afterCommit = []
+        try:
+            yield
+            connection.commit()
+            # Search results cached before the commit didnt include the changes
+            self.modified()
+        except:
+            connection.rollback()
+            # The suggestions had the changes which were rolled back
+            self.suggestIndex.data = None
+            raise
+        finally:
+            self.connections.transaction = False
+            afterCommit, self.connections.afterCommit = self.connections.afterCommit, []
+        for function in afterCommit:
+            function()
+
+    def afterCommit(self, function):
+        """Call a function once the current transaction is committed, or now if there isnt one"""
+        if self.inTransaction():
+            self.connections.afterCommit.append(function)
+        else:
+            function()
+
+    def bookSearchPage(self, query, offset, limit, filters=None, sort=None, reverse=False):
+        """Returns a page of the ordered bookIDs for a query and the total amount of results"""
+        self.sync()
+        return super().bookSearchPage(query, offset, limit, filters, sort, reverse)
+
+    def bookSuggest(self, query, limit=10):
+        """Returns [(value, field, amount of books, edits)] of the titles, authors,
+        and series which match a query that is being typed"""
+        self.sync()
+        return super().bookSuggest(query, limit)
+
+    def coverStatus(self, bookID):
+        """Returns the status of a books latest cover upload, or None if there isnt one
+
+        Covers uploaded to other processes are processing while their original image exists"""
+        status = super().coverStatus(bookID)
+        if status == None and self.shared and self.coverQueue:
+            try:
+                if any(filename.startswith("coverOriginal.") for filename in os.listdir(self.bookFilePath(bookID))):
+                    return "processing"
+            except FileNotFoundError:
+                pass
+        return status
+
+    def changesSince(self, cursor, limit=None):
+        """Returns the [(seq, bookID, deleted)] of changes after cursor, oldest first, and
+        a bool for if changes after the cursor have been forgotten"""
+        horizon = self.sql("SELECT value FROM settings WHERE key = 'changesHorizon'").fetchone()
+        reset = horizon != None and cursor < horizon[0]
+        rows = self.sql("SELECT seq, bookID, deleted FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                        (0 if reset else cursor, -1 if limit == None else limit))
+        return [(row["seq"], row["bookID"], bool(row["deleted"])) for row in rows], reset
+
+    def filterSql(self, filters):
+        """Returns the WHERE clause and its parameters for bookFilterPage filters"""
+        conditions = []
+        parameters = []
+        for field, values in filters.items():
+            if field == "releaseDate":
+                start, end = values
+                if start != None:
+                    conditions.append("releaseDate >= ?")
+                    parameters.append(start)
+                if end != None:
+                    conditions.append("releaseDate < ?")
+                    parameters.append(end + "\uffff")
+                conditions.append("releaseDate != ''")
+            else:
+                conditions.append(f"{field}Lower IN ({', '.join('?' * len(values))})")
+                parameters += [value.lower() for value in values]
+        return " AND ".join(conditions) or "1", parameters
+
+    def bookFilterPage(self, query, offset, limit, filters, sort=None, reverse=False):
+        """Returns a page of the bookIDs which match the query and filters and the total amount of them
+
+        Without a query the page is selected with the indexes, with a query
+        the ranked results are filtered and sorted in chunks"""
+        where, parameters = self.filterSql(filters)
+        direction = "DESC" if reverse else "ASC"
+        if not query:
+            order = "seq DESC"
+            if sort:
+                column = "titleLower" if sort == "title" else sort
+                order = f"{sort} = '', {column} {direction}, seq {direction}"
+            total = self.sql(f"SELECT COUNT(*) FROM books WHERE {where}", parameters).fetchone()[0]
+            rows = self.sql(f"SELECT bookID FROM books WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                            (*parameters, -1 if limit == None else limit, offset))
+            return [row[0] for row in rows], total
+
+        bookIDs = self.bookSearchPage(query, 0, None)[0]
+        matches = {}
+        for i in range(0, len(bookIDs), self.maxVariables):
+            chunk = bookIDs[i:i + self.maxVariables]
+            column = "titleLower" if sort == "title" else sort or "seq"
+            for row in self.sql(f"SELECT bookID, seq, {column} AS value FROM books "
+                                f"WHERE bookID IN ({', '.join('?' * len(chunk))}) AND {where}", (*chunk, *parameters)):
+                matches[row["bookID"]] = (row["value"], row["seq"], row["bookID"])
+        bookIDs = [bookID for bookID in bookIDs if bookID in matches]
+        if sort:
+            books = [matches[bookID] for bookID in bookIDs]
+            bookIDs = ([book[-1] for book in sorted((book for book in books if book[0] != ""), reverse=reverse)]
+                       + [book[-1] for book in sorted((book for book in books if book[0] == ""), reverse=reverse)])
+        end = None if limit is None else offset + limit
+        return bookIDs[offset:end], len(bookIDs)
+
+    def bookFacets(self, query, filters, fields, limit=10):
+        """Returns {field: [(value, count)]} of the most common values of fields
+        in the books which match the query and filters
+
+        Without a query the values are grouped with the indexes, with a query
+        the matching books are read in chunks and counted"""
+        where, parameters = self.filterSql(filters)
+        columns = {field: "substr(releaseDate, 1, 4)" if field == "releaseYear" else field for field in fields}
+        facets = {}
+        if not query:
+            for field, column in columns.items():
+                key = column if field == "releaseYear" else field + "Lower"
+                rows = self.sql(f"SELECT MIN({column}) AS value, COUNT(*) AS count FROM books WHERE {where} AND {column} != '' "
+                                f"GROUP BY {key} ORDER BY count DESC, {key} LIMIT ?", (*parameters, limit))
+                facets[field] = [(row["value"], row["count"]) for row in rows]
+            return facets
+
+        bookIDs = self.bookSearchPage(query, 0, None)[0]
+        counts = {field: collections.Counter() for field in fields}
+        values = {field: {} for field in fields}
+        for i in range(0, len(bookIDs), self.maxVariables):
+            chunk = bookIDs[i:i + self.maxVariables]
+            for row in self.sql(f"SELECT {', '.join(column + ' AS ' + field for field, column in columns.items()) or 1} "
+                                f"FROM books WHERE bookID IN ({', '.join('?' * len(chunk))}) AND {where}", (*chunk, *parameters)):
+                for field in fields:
+                    if row[field] != "":
+                        counts[field][row[field].lower()] += 1
+                        values[field].setdefault(row[field].lower(), row[field])
+        for field in fields:
+            top = sorted(counts[field].items(), key=lambda item: (-item[1], item[0]))[:limit]
+            facets[field] = [(values[field][value], count) for value, count in top]
+        return facets
+
+    def suggestIndexRebuild(self):
+        """Index every book for suggestions, reading only the suggested fields"""
+        fields = search.suggestIndex.suggestFields
+        rows = self.sql(f"SELECT bookID, {', '.join(fields)} FROM books ORDER BY seq")
+        self.suggestIndex.rebuild(self.data, ((row["bookID"], {field: row[field] for field in fields}) for row in rows))
+
+    def blobReferences(self, blob):
+        """Returns the amount of files which use a blob"""
+        return self.sql("SELECT COUNT(*) FROM files WHERE blob = ?", (blob,)).fetchone()[0]
+
+    def bookIDsNewest(self):
+        """Returns an iterator of every bookID, newest first"""
+        return reversed(self.data)
+
+    def fieldValueLengths(self):
+        """Returns the set of lengths of the whole fields in fieldValues, cached until the books change"""
+        generation = self.generation
+        if self.valueLengths[0] != generation:
+            self.valueLengths = (generation, {row[0] for row in self.sql("SELECT DISTINCT length(value) FROM fieldValues")})
+        return self.valueLengths[1]
+
+    def bookRank(self, query, count=None):
+        """Returns the ordered bookIDs for a lowercase query and the total amount of results
+
+        Books which contain a query word or whose fields are in the query
+        are found with the indexes, then scored with the same rules as the
+        in-memory search index"""
+        candidates = set()
+        for queryWord in set(query.split(" ")):
+            if queryWord == "":
+                continue
+            if self.fts and len(queryWord) >= 3:
+                # Trigram phrase queries match substrings of any column
+                rows = self.sql("SELECT rowid FROM booksSearch WHERE booksSearch MATCH ?",
+                                ('"' + queryWord.replace('"', '""') + '"',))
+            else:
+                rows = self.sql("SELECT rowid FROM booksSearch WHERE " + " OR ".join(
+                    f"instr({field}, ?)" for field in self.bookFields), (queryWord,) * len(self.bookFields))
+            candidates.update(row[0] for row in rows)
+        # Only substrings as long as a field are looked up, a chunk at a time
+        substrings = (substring for length in sorted(self.fieldValueLengths()) if length <= len(query)
+                      for substring in {query[start:start + length] for start in range(len(query) - length + 1)})
+        while True:
+            chunk = list(itertools.islice(substrings, self.maxVariables))
+            if not chunk:
+                break
+            candidates.update(row[0] for row in self.sql(
+                f"SELECT seq FROM fieldValues WHERE value IN ({', '.join('?' * len(chunk))})", chunk))
+
+        results = []
+        candidates = list(candidates)
+        for i in range(0, len(candidates), self.maxVariables):
+            chunk = candidates[i:i + self.maxVariables]
+            for row in self.sql(f"SELECT books.bookID, booksSearch.rowid, {', '.join('booksSearch.' + field for field in self.bookFields)} "
+                                "FROM booksSearch JOIN books ON books.seq = booksSearch.rowid "
+                                f"WHERE booksSearch.rowid IN ({', '.join('?' * len(chunk))})", chunk):
+                fields = {field: row[field] for field in self.bookFields}
+                results.append((search.relevance(fields, query), row["rowid"], row["bookID"]))
+        return search.rank(results, query, count)
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv:
+        print("Migrate data.json to SQLite for ./server.py --sqlite")
+        print("Usage: ./sqlitedb.py [options]")
+        print("Options:")
+        print("  --help            Display this help and exit")
+        print("  --data-dir DIR    Set the directory where data is stored")
+        exit()
+
+    db = sqliteDatabase()
+    if os.path.exists(db.fullFilePath(db.sqliteFilename)):
+        print(f"{db.fullFilePath(db.sqliteFilename)} already exists")
+        exit(1)
+    db.load()
+    print(f"{len(db.data)} books in {db.fullFilePath(db.sqliteFilename)}")
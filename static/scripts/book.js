@@ -105,7 +105,7 @@ const bookPages = {
         let currentImg = "";
         let newImg = "";
         if (api.currentBook.hasCover) {
-            currentImg = "<div><p>Current:</p><img id='coverCurrentPreview' src='/book/cover/" + api.currentBookID + "?lastmodified=" + api.currentBook.lastModified + "'></div>";
+            currentImg = "<div><p>Current:</p><img id='coverCurrentPreview' src='/book/cover/" + api.currentBookID + "?v=" + (api.currentBook.coverVersion || api.currentBook.lastModified) + "'></div>";
         }
         if (api.bookCoverAction == "upload") {
             newImg = "<div><p>New:</p><img id='coverUploadPreview' src='" + URL.createObjectURL(newFile) + "'></div>";
@@ -185,7 +185,9 @@ const bookPages = {
             cover.className = "viewBookDivider coverDivider";
             let img = document.createElement("img");
             img.className = "viewCover";
-            img.src = "/book/cover/" + api.currentBookID + "?lastmodified=" + book.lastModified;
+            // Only download the size the cover is shown at, which is smaller on mobile
+            let coverWidth = Math.min(400, window.innerWidth - 16) * window.devicePixelRatio;
+            img.src = "/book/cover/" + api.currentBookID + "?v=" + (book.coverVersion || book.lastModified) + "&w=" + Math.ceil(coverWidth);
             cover.appendChild(img);
             bookData.appendChild(cover);
         }
@@ -346,6 +348,7 @@ const api = {
         language: "",
         files: [],
         hasCover: false,
+        coverVersion: "",
         lastModified: 0
     },
     // Current book being viewed
@@ -429,14 +432,26 @@ const api = {
             search.search(search.currentPage, false);
         }
     },
+    // Wait for the server to finish resizing an uploaded cover
+    coverWait: function (status) {
+        if (status != "queued" && status != "processing") {
+            api.openPageIfDone();
+            return;
+        }
+        setTimeout(function () {
+            api.request("GET", "/api/cover/" + api.currentBookID + "/status", "uploadFile", function (req) {
+                api.coverWait(JSON.parse(req.responseText).status);
+            });
+        }, 250);
+    },
     // Send the requests for uploading and deleting files and covers
     uploadFiles: function () {
         let requestsCount = 0;
         // Book cover
         if (api.bookCoverAction == "upload") {
             let coverFile = document.getElementById("formCover").files[0];
-            this.request("PUT", "/api/cover/" + api.currentBookID + "/upload", "uploadFile", function () {
-                api.openPageIfDone();
+            this.request("PUT", "/api/cover/" + api.currentBookID + "/upload", "uploadFile", function (req) {
+                api.coverWait(JSON.parse(req.responseText).status);
             }, coverFile, coverFile.type);
             requestsCount++;
         }
@@ -537,6 +552,10 @@ const api = {
                 else {
                     api.requestsCount--;
                     console.log(req.status, action)
+                    // Suggestions are not needed, so there is no error message
+                    if (action == "suggest") {
+                        return;
+                    }
                     if (action == "search") {
                         let bookList = document.getElementById("listContainer");
                         bookList.innerHTML = "<h3 id='bookListStatusText'>Loading books...</h3>";
@@ -635,7 +654,7 @@ const search = {
 
             let img = this.tableCell("Cover");
             if (book.hasCover) {
-                img.innerHTML = "<img src = '/book/cover/" + book.bookID + "/preview?lastModified=" + book.lastModified + "' >";
+                img.innerHTML = "<img src = '/book/cover/" + book.bookID + "/preview?v=" + (book.coverVersion || book.lastModified) + "' >";
             }
             else {
                 img.innerHTML = "<img src = '/static/images/bookCoverPlaceholderPreview.png' >";
@@ -746,6 +765,26 @@ const search = {
             search.search(next, false);
         }
     },
+    // Suggest titles, authors, and series while typing, after a short pause
+    suggestTimeout: null,
+    suggest: function () {
+        clearTimeout(search.suggestTimeout);
+        search.suggestTimeout = setTimeout(function () {
+            let query = document.getElementById("controlsSearchText").value;
+            if (query.trim() == "") {
+                return;
+            }
+            api.request("GET", "api/suggest?q=" + encodeURIComponent(query), "suggest", function (req) {
+                let datalist = document.getElementById("controlsSearchSuggestions");
+                datalist.innerHTML = "";
+                for (let suggestion of JSON.parse(req.responseText).suggestions) {
+                    let option = document.createElement("option");
+                    option.value = suggestion.value;
+                    datalist.appendChild(option);
+                }
+            });
+        }, 100);
+    },
     // Open a book when it is selected, do nothing if already open
     bookSelected: function () {
         if (this.className == "") {
@@ -754,9 +793,10 @@ const search = {
     }
 };
 
-// Search when enter is pressed
+// Search when enter is pressed, suggest when typing
 document.getElementById("controlsSearchText").addEventListener("keyup", function (event) {
     if (event.key === "Enter") {
         search.search();
     }
-});
\ No newline at end of file
+});
+document.getElementById("controlsSearchText").addEventListener("input", search.suggest);
\ No newline at end of file
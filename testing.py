@@ -2,18 +2,30 @@
 # Copyright (c) 2022 JoeBlakeB
 # All Rights Reserved
 
+import asyncio
 import hashlib
+import io
 import json
 import multiprocessing
 import os
 import random
 import requests
 import shutil
+import tarfile
+import threading
 import time
+import tracemalloc
 import unittest
 
+import asgi
+import covers
 import database
+import locks
+import metrics
+import sqlitedb
 import server
+from changes import changeLog
+from PIL import Image
 
 testData = [
     {"title": "Harry Potter and the Philosophers Stone"},
@@ -22,7 +34,8 @@ testData = [
 
 bookDefaults = {
     "title": "", "author": "", "series": "", "description": "", "genre": "", "isbn": "", "releaseDate": "",
-    "publisher": "", "language": "", "files": {"count": 0}, "hasCover": False, "lastModified": 0
+    "publisher": "", "language": "", "files": {"count": 0}, "hasCover": False, "coverVersion": "",
+    "lastModified": 0
 }
 
 imagesBaseURL = "https://cdn.discordapp.com/attachments/796434329831604288"
@@ -39,6 +52,51 @@ testFiles = {
 
 testFileCache = {}
 
+searchWords = ["harry", "potter", "orwell", "george", "nineteen", "eighty", "four", "the", "and",
+               "python", "flask", "web", "a", "an", "of", "stone", "Philosophers", "HARRY", "eighty-four"]
+
+def randomBook(rng):
+    """Generate a book with random words in each field for testing search."""
+    book = {"title": " ".join(rng.choice(searchWords) for i in range(rng.randint(1, 4)))}
+    for field in ("author", "series", "description", "genre", "language"):
+        if rng.random() < 0.6:
+            book[field] = " ".join(rng.choice(searchWords) for i in range(rng.randint(1, 12)))
+    return book
+
+
+def referenceSearch(data, query):
+    """The original full scan bookSearch, used to check the search index gives the same results."""
+    query = query.lower()
+    results = {}
+    for bookID in list(data.keys())[::-1]:
+        relevance = 0
+        for fieldName, field in data[bookID].items():
+            if fieldName in ("files", "hasCover", "coverVersion", "lastModified"):
+                continue
+            field = field.lower()
+            for queryWord in query.split(" "):
+                relevance += int(queryWord in field) * (len(queryWord)
+                            / (1 + (3 * bool(fieldName == "description"))))
+            relevance += int(field in query and len(field) != 0) * 15
+        results[bookID] = relevance
+    resultsOrdered = []
+    minRelevancy = len(query) * 0.75
+    for bookID, relevance in sorted(results.items(),
+            key=lambda item: item[1], reverse=True):
+        if relevance > minRelevancy:
+            resultsOrdered.append(bookID)
+        else:
+            break
+    return resultsOrdered
+
+
+def generatedImage(colour, size=(90, 120)):
+    """Generate a PNG image for tests which dont need a real cover."""
+    image = io.BytesIO()
+    Image.new("RGB", size, colour).save(image, "PNG")
+    return image.getvalue()
+
+
 def getFile(url):
     """Get a file for testing from a URL, caches the file so it can be used on multiple tests."""
     if not url in testFileCache:
@@ -89,6 +147,354 @@ class databaseTests(unittest.TestCase):
         self.assertEqual(db.data, dbDataShouldBe)
         db.save()
 
+    def testSaveIncremental(self):
+        """Test saving only serializes changed books, while other threads are changing books."""
+        saveDataDir = os.path.join(self.tempDataDir, "save")
+        db = database.database(saveDataDir)
+        db.load()
+        bookIDs = [db.bookAdd(book) for book in testData * 10]
+        db.save()
+        self.assertEqual(db.saveStats["lastBooksSerialized"], 20)
+        db.bookEdit(bookIDs[3], {"genre": "fantasy"})
+        db.bookDelete(bookIDs[4])
+        db.save()
+        self.assertEqual(db.saveStats["lastBooksSerialized"], 1)
+        with open(db.fullFilePath(db.dataFilename), "rb") as dataFile:
+            self.assertEqual(dataFile.read(), json.dumps(db.data, indent=4).encode())
+        self.assertEqual(db.saveStats["lastBytes"], os.path.getsize(db.fullFilePath(db.dataFilename)))
+
+        # Save repeatedly while books are being added and edited
+        def changeBooks():
+            for i in range(200):
+                bookID = db.bookAdd({"title": str(i)})
+                db.bookEdit(bookID, {"author": str(i)})
+        threads = [threading.Thread(target=changeBooks) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            db.save()
+        db.save()
+        dbLoaded = database.database(saveDataDir)
+        dbLoaded.load()
+        self.assertEqual(dbLoaded.data, db.data)
+        self.assertEqual(len(db.data), 819)
+
+    def testConcurrentChanges(self):
+        """Test many threads changing and searching the same book at once dont lose any changes."""
+        db = database.database(os.path.join(self.tempDataDir, "concurrent"))
+        db.load()
+        bookID = db.bookAdd({**testData[1], "genre": "dystopia"})
+        hashNames = []
+        errors = []
+        def addFiles(thread):
+            try:
+                for i in range(25):
+                    hashNames.append(db.fileAdd(bookID, f"{thread}.{i}.txt", f"{thread}.{i}".encode()))
+                    db.bookEdit(bookID, {db.bookFields[thread]: f"{thread} {i}"})
+            except Exception as e:
+                errors.append(e)
+        def searchBooks():
+            try:
+                for i in range(200):
+                    self.assertEqual(db.bookSearch("dystopia"), [bookID])
+                    db.bookGet(bookID)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=addFiles, args=(thread,)) for thread in range(8)]
+        threads += [threading.Thread(target=searchBooks) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        book = db.bookGet(bookID)
+        self.assertEqual(book["files"]["count"], 200)
+        self.assertEqual(len(set(hashNames)), 200)
+        self.assertEqual(sorted(file["hashName"] for file in list(book["files"].values())[1:]), sorted(hashNames))
+        for thread in range(8):
+            self.assertEqual(book[db.bookFields[thread]], f"{thread} 24")
+
+    def testReadWriteLock(self):
+        """Test readers can hold the lock at the same time, and writers cant."""
+        lock = locks.readWriteLock()
+        readers = threading.Barrier(4, timeout=5)
+        def read():
+            with lock.read():
+                readers.wait()
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(readers.broken)
+        writing = []
+        def write(i):
+            with lock.write():
+                writing.append(i)
+                time.sleep(0.01)
+                self.assertEqual(len(writing), 1)
+                writing.remove(i)
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def testProcessLocks(self):
+        """Test process locks are held across processes, and only for the same key."""
+        path = os.path.join(self.tempDataDir, "test.lock")
+        held = multiprocessing.get_context("fork").Event()
+        def hold():
+            with locks.processLocks(path)("a"):
+                held.set()
+                time.sleep(0.3)
+        process = multiprocessing.get_context("fork").Process(target=hold)
+        process.start()
+        held.wait(5)
+        lock = locks.processLocks(path)
+        start = time.perf_counter()
+        with lock("b"):
+            self.assertLess(time.perf_counter() - start, 0.2)
+        with lock("a"):
+            self.assertGreater(time.perf_counter() - start, 0.2)
+        process.join()
+
+    def testSqliteShared(self):
+        """Test changes made by another process are in the search cache and suggestions."""
+        sharedDataDir = os.path.join(self.tempDataDir, "shared")
+        dbs = [sqlitedb.sqliteDatabase(sharedDataDir) for i in range(2)]
+        for db in dbs:
+            db.load()
+            db.share()
+        bookID = dbs[0].bookAdd(testData[1])
+        self.assertEqual(dbs[1].bookSearchPage("orwell", 0, 25), ([bookID], 1))
+        self.assertEqual(dbs[1].bookSuggest("orwe")[0][0], "George Orwell")
+        dbs[0].bookEdit(bookID, {"author": "Eric Blair"})
+        self.assertEqual(dbs[1].bookSearchPage("orwell", 0, 25), ([], 0))
+        self.assertEqual(dbs[1].bookSuggest("orwe"), [])
+        self.assertEqual(dbs[1].bookSuggest("blai")[0][0], "Eric Blair")
+        dbs[0].bookDelete(bookID)
+        self.assertEqual(dbs[1].bookSuggest("blai"), [])
+        self.assertEqual(dbs[1].bookSuggest("nine"), [])
+
+    def testAutosave(self):
+        """Test autosave waits for changes to stop, but not for longer than the maximum delay."""
+        db = database.database(os.path.join(self.tempDataDir, "autosave"))
+        db.load()
+        db.autosaveDebounce = 0.5
+        db.autosaveMaxDelay = 1.5
+        autosaveThread = threading.Thread(target=db.autosave)
+        autosaveThread.start()
+        try:
+            startTime = time.time()
+            while time.time() - startTime < 1:
+                db.bookAdd(testData[0])
+                time.sleep(0.1)
+            self.assertEqual(db.saveStats["saves"], 0)
+            time.sleep(1)
+            self.assertEqual(db.saveStats["saves"], 1)
+            db.bookAdd(testData[1])
+            time.sleep(1)
+            self.assertEqual(db.saveStats["saves"], 2)
+            self.assertFalse(db.dataChanged)
+        finally:
+            db.shutdown = True
+            autosaveThread.join()
+
+    def testJournal(self):
+        """Test the journal recovers changes which were not saved, and recovers with the backup."""
+        journalDataDir = os.path.join(self.tempDataDir, "journal")
+        db = database.database(journalDataDir)
+        db.journaled = True
+        db.load()
+        bookIDs = [db.bookAdd(book) for book in testData]
+        db.save()
+        # Changes after the save are only in the journal
+        db.bookEdit(bookIDs[0], {"language": "english"})
+        hashName = db.fileAdd(bookIDs[0], "file.txt", b"journal")
+        db.fileRename(bookIDs[0], hashName, "renamed.txt")
+        db.bookDelete(bookIDs[1])
+        bookIDs.append(db.bookAdd({"title": "Flask Web Development"}))
+        with open(db.fullFilePath(db.journalFilename), "a") as journal:
+            journal.write('{"id": "incomplete", "se')
+        dbRecovered = database.database(journalDataDir)
+        dbRecovered.load()
+        self.assertEqual(dbRecovered.data, db.data)
+        self.assertEqual(dbRecovered.journalRecords, 5)
+        # Compact, change more, then lose data.json
+        db.save()
+        db.bookEdit(bookIDs[2], {"author": "Miguel Grinberg"})
+        os.remove(db.fullFilePath(db.dataFilename))
+        dbRecovered = database.database(journalDataDir)
+        dbRecovered.load()
+        self.assertEqual(dbRecovered.data, db.data)
+        self.assertEqual(dbRecovered.bookSearch("grinberg"), [bookIDs[2]])
+
+    def testChanges(self):
+        """Test the change log orders changes, keeps tombstones, and is recovered when loading."""
+        changesDataDir = os.path.join(self.tempDataDir, "changes")
+        db = database.database(changesDataDir)
+        db.journaled = True
+        db.load()
+        bookIDs = [db.bookAdd(book) for book in testData]
+        db.save()
+        changes, reset = db.changesSince(0)
+        self.assertEqual([bookID for seq, bookID, deleted in changes], bookIDs)
+        cursor = changes[-1][0]
+        # Only the latest change to each book is kept
+        db.bookEdit(bookIDs[0], {"language": "english"})
+        db.bookDelete(bookIDs[1])
+        db.bookEdit(bookIDs[0], {"language": "English"})
+        changes, reset = db.changesSince(cursor)
+        self.assertEqual([(bookID, deleted) for seq, bookID, deleted in changes], [(bookIDs[1], True), (bookIDs[0], False)])
+        self.assertFalse(reset)
+        self.assertEqual(db.changesSince(cursor, 1)[0], changes[:1])
+
+        # The changes after the save are recovered from the journal
+        dbRecovered = database.database(changesDataDir)
+        dbRecovered.load()
+        self.assertEqual(dbRecovered.changesSince(0), db.changesSince(0))
+        dbRecovered.bookAdd({"title": "After Recovering"})
+        self.assertGreater(dbRecovered.changesSince(0)[0][-1][0], changes[-1][0])
+
+        # Forgotten tombstones reset clients which havent seen them
+        db.changes.maxTombstones = 1
+        db.bookDelete(bookIDs[0])
+        changes, reset = db.changesSince(cursor)
+        self.assertTrue(reset)
+        self.assertEqual([(bookID, deleted) for seq, bookID, deleted in changes], [(bookIDs[0], True)])
+
+        # SQLite has the same changes
+        dbSqlite = sqlitedb.sqliteDatabase(os.path.join(self.tempDataDir, "changesSqlite"))
+        dbSqlite.load()
+        bookIDs = [dbSqlite.bookAdd(book) for book in testData]
+        changes, reset = dbSqlite.changesSince(0)
+        dbSqlite.bookEdit(bookIDs[0], {"language": "english"})
+        dbSqlite.bookDelete(bookIDs[1])
+        self.assertEqual([(bookID, deleted) for seq, bookID, deleted in dbSqlite.changesSince(changes[-1][0])[0]],
+                         [(bookIDs[0], False), (bookIDs[1], True)])
+
+    def testChangesPaging(self):
+        """Test a large change log is paged through in order with a small limit"""
+        changes = changeLog()
+        rng = random.Random(7)
+        for i in range(20000):
+            changes.record(f"book{rng.randrange(5000)}", rng.random() < 0.1)
+        expected = [(seq, bookID, deleted) for bookID, (seq, deleted) in changes.entries.items()]
+        self.assertLess(len(changes.log), 2 * len(changes.entries) + 1001)
+        paged = []
+        cursor = 0
+        while True:
+            page = changes.since(cursor, 7)
+            self.assertLessEqual(len(page), 7)
+            if not page:
+                break
+            paged += page
+            cursor = page[-1][0]
+        self.assertEqual(paged, expected)
+        self.assertEqual(changes.since(expected[100][0]), expected[101:])
+        # Replayed changes older than the newest are kept in order
+        changes.record("replayed", seq=expected[0][0] - 1)
+        self.assertEqual(changes.since(0, 2)[0][1], "replayed")
+        # Replaying every change out of order gives the same log
+        replayed = changeLog()
+        shuffled = list(expected)
+        rng.shuffle(shuffled)
+        for seq, bookID, deleted in shuffled:
+            replayed.record(bookID, deleted, seq)
+        replayed.sort()
+        self.assertEqual(replayed.since(0), expected)
+        self.assertEqual(replayed.log, [(seq, bookID) for seq, bookID, deleted in expected])
+
+    def testSqlite(self):
+        """Test the SQLite database migrates data.json, and matches the json database."""
+        rng = random.Random(2022)
+        sqliteDataDir = os.path.join(self.tempDataDir, "sqlite")
+        db = database.database(sqliteDataDir)
+        db.load()
+        for i in range(100):
+            db.bookAdd(randomBook(rng))
+        db.fileAdd(list(db.data.keys())[0], "file.txt", b"sqlite")
+        db.save()
+        # A migration which stops part way is started again the next time
+        bookStore = sqlitedb.sqliteDatabase.bookStore
+        stored = []
+        def stoppingBookStore(self, bookID, book, keys=None, touch=False, commit=True):
+            if len(stored) == 50:
+                raise KeyboardInterrupt()
+            stored.append(bookID)
+            bookStore(self, bookID, book, keys, touch, commit)
+        sqlitedb.sqliteDatabase.bookStore = stoppingBookStore
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                sqlitedb.sqliteDatabase(sqliteDataDir).load()
+        finally:
+            sqlitedb.sqliteDatabase.bookStore = bookStore
+        self.assertFalse(os.path.exists(os.path.join(sqliteDataDir, "data.sqlite")))
+        dbSqlite = sqlitedb.sqliteDatabase(sqliteDataDir)
+        dbSqlite.load()
+        self.assertEqual(dict(dbSqlite.data.items()), db.data)
+
+        for i in range(100):
+            action = rng.random()
+            if action < 0.5:
+                # Add with the same bookID in both
+                bookID = db.bookAdd(randomBook(rng))
+                dbSqlite.bookStore(bookID, dict(db.data[bookID]))
+            elif action < 0.8:
+                bookID = rng.choice(list(db.data.keys()))
+                book = randomBook(rng)
+                db.bookEdit(bookID, dict(book))
+                dbSqlite.bookEdit(bookID, book)
+                self.assertEqual(dbSqlite.data[bookID]["title"], db.data[bookID]["title"])
+                dbSqlite.bookStore(bookID, {**dbSqlite.data[bookID], "lastModified": db.data[bookID]["lastModified"]})
+            else:
+                bookID = rng.choice(list(db.data.keys()))
+                db.bookDelete(bookID)
+                dbSqlite.bookDelete(bookID)
+        self.assertEqual(dict(dbSqlite.data.items()), db.data)
+        self.assertEqual(list(dbSqlite.data.keys()), list(db.data.keys()))
+        # Long queries only look up substrings as long as a field
+        longQuery = " ".join(db.data[bookID]["title"] for bookID in list(db.data.keys())[:3]) + " " + "z" * 4000
+        for query in ["harry potter", "orwell", "a", "the stone", "eighty-four", "nineteen eighty four", "big chungus", longQuery]:
+            self.assertEqual(dbSqlite.bookSearch(query), db.bookSearch(query), query)
+            self.assertEqual(dbSqlite.bookSearchPage(query, 5, 10), db.bookSearchPage(query, 5, 10))
+        self.assertEqual(dbSqlite.bookSearchPage("", 5, 10), db.bookSearchPage("", 5, 10))
+
+        # Files
+        bookID = dbSqlite.bookAdd(testData[1])
+        hashName = dbSqlite.fileAdd(bookID, "file.txt", b"sqlite")
+        dbSqlite.fileRename(bookID, hashName, "renamed")
+        self.assertEqual(dbSqlite.fileGet(bookID, hashName)["name"], "renamed.txt")
+        self.assertTrue(dbSqlite.fileDelete(bookID, hashName))
+        self.assertEqual(dbSqlite.bookGet(bookID)["files"], {"count": 1})
+
+        # Batches are committed together, or not at all
+        bookIDs = dbSqlite.bookAddMany([{"title": "batch 1"}, {"title": ""}, {"title": "batch 3"}])
+        self.assertFalse(bookIDs[1])
+        self.assertEqual(dbSqlite.bookGetMany(bookIDs, ["title"]), {bookIDs[0]: {"title": "batch 1"}, bookIDs[2]: {"title": "batch 3"}})
+        with self.assertRaises(RuntimeError):
+            with dbSqlite.transaction():
+                dbSqlite.bookEdit(bookIDs[0], {"title": "rolled back"})
+                raise RuntimeError()
+        self.assertEqual(dbSqlite.bookGet(bookIDs[0])["title"], "batch 1")
+        # Files are only deleted once the books deletion is committed
+        hashName = dbSqlite.fileAdd(bookIDs[0], "file.txt", b"rolled back delete")
+        blobPath = dbSqlite.filePath(bookIDs[0], hashName)
+        os.makedirs(dbSqlite.bookFilePath(bookIDs[0]), exist_ok=True)
+        with open(dbSqlite.bookFilePath(bookIDs[0], "cover.jpg"), "wb") as file:
+            file.write(b"cover")
+        with self.assertRaises(RuntimeError):
+            with dbSqlite.transaction():
+                dbSqlite.bookDeleteMany([bookIDs[0], bookIDs[2]])
+                raise RuntimeError()
+        self.assertTrue(os.path.exists(blobPath))
+        self.assertTrue(os.path.exists(dbSqlite.bookFilePath(bookIDs[0], "cover.jpg")))
+        self.assertEqual(dbSqlite.fileGet(bookIDs[0], hashName)["name"], "file.txt")
+        dbSqlite.bookDeleteMany([bookIDs[0], bookIDs[2]])
+        self.assertFalse(os.path.exists(blobPath))
+        self.assertFalse(os.path.exists(dbSqlite.bookFilePath(bookIDs[0])))
+
     def testBookAddEditDelete(self):
         """Test the database for adding, editing, and deleting books from the database."""
         db = database.database(self.tempDataDir)
@@ -131,6 +537,228 @@ class databaseTests(unittest.TestCase):
         self.assertEqual(db.bookSearch("orwell"), [bookIDs[1]])
         self.assertEqual(db.bookSearch("big chungus"), [])
 
+    def testSearchIndexParity(self):
+        """Test the search index gives the same results as a full scan, while books are being changed."""
+        rng = random.Random(1984)
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        queries = ["harry potter", "orwell", "big chungus", "a", "eighty-four", "rwe", "the stone",
+                   "harry  potter", "potter harry potter", "web flask", ""]
+        for i in range(300):
+            action = rng.random()
+            if action < 0.6 or len(db.data) < 5:
+                db.bookAdd(randomBook(rng))
+            elif action < 0.85:
+                db.bookEdit(rng.choice(list(db.data.keys())), randomBook(rng))
+            else:
+                db.bookDelete(rng.choice(list(db.data.keys())))
+            if i % 10 == 0:
+                queries.append(" ".join(rng.choice(searchWords)[:rng.randint(1, 8)]
+                                        for i in range(rng.randint(1, 3))))
+                for query in queries:
+                    self.assertEqual(db.bookSearch(query), referenceSearch(db.data, query), query)
+
+    def testSearchIndexBuild(self):
+        """Test building the search index while books are being changed keeps every change."""
+        rng = random.Random(2001)
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        for i in range(1000):
+            db.bookAdd(randomBook(rng))
+        db.data = dict(db.data)
+        builder = threading.Thread(target=db.searchIndexBuild)
+        builder.start()
+        while builder.is_alive() or rng.random() < 0.9:
+            action = rng.random()
+            if action < 0.4:
+                db.bookAdd(randomBook(rng))
+            elif action < 0.8:
+                db.bookEdit(rng.choice(list(db.data.keys())), randomBook(rng))
+            else:
+                db.bookDelete(rng.choice(list(db.data.keys())))
+        builder.join()
+        self.assertIs(db.searchIndex.data, db.data)
+        for query in ["harry potter", "orwell", "a", "rwe", "the stone", "web flask"]:
+            self.assertEqual(db.bookSearch(query), referenceSearch(db.data, query), query)
+
+    def testSearchPage(self):
+        """Test getting a single page of search results matches the full list of results."""
+        rng = random.Random(451)
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        for i in range(200):
+            db.bookAdd(randomBook(rng))
+        for query in ["harry potter", "a", "the", "", None]:
+            if query:
+                allResults = referenceSearch(db.data, query)
+            else:
+                allResults = list(db.data.keys())[::-1]
+            for offset, limit in ((0, 25), (25, 25), (190, 25), (500, 10), (3, 0)):
+                self.assertEqual(db.bookSearchPage(query, offset, limit),
+                                 (allResults[offset:offset+limit], len(allResults)))
+        # Whole field matches
+        bookID = db.bookAdd({"title": "Harry", "author": "Harry"})
+        self.assertIn(bookID, db.bookSearch("harry potter"))
+        self.assertEqual(db.bookSearch("harry potter"), referenceSearch(db.data, "harry potter"))
+
+    def testSearchFilters(self):
+        """Test filtering and sorting with the indexes matches a full scan, and SQLite matches it, with any case."""
+        rng = random.Random(1949)
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        dbSqlite = sqlitedb.sqliteDatabase(os.path.join(self.tempDataDir, "filtersSqlite"))
+        dbSqlite.load()
+        def filteredBook():
+            book = randomBook(rng)
+            book["author"] = rng.choice(["George Orwell", "george orwell", "J. K. Rowling", "Émile Zola", "ÉMILE ZOLA", ""])
+            # Only ASCII letters have the same case in every collation
+            book["title"] = rng.choice(["", "É", "é", "Z", "z"]) + book["title"]
+            book["releaseDate"] = rng.choice(["", f"19{rng.randint(10, 99)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}"])
+            return book
+        for i in range(300):
+            action = rng.random()
+            if action < 0.7 or len(db.data) < 5:
+                bookID = db.bookAdd(filteredBook())
+            elif action < 0.9:
+                bookID = rng.choice(list(db.data.keys()))
+                db.bookEdit(bookID, filteredBook())
+            else:
+                bookID = rng.choice(list(db.data.keys()))
+                db.bookDelete(bookID)
+                dbSqlite.bookDelete(bookID)
+                continue
+            dbSqlite.bookStore(bookID, dict(db.data[bookID]))
+
+        def reference(query, filters, sort, reverse):
+            bookIDs = referenceSearch(db.data, query) if query else list(db.data.keys())[::-1]
+            bookIDs = [bookID for bookID in bookIDs if all(
+                (values[0] or "") <= db.data[bookID]["releaseDate"] <= (values[1] or "9") + "\uffff"
+                and db.data[bookID]["releaseDate"] != "" if field == "releaseDate"
+                else db.data[bookID][field].lower() in [value.lower() for value in values]
+                for field, values in filters.items())]
+            if sort:
+                order = list(db.data.keys())
+                key = lambda bookID: (db.data[bookID][sort].lower() if sort == "title" else db.data[bookID][sort], order.index(bookID))
+                bookIDs = (sorted([bookID for bookID in bookIDs if db.data[bookID][sort] != ""], key=key, reverse=reverse)
+                           + sorted([bookID for bookID in bookIDs if db.data[bookID][sort] == ""], key=key, reverse=reverse))
+            return bookIDs
+
+        for query in ["", "harry potter", "orwell"]:
+            for filters in ({}, {"author": ["GEORGE ORWELL"]}, {"author": ["j. k. rowling", "george orwell"], "genre": ["a"]},
+                            {"releaseDate": ("1950", "1960-05")}, {"releaseDate": (None, "1930")}, {"author": ["nobody"]},
+                            {"author": ["émile zola"]}):
+                for sort, reverse in ((None, False), ("title", False), ("releaseDate", True), ("lastModified", True)):
+                    allResults = reference(query, filters, sort, reverse)
+                    for offset, limit in ((0, 10), (10, 25), (0, None)):
+                        end = None if limit is None else offset + limit
+                        page = db.bookSearchPage(query, offset, limit, filters, sort, reverse)
+                        self.assertEqual(page, (allResults[offset:end], len(allResults)), (query, filters, sort))
+                        self.assertEqual(dbSqlite.bookSearchPage(query, offset, limit, filters, sort, reverse), page)
+
+                # Facets count the values of every result
+                allResults = reference(query, filters, None, False)
+                facets = db.bookFacets(query, filters, ["author", "genre", "releaseYear"], 4)
+                for field, values in facets.items():
+                    counts = {}
+                    for bookID in allResults:
+                        value = db.data[bookID]["releaseDate"][:4] if field == "releaseYear" else db.data[bookID][field].lower()
+                        if value != "":
+                            counts[value] = counts.get(value, 0) + 1
+                    self.assertEqual([(value.lower(), count) for value, count in values],
+                                     sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:4], (query, filters, field))
+                self.assertEqual({field: [(value.lower(), count) for value, count in values] for field, values in
+                                  dbSqlite.bookFacets(query, filters, ["author", "genre", "releaseYear"], 4).items()},
+                                 {field: [(value.lower(), count) for value, count in values] for field, values in facets.items()})
+
+    def testSuggest(self):
+        """Test suggestions match the start of words and typos, and stay correct while books change."""
+        rng = random.Random(1903)
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        dbSqlite = sqlitedb.sqliteDatabase(os.path.join(self.tempDataDir, "suggestSqlite"))
+        dbSqlite.load()
+        for book in [*testData, {"title": "Animal Farm", "author": "George Orwell"},
+                     {"title": "Harry Potter and the Chamber of Secrets", "series": "Harry Potter"}]:
+            dbSqlite.bookStore(db.bookAdd(book), dict(db.data[list(db.data.keys())[-1]]))
+        self.assertEqual(db.bookSuggest("orw"), [("George Orwell", "author", 2, 0)])
+        self.assertEqual(db.bookSuggest("orwlel"), [("George Orwell", "author", 2, 1)])
+        self.assertEqual(db.bookSuggest("harry potter ch"), [("Harry Potter and the Chamber of Secrets", "title", 1, 0)])
+        self.assertEqual([suggestion[:2] for suggestion in db.bookSuggest("h", 3)], [
+            ("Harry Potter", "series"), ("Harry Potter and the Chamber of Secrets", "title"),
+            ("Harry Potter and the Philosophers Stone", "title")])
+        self.assertEqual(db.bookSuggest("xyz"), [])
+        self.assertEqual(db.bookSuggest("o"), dbSqlite.bookSuggest("o"))
+
+        # Cached prefixes stay the same as suggesting without the cache while books change
+        prefixes = ["h", "ha", "har", "a", "th", "o", "p", "e"]
+        for i in range(200):
+            action = rng.random()
+            if action < 0.6 or len(db.data) < 5:
+                bookID = db.bookAdd(randomBook(rng))
+            elif action < 0.85:
+                bookID = rng.choice(list(db.data.keys()))
+                db.bookEdit(bookID, randomBook(rng))
+            else:
+                bookID = rng.choice(list(db.data.keys()))
+                db.bookDelete(bookID)
+                dbSqlite.bookDelete(bookID)
+                continue
+            dbSqlite.bookStore(bookID, dict(db.data[bookID]))
+            if i % 20 == 0:
+                for prefix in prefixes:
+                    suggestions = db.bookSuggest(prefix, 25)
+                    db.suggestIndex.prefixCache.pop(prefix)
+                    self.assertEqual(db.bookSuggest(prefix, 25), suggestions, prefix)
+        for query in prefixes + ["harry pott", "orwel", "eighty-fuor", "the stone "]:
+            self.assertEqual(dbSqlite.bookSuggest(query, 25), db.bookSuggest(query, 25), query)
+
+    def testSearchCache(self):
+        """Test search results are cached and the cache is invalidated by changes."""
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        bookIDs = [db.bookAdd({"title": f"Harry Potter {i}"}) for i in range(60)]
+        firstPage = db.bookSearchPage("Harry Potter", 0, 25)
+        self.assertEqual(db.searchCache.stats()["misses"], 1)
+        # Second page ranks every result, third page is a slice of the cache
+        secondPage = db.bookSearchPage("harry potter", 25, 25)
+        thirdPage = db.bookSearchPage("HARRY POTTER", 50, 25)
+        self.assertEqual(firstPage[0] + secondPage[0] + thirdPage[0], db.bookSearch("harry potter"))
+        self.assertEqual(db.searchCache.stats()["hits"], 1)
+        # Changes invalidate the cache
+        db.bookEdit(bookIDs[0], {"title": "Nineteen Eighty-Four"})
+        self.assertEqual(db.bookSearchPage("harry potter", 0, 100)[1], 59)
+        self.assertEqual(db.searchCache.stats()["hits"], 1)
+        # Expired results are not used
+        db.searchCache.ttl = 0
+        db.bookSearchPage("harry potter", 0, 100)
+        self.assertEqual(db.searchCache.stats()["hits"], 1)
+
+    def testMetrics(self):
+        """Test database methods are timed and slow requests are profiled."""
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        requestMetrics = metrics.metrics()
+        requestMetrics.instrument(db)
+        for book in testData:
+            db.bookAdd(book)
+        db.bookSearchPage("orwell", 0, 25)
+        rendered = requestMetrics.render()
+        self.assertIn('booklist_database_seconds_count{method="bookAdd"} 2', rendered)
+        self.assertIn('booklist_database_seconds_bucket{method="bookSearchPage",le="+Inf"} 1', rendered)
+        requestMetrics.gauge("booklist_books", "Books", lambda: len(db.data))
+        self.assertIn("booklist_books 2\n", requestMetrics.render())
+        # Only requests slower than slowSeconds are saved
+        profiler = metrics.sampler(os.path.join(self.tempDataDir, "profiles"), 0.05)
+        profiler.start()
+        self.assertIsNone(profiler.stop("GET /fast", 0.001))
+        profiler.start()
+        start = time.perf_counter()
+        while time.perf_counter() - start < 0.1:
+            pass
+        path = profiler.stop("GET /api/search", time.perf_counter() - start)
+        with open(path) as file:
+            self.assertIn("testMetrics (testing.py:", file.read())
+
     def testBookCover(self):
         """Test adding and deleting book covers.
         
@@ -166,6 +794,107 @@ class databaseTests(unittest.TestCase):
             self.assertFalse(os.path.exists(db.bookFilePath(f"book{i}", "cover.jpg")))
             self.assertFalse(os.path.exists(db.bookFilePath(f"book{i}", "coverPreview.jpg")))
     
+    def testCoverSizes(self):
+        """Test every configured size of cover is made from a single decode."""
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        bookID = db.bookAdd({"title": "Cover Sizes"})
+        photo = io.BytesIO()
+        Image.new("RGB", (3000, 2000), (200, 100, 50)).save(photo, "JPEG")
+        self.assertTrue(db.coverAdd(bookID, photo.getvalue()))
+        for size, dimensions in {"": (1200, 800), "grid": (300, 400), "preview": (60, 80)}.items():
+            with Image.open(db.bookFilePath(bookID, covers.coverFilename(size))) as cover:
+                self.assertEqual(cover.size, dimensions)
+
+        db.coverSizes = covers.parseCoverSizes("preview=60x80,full=600x800,small=150x200")
+        self.assertEqual(list(db.coverSizes), ["", "small", "preview"])
+        self.assertTrue(db.coverAdd(bookID, generatedImage((0, 0, 0), (1000, 2000))))
+        for size, dimensions in {"": (400, 800), "small": (150, 200), "preview": (60, 80)}.items():
+            with Image.open(db.bookFilePath(bookID, covers.coverFilename(size))) as cover:
+                self.assertEqual(cover.size, dimensions)
+        self.assertFalse(db.coverAdd(bookID, b"not an image"))
+        db.bookDelete(bookID)
+
+    def testCoverCache(self):
+        """Test covers resized on request are cached, coalesced, and evicted."""
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        bookIDs = [db.bookAdd({"title": str(i)}) for i in range(3)]
+        for bookID in bookIDs:
+            db.coverAdd(bookID, generatedImage((0, 0, 255), (1200, 1600)))
+        self.assertEqual(db.coverCache.width(250, 1200), 300)
+        self.assertEqual(db.coverCache.width(5000, 1200), 1200)
+
+        # Concurrent requests for the same cover only resize it once
+        paths = []
+        get = lambda: paths.append(db.coverCache.get(bookIDs[0], db.bookGet(bookIDs[0])["coverVersion"],
+                                                     db.bookFilePath(bookIDs[0], "cover.jpg"), 300, "webp"))
+        threads = [threading.Thread(target=get) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual((db.coverCache.stats()["misses"], db.coverCache.stats()["hits"]), (1, 7))
+        with Image.open(paths[0]) as cover:
+            self.assertEqual((cover.format, cover.size), ("WEBP", (300, 400)))
+
+        # The least recently used covers are evicted
+        db.coverCache.maxBytes = os.path.getsize(paths[0]) * 2 + 1
+        for bookID in bookIDs[1:]:
+            db.coverCache.get(bookID, 0, db.bookFilePath(bookID, "cover.jpg"), 300, "webp")
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(db.coverCache.stats()["covers"], 2)
+        self.assertEqual(db.coverCache.get("bookDoesntExist", 0, db.bookFilePath("bookDoesntExist", "cover.jpg"), 300), None)
+
+        # Deleting a book removes its cached covers
+        db.bookDelete(bookIDs[2])
+        self.assertEqual(db.coverCache.stats()["covers"], 1)
+        for bookID in bookIDs[:2]:
+            db.bookDelete(bookID)
+        self.assertEqual(os.listdir(db.coverCache.directory), [])
+
+    def testCoverQueue(self):
+        """Test covers resized by worker processes are only used once they are done."""
+        db = database.database(self.tempDataDir)
+        db.data = {}
+        db.coverQueue = covers.coverQueue(db, 2)
+        try:
+            bookIDs = [db.bookAdd({"title": str(i)}) for i in range(6)]
+            # Finished covers are stored by the queues thread, not the executors
+            storeThreads = set()
+            bookStore = db.bookStore
+            db.bookStore = lambda *args, **kwargs: (storeThreads.add(threading.current_thread()), bookStore(*args, **kwargs))
+            for i, bookID in enumerate(bookIDs):
+                self.assertTrue(db.coverAdd(bookID, generatedImage((i * 40, 0, 0), (300, 400))))
+                self.assertIn(db.coverStatus(bookID), ("queued", "processing", "done"))
+            self.assertFalse(db.coverAdd(bookIDs[0], b"not an image"))
+            self.assertFalse(db.coverAdd("bookDoesntExist", generatedImage((0, 0, 0))))
+            # Uploading again replaces the pending cover, deleting discards it
+            db.coverAdd(bookIDs[1], generatedImage((0, 255, 0), (30, 40)))
+            db.coverDelete(bookIDs[2])
+            db.bookDelete(bookIDs[3])
+            db.coverQueue.join()
+            self.assertEqual(storeThreads, {threading.current_thread(), db.coverQueue.finisher})
+
+            for bookID in (bookIDs[0], bookIDs[1], bookIDs[4], bookIDs[5]):
+                self.assertTrue(db.coverExists(bookID))
+                self.assertEqual(db.coverStatus(bookID), "done")
+                with Image.open(db.bookFilePath(bookID, "coverPreview.jpg")) as preview:
+                    self.assertEqual(preview.size, (60, 80))
+                self.assertEqual(sorted(os.listdir(db.bookFilePath(bookID))), ["cover.jpg", "coverGrid.jpg", "coverPreview.jpg"])
+            with Image.open(db.bookFilePath(bookIDs[1], "cover.jpg")) as cover:
+                self.assertEqual(cover.size, (30, 40))
+            self.assertFalse(db.coverExists(bookIDs[2]))
+            self.assertEqual(os.listdir(db.bookFilePath(bookIDs[2])), [])
+            self.assertEqual(db.coverStatus(bookIDs[2]), None)
+            self.assertFalse(db.coverExists(bookIDs[3]))
+            self.assertEqual(db.coverQueue.stats()["queued"] + db.coverQueue.stats()["processing"], 0)
+        finally:
+            db.coverQueue.shutdown()
+            for bookID in list(db.data.keys()):
+                db.bookDelete(bookID)
+
     def testSafeFilename(self):
         """Test the safe filename function."""
         db = database.database()
@@ -188,7 +917,7 @@ class databaseTests(unittest.TestCase):
             db.fileAdd(bookID, testFiles[fileUrl][0], getFile(fileUrl))
             hashName = hashlib.md5(getFile(fileUrl)).hexdigest()
             hashName += ".1." + fileUrl.split(".")[-1]
-            self.assertTrue(os.path.exists(db.bookFilePath(bookID, hashName)))
+            self.assertTrue(os.path.exists(db.filePath(bookID, hashName)))
             # Get
             dbFile = db.fileGet(bookID, hashName)
             self.assertEqual(hashName, dbFile["hashName"])
@@ -202,6 +931,74 @@ class databaseTests(unittest.TestCase):
             self.assertFalse(db.fileGet(bookID, hashName))
 
 
+    def testFileStream(self):
+        """Test adding a file from a stream only keeps a chunk of it in memory, and enforces the maximum size."""
+        class chunkStream:
+            """A stream of size bytes which are generated as they are read"""
+            def __init__(self, size):
+                self.remaining = size
+                self.md5 = hashlib.md5()
+            def read(self, size):
+                chunk = os.urandom(min(size, self.remaining))
+                self.remaining -= len(chunk)
+                self.md5.update(chunk)
+                return chunk
+
+        db = database.database(os.path.join(self.tempDataDir, "stream"))
+        db.load()
+        bookID = db.bookAdd(testData[0])
+        stream = chunkStream(32 * 1024 * 1024)
+        tracemalloc.start()
+        hashName = db.fileAddStream(bookID, "big.bin", stream)
+        peakMemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peakMemory, 4 * db.uploadChunkSize)
+        self.assertEqual(hashName, stream.md5.hexdigest() + ".1.bin")
+        self.assertEqual(db.fileGet(bookID, hashName)["size"], 32 * 1024 * 1024)
+        self.assertEqual(os.path.getsize(db.filePath(bookID, hashName)), 32 * 1024 * 1024)
+
+        with self.assertRaises(database.fileTooLarge):
+            db.fileAddStream(bookID, "tooBig.bin", chunkStream(4 * 1024 * 1024), 3 * 1024 * 1024)
+        self.assertFalse(db.fileAddStream(bookID, "empty.bin", chunkStream(0)))
+        self.assertFalse(db.fileAddStream("bookDoesntExist", "file.bin", chunkStream(1)))
+        self.assertEqual(os.listdir(db.blobPath()), [db.fileGet(bookID, hashName)["blob"][:2]])
+        self.assertEqual(db.bookGet(bookID)["files"]["count"], 1)
+
+
+    def testBlobStore(self):
+        """Test files with the same content share a blob which is only deleted with its last file."""
+        db = database.database(os.path.join(self.tempDataDir, "blobs"))
+        db.load()
+        bookIDs = [db.bookAdd(book) for book in testData]
+        hashNames = [db.fileAdd(bookIDs[0], "a.txt", b"blob"), db.fileAdd(bookIDs[0], "b.txt", b"blob"),
+                     db.fileAdd(bookIDs[1], "c.txt", b"blob")]
+        self.assertNotEqual(hashNames[0], hashNames[1])
+        blobPath = db.filePath(bookIDs[0], hashNames[0])
+        self.assertEqual(blobPath, db.filePath(bookIDs[1], hashNames[2]))
+        self.assertEqual(db.blobReferences(db.fileGet(bookIDs[0], hashNames[0])["blob"]), 3)
+        self.assertTrue(db.fileDelete(bookIDs[0], hashNames[0]))
+        db.bookDelete(bookIDs[0])
+        self.assertTrue(os.path.exists(blobPath))
+        self.assertTrue(db.fileDelete(bookIDs[1], hashNames[2]))
+        self.assertFalse(os.path.exists(blobPath))
+
+        # Migrate files stored before the blob store
+        bookIDs = [db.bookAdd(book) for book in testData]
+        for bookID in bookIDs:
+            book = db.bookCopy(bookID)
+            book["files"] = {"count": 1, "1": {"name": "old.txt", "hashName": "old.1.txt", "type": ".txt", "size": 3}}
+            db.bookStore(bookID, book, ["files"])
+            os.makedirs(db.bookFilePath(bookID))
+            with open(db.bookFilePath(bookID, "old.1.txt"), "wb") as file:
+                file.write(b"old")
+        self.assertEqual(db.filePath(bookIDs[0], "old.1.txt"), db.bookFilePath(bookIDs[0], "old.1.txt"))
+        self.assertEqual(db.dedupe(), (2, 3))
+        self.assertEqual(db.filePath(bookIDs[0], "old.1.txt"), db.filePath(bookIDs[1], "old.1.txt"))
+        self.assertFalse(os.path.exists(db.bookFilePath(bookIDs[0], "old.1.txt")))
+        with open(db.filePath(bookIDs[1], "old.1.txt"), "rb") as file:
+            self.assertEqual(file.read(), b"old")
+
+
 class requestsTestsBase(unittest.TestCase):
     host = "127.0.0.1"
     port = 8081
@@ -272,18 +1069,46 @@ class requestsDataTests(requestsTestsBase):
 
     def testIndex(self):
         """Test that the index is send without any errors."""
-        self.get(self.baseUrl)
+        r = self.get(self.baseUrl)
+        self.assertIn("desktopLayout breezeColorScheme", r.text)
+        # Static files have versioned URLs
+        self.assertIn(server.staticAssets().url("scripts/main.js"), r.text)
+        self.get(self.baseUrl, "304", headers={"If-None-Match": r.headers["etag"]})
+        r = self.get(self.baseUrl, cookies={"uiLayout": "mobile", "uiTheme": "nordic"})
+        self.assertIn("mobileLayout nordicColorScheme", r.text)
+        self.assertIn("Cookie", r.headers["vary"])
 
     def testStatic(self):
         """Check that files are sent from the static directory properly."""
+        with open(os.path.join(os.path.dirname(__file__), "static/images/favicon.ico"), "rb") as file:
+            self.assertEqual(self.get(f"{self.baseUrl}/static/images/favicon.ico").content, file.read())
+        self.get(f"{self.baseUrl}/static/scripts/missing.js", "404")
         for path in (
-            "images/favicon.ico",
             "scripts/main.js",
-            "styles/layout.css"
+            "styles/layout.css",
+            "svg/new.svg"
         ):
-            r = self.get(f"{self.baseUrl}/static/{path}")
+            asset = server.staticAssets().get(path)
             with open(os.path.join(os.path.dirname(__file__), "static", path), "rb") as file:
-                self.assertEqual(r.content, file.read())
+                self.assertLess(len(asset.bodies["identity"]), len(file.read()))
+            # Minified, and compressed if it is accepted
+            r = self.get(f"{self.baseUrl}/static/{path}", headers={"Accept-Encoding": "identity"})
+            self.assertEqual(r.content, asset.bodies["identity"])
+            self.assertNotIn("content-encoding", r.headers)
+            self.assertIn("no-cache", r.headers["cache-control"])
+            r = self.get(f"{self.baseUrl}/static/{path}", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(r.headers["content-encoding"], "gzip")
+            self.assertEqual(r.content, asset.bodies["identity"])
+            self.assertEqual(r.headers["vary"], "Accept-Encoding")
+            self.get(f"{self.baseUrl}/static/{path}", "304", headers={
+                "Accept-Encoding": "gzip", "If-None-Match": r.headers["etag"]})
+            # Versioned URLs are cached forever
+            r = self.get(f"{self.baseUrl}{server.staticAssets().url(path)}")
+            self.assertIn("immutable", r.headers["cache-control"])
+
+        # Scripts use the versioned URLs of other static files
+        self.assertIn(server.staticAssets().url("svg/new.svg"),
+                      server.staticAssets().get("scripts/book.js").bodies["identity"].decode())
 
     def testGetBook(self):
         """Tests getting books from the server"""
@@ -299,11 +1124,9 @@ class requestsDataTests(requestsTestsBase):
         for fileName, urlName in (("pdf", "pdf"),
                                   ("unknown", "bruh"),
                                   ("doc+docx+odt+rtf", "docx")):
-            with open(os.path.join(os.path.dirname(__file__), 
-                      f"static/svg/filetype-{fileName}.svg"), "rb") as file:
-                self.assertEqual(
-                    self.get(f"{self.baseUrl}/fileicon/{urlName}.svg").content,
-                    file.read())
+            self.assertEqual(
+                self.get(f"{self.baseUrl}/fileicon/{urlName}.svg").content,
+                server.staticAssets().get(f"svg/filetype-{fileName}.svg").bodies["identity"])
     
     def testAddBook(self):
         """Tests adding a book to the server"""
@@ -327,7 +1150,7 @@ class requestsDataTests(requestsTestsBase):
             bookData = server.db.bookGet(bookID)
             self.assertEqual(
                 bookData, 
-                {"isbn": isbn, **bookDefaults, **book, "lastModified": bookData["lastModified"]})
+                {**bookDefaults, **book, "isbn": isbn, "lastModified": bookData["lastModified"]})
 
     def testDeleteBook(self):
         """Tests deleting a book from the server"""
@@ -337,6 +1160,95 @@ class requestsDataTests(requestsTestsBase):
             self.assertEqual(json.loads(r.content), {"deleted": True})
             self.assertFalse(server.db.bookGet(bookID))
 
+    def testBatch(self):
+        """Tests getting, adding, editing, and deleting books in batches"""
+        r = self.post(f"{self.baseUrl}/api/batch/new", json={"books": [*testData, {"title": " "}, "notABook"]})
+        bookIDs = json.loads(r.content)["bookIDs"]
+        self.assertEqual(bookIDs[2:], [False, False])
+        bookIDs = bookIDs[:2]
+
+        r = self.post(f"{self.baseUrl}/api/batch/get", json={"bookIDs": [*bookIDs, "bookDoesntExist"]})
+        response = json.loads(r.content)
+        self.assertEqual(response["books"], {bookID: server.db.bookGet(bookID) for bookID in bookIDs})
+        self.assertEqual(response["missing"], ["bookDoesntExist"])
+        r = self.post(f"{self.baseUrl}/api/batch/get", json={"bookIDs": bookIDs, "fields": ["title", "hasCover"]})
+        self.assertEqual(json.loads(r.content)["books"][bookIDs[1]], {"title": testData[1]["title"], "hasCover": False})
+        r = self.get(f"{self.baseUrl}/api/search?q=orwell&fields=author")
+        self.assertIn({"bookID": bookIDs[1], "author": "George Orwell"}, json.loads(r.content)["books"])
+
+        r = self.put(f"{self.baseUrl}/api/batch/edit", json={"books": {
+            bookIDs[0]: {"genre": "fantasy"}, bookIDs[1]: {"genre": 1984}, "bookDoesntExist": {"genre": "none"}}})
+        self.assertEqual(json.loads(r.content)["edited"], {bookIDs[0]: True, bookIDs[1]: False, "bookDoesntExist": False})
+        self.assertEqual(server.db.bookGet(bookIDs[0])["genre"], "fantasy")
+
+        r = self.delete(f"{self.baseUrl}/api/batch/delete", json={"bookIDs": [*bookIDs, "bookDoesntExist"]})
+        self.assertEqual(json.loads(r.content)["deleted"], {bookIDs[0]: True, bookIDs[1]: True, "bookDoesntExist": False})
+        self.assertFalse(server.db.bookGet(bookIDs[0]))
+
+        # Bad requests
+        self.post(f"{self.baseUrl}/api/batch/get", "422", json={"bookIDs": "notAList"})
+        self.post(f"{self.baseUrl}/api/batch/get", "422", json={"bookIDs": bookIDs, "fields": ["notAField"]})
+        self.post(f"{self.baseUrl}/api/batch/new", "422", json={"books": []})
+        self.post(f"{self.baseUrl}/api/batch/new", "422", json={"books": [{"title": "a"}] * (server.batchMaxSize + 1)})
+        self.get(f"{self.baseUrl}/api/search?fields=notAField", "422")
+
+    def testChanges(self):
+        """Tests following the changes to books with a cursor"""
+        r = self.get(f"{self.baseUrl}/api/changes?since=0&limit=1000")
+        cursor = json.loads(r.content)["cursor"]
+        r = self.post(f"{self.baseUrl}/api/batch/new", json={"books": testData})
+        bookIDs = json.loads(r.content)["bookIDs"]
+        self.delete(f"{self.baseUrl}/api/delete/{bookIDs[0]}")
+        r = self.get(f"{self.baseUrl}/api/changes?since={cursor}&limit=1&fields=title")
+        response = json.loads(r.content)
+        self.assertEqual([change["bookID"] for change in response["changes"]], [bookIDs[1]])
+        self.assertEqual(response["changes"][0]["book"], {"title": testData[1]["title"]})
+        self.assertTrue(response["more"])
+        self.assertFalse(response["reset"])
+        r = self.get(f"{self.baseUrl}/api/changes?since={response['cursor']}")
+        response = json.loads(r.content)
+        self.assertEqual(response["changes"], [{"seq": response["cursor"], "bookID": bookIDs[0], "deleted": True}])
+        self.assertFalse(response["more"])
+        self.get(f"{self.baseUrl}/api/changes?fields=notAField", "422")
+
+    def testBulkImportExport(self):
+        """Tests importing and exporting books as JSON Lines, CSV, and tar"""
+        records = [{"title": "Bulk 1", "genre": "bulk"}, {"author": "No Title"}, {"title": "Bulk 3", "genre": 3}]
+        r = self.post(f"{self.baseUrl}/api/import", data="\n".join(json.dumps(record) for record in records),
+                      headers={"Content-Type": "application/x-ndjson"})
+        response = json.loads(r.content)
+        self.assertEqual((response["added"], response["errorCount"]), (1, 2))
+        self.assertEqual([error["record"] for error in response["errors"]], [2, 3])
+        r = self.post(f"{self.baseUrl}/api/import?format=csv", data="title,genre,files\nBulk 4,bulk,\n")
+        self.assertEqual(json.loads(r.content)["added"], 1)
+        bulkBookIDs = lambda : [bookID for bookID, book in server.db.data.items() if book["title"].startswith("Bulk")]
+        self.assertEqual(sorted(server.db.data[bookID]["title"] for bookID in bulkBookIDs()), ["Bulk 1", "Bulk 4"])
+
+        r = self.get(f"{self.baseUrl}/api/export")
+        exported = [json.loads(line) for line in r.content.decode().splitlines()]
+        self.assertEqual([record["bookID"] for record in exported], list(server.db.data.keys()))
+
+        # A tar of records followed by the files they use
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for name, data in (("books.jsonl", json.dumps({"title": "Bulk Tar", "cover": "cover.png",
+                                "files": [{"path": "files/1", "name": "book.txt"}]}).encode()),
+                               ("cover.png", generatedImage((1, 2, 3))), ("files/1", b"bulk tar")):
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+        r = self.post(f"{self.baseUrl}/api/import?format=tar", data=archive.getvalue())
+        self.assertEqual(json.loads(r.content), {"success": True, "added": 1, "covers": 1, "files": 1,
+                                                 "errorCount": 0, "errors": []})
+        r = self.get(f"{self.baseUrl}/api/export?format=tar")
+        with tarfile.open(fileobj=io.BytesIO(r.content)) as tar:
+            names = tar.getnames()
+            bookID = [bookID for bookID in bulkBookIDs() if server.db.data[bookID]["title"] == "Bulk Tar"][0]
+            self.assertIn(f"covers/{bookID}.jpg", names)
+            self.assertEqual(tar.extractfile(f"files/{bookID}/{server.db.data[bookID]['files']['1']['hashName']}").read(), b"bulk tar")
+        for bookID in bulkBookIDs():
+            server.db.bookDelete(bookID)
+
     def getBookIDList(self, response):
         """Used by both search tests to get a list of bookIDs from the response"""
         bookIDs = []
@@ -363,7 +1275,49 @@ class requestsDataTests(requestsTestsBase):
             self.assertEqual(
                 self.getBookIDList(json.loads(r.content)),
                 server.db.bookSearch(query).sort())
+        # Long queries are cut to maxQueryLength
+        query = "orwell " * 1000
+        results = json.loads(self.get(f"{self.baseUrl}/api/search?q={query}").content)
+        cutResults = json.loads(self.get(f"{self.baseUrl}/api/search?q={query[:server.maxQueryLength]}").content)
+        self.assertEqual((results["total"], results["books"]), (cutResults["total"], cutResults["books"]))
+        self.get(f"{self.baseUrl}/api/suggest?q={query}")
+
+    def testSearchFilters(self):
+        """Tests filtering and sorting books via the server"""
+        r = self.post(f"{self.baseUrl}/api/batch/new", json={"books": [
+            {"title": "Animal Farm", "author": "Eric Blair", "releaseDate": "1945-08-17"},
+            {"title": "Burmese Days", "author": "Eric Blair", "releaseDate": "1934-10-25"},
+            {"title": "Nineteen Eighty-Four", "author": "Eric Blair", "releaseDate": "1949-06-08"}]})
+        bookIDs = json.loads(r.content)["bookIDs"]
+        r = self.get(f"{self.baseUrl}/api/search?author=eric%20blair&sort=-releaseDate&fields=title")
+        self.assertEqual([book["bookID"] for book in json.loads(r.content)["books"]], [bookIDs[2], bookIDs[0], bookIDs[1]])
+        r = self.get(f"{self.baseUrl}/api/search?q=days&author=Eric%20Blair&releaseDateFrom=1930&releaseDateTo=1939")
+        self.assertEqual([book["bookID"] for book in json.loads(r.content)["books"]], [bookIDs[1]])
+        r = self.get(f"{self.baseUrl}/api/search?author=eric%20blair&facets=author,releaseYear&facetLimit=2")
+        self.assertEqual(json.loads(r.content)["facets"], {"author": [{"value": "Eric Blair", "count": 3}],
+            "releaseYear": [{"value": "1934", "count": 1}, {"value": "1945", "count": 1}]})
+        self.get(f"{self.baseUrl}/api/search?sort=notAField", "422")
+        self.get(f"{self.baseUrl}/api/search?facets=title", "422")
+
+    def testSuggest(self):
+        """Tests suggestions via the server"""
+        self.post(f"{self.baseUrl}/api/batch/new", json={"books": [{"title": "Keep the Aspidistra Flying", "author": "Eric Blair"}]})
+        r = self.get(f"{self.baseUrl}/api/suggest?q=aspidsitra")
+        self.assertEqual(json.loads(r.content)["suggestions"],
+                         [{"value": "Keep the Aspidistra Flying", "field": "title", "count": 1, "edits": 1}])
 
+    def testMetrics(self):
+        """Tests request latency is shown in the Prometheus format"""
+        searchCount = 'booklist_request_seconds_count{method="GET",route="/api/search",status="200"} '
+        count = lambda text: int(text.split(searchCount)[1].split("\n")[0]) if searchCount in text else 0
+        before = count(self.get(f"{self.baseUrl}/metrics").text)
+        self.get(f"{self.baseUrl}/api/search?q=metrics")
+        self.get(f"{self.baseUrl}/api/get/notABookID", "404")
+        r = self.get(f"{self.baseUrl}/metrics")
+        self.assertTrue(r.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertEqual(count(r.text), before + 1)
+        self.assertIn('route="/api/get/<bookID>",status="404"', r.text)
+        self.assertIn("booklist_requests_in_progress 1", r.text)
 
 class requestsFilesTests(requestsTestsBase):
     """Tests for the server using requests, 
@@ -413,6 +1367,92 @@ class requestsFilesTests(requestsTestsBase):
         self.put(f"{self.baseUrl}/api/cover/invalidbook/upload", "4", data=getFile(testImages[1]))
         self.delete(f"{self.baseUrl}/api/cover/invalidbook/delete", "4")
     
+    def testConditionalGet(self):
+        """Test covers and files are only sent again when they have changed"""
+        bookID = self.newBook()
+        cover = generatedImage((108, 54, 243))
+        self.put(f"{self.baseUrl}/api/cover/{bookID}/upload", data=cover)
+        coverVersion = json.loads(self.get(f"{self.baseUrl}/api/get/{bookID}").content)["coverVersion"]
+
+        for url in (f"{self.baseUrl}/book/cover/{bookID}", f"{self.baseUrl}/book/cover/{bookID}/grid",
+                    f"{self.baseUrl}/book/cover/{bookID}/preview"):
+            r = self.get(url)
+            self.assertIn("no-cache", r.headers["cache-control"])
+            self.get(url, "304", headers={"If-None-Match": r.headers["etag"]})
+            self.get(url, "304", headers={"If-Modified-Since": r.headers["last-modified"]})
+            r = self.get(f"{url}?v={coverVersion}")
+            self.assertIn("immutable", r.headers["cache-control"])
+        etag = r.headers["etag"]
+
+        # Covers resized to a width are WebP if it is accepted
+        url = f"{self.baseUrl}/book/cover/{bookID}?w=50"
+        r = self.get(url, headers={"Accept": "image/webp,*/*"})
+        self.assertEqual(r.headers["content-type"], "image/webp")
+        self.assertEqual(r.headers["vary"], "Accept")
+        self.get(url, "304", headers={"Accept": "image/webp,*/*", "If-None-Match": r.headers["etag"]})
+        r = self.get(url, headers={"Accept": "image/jpeg", "If-None-Match": r.headers["etag"]})
+        self.assertEqual(r.headers["content-type"], "image/jpeg")
+        with Image.open(io.BytesIO(r.content)) as image:
+            self.assertEqual(image.size, (90, 120))
+
+        # Changing the cover changes the etag, even in the same second, and uploading it again doesnt
+        self.put(f"{self.baseUrl}/api/cover/{bookID}/upload", data=cover)
+        self.get(f"{self.baseUrl}/book/cover/{bookID}/preview", "304", headers={"If-None-Match": etag})
+        self.put(f"{self.baseUrl}/api/cover/{bookID}/upload", data=generatedImage((243, 54, 108)))
+        r = self.get(f"{self.baseUrl}/book/cover/{bookID}/preview", "200", headers={"If-None-Match": etag})
+        self.assertNotEqual(r.headers["etag"], etag)
+
+        r = self.post(f"{self.baseUrl}/api/file/upload/{bookID}/test.txt", data=b"conditional get")
+        hashName = json.loads(r.content)["hashName"]
+        url = f"{self.baseUrl}/book/file/{bookID}/{hashName}"
+        etag = self.get(url).headers["etag"]
+        self.get(url, "304", headers={"If-None-Match": etag})
+        # Renaming changes the Content-Disposition so the etag changes
+        self.post(f"{self.baseUrl}/api/file/rename/{bookID}", json={hashName: "renamed.txt"})
+        self.get(url, "200", headers={"If-None-Match": etag})
+
+    def testRangeRequests(self):
+        """Test parts of files can be requested with Range and If-Range"""
+        bookID = self.newBook()
+        data = os.urandom(5000)
+        r = self.post(f"{self.baseUrl}/api/file/upload/{bookID}/ranges.bin", data=data)
+        url = f"{self.baseUrl}/book/file/{bookID}/{json.loads(r.content)['hashName']}"
+        r = self.get(url)
+        self.assertEqual(r.headers["accept-ranges"], "bytes")
+        etag = r.headers["etag"]
+
+        r = self.get(url, "206", headers={"Range": "bytes=100-199"})
+        self.assertEqual(r.headers["content-range"], "bytes 100-199/5000")
+        self.assertEqual(r.content, data[100:200])
+        r = self.get(url, "206", headers={"Range": "bytes=4000-"})
+        self.assertEqual(r.content, data[4000:])
+        r = self.get(url, "206", headers={"Range": "bytes=-10"})
+        self.assertEqual(r.headers["content-range"], "bytes 4990-4999/5000")
+        self.assertEqual(r.content, data[-10:])
+        r = self.get(url, "416", headers={"Range": "bytes=6000-"})
+        self.assertEqual(r.headers["content-range"], "bytes */5000")
+        # Invalid ranges are ignored
+        self.assertEqual(self.get(url, "200", headers={"Range": "bytes=20-10"}).content, data)
+
+        # Only ranges of the current file are sent
+        r = self.get(url, "206", headers={"Range": "bytes=0-9", "If-Range": etag})
+        self.assertEqual(r.content, data[:10])
+        r = self.get(url, "200", headers={"Range": "bytes=0-9", "If-Range": "\"outdated\""})
+        self.assertEqual(r.content, data)
+
+        # Multiple ranges are sorted and overlaps are merged
+        r = self.get(url, "206", headers={"Range": "bytes=3000-3099,0-9,5-19"})
+        contentType, _, boundary = r.headers["content-type"].partition("; boundary=")
+        self.assertEqual(contentType, "multipart/byteranges")
+        self.assertEqual(int(r.headers["content-length"]), len(r.content))
+        parts = r.content.split(f"--{boundary}".encode())
+        self.assertEqual(parts[0], b"")
+        self.assertEqual(parts[-1], b"--\r\n")
+        for part, (start, stop) in zip(parts[1:-1], [(0, 20), (3000, 3100)]):
+            head, _, body = part.partition(b"\r\n\r\n")
+            self.assertIn(f"Content-Range: bytes {start}-{stop - 1}/5000".encode(), head)
+            self.assertEqual(body, data[start:stop] + b"\r\n")
+
     def testFileUpload(self):
         """Test uploading, renaming, getting, and deleting files from the server"""
         bookIDNoFiles = self.newBook()
@@ -445,5 +1485,107 @@ class requestsFilesTests(requestsTestsBase):
             r = self.delete(f"{self.baseUrl}/api/file/delete/{bookID}/{hashName}")
             self.assertEqual(json.loads(r.content), {"deleted": True})
 
+class asgiTests(unittest.TestCase):
+    """Tests for the ASGI server, requests are sent to the application without a server"""
+
+    @classmethod
+    def setUpClass(self):
+        setUp(self)
+        server.db = database.database(self.tempDataDir)
+        server.db.data = {}
+        server.fileIcons = server.fileIconsDict()
+        self.application = asgi.asgiBooklist(server.booklist, 4)
+        self.application.chunkSize = 1000
+
+    @classmethod
+    def tearDownClass(self):
+        self.application.executor.shutdown()
+        tearDown(self)
+
+    def request(self, method, path, body=b"", headers=(), extensions=None):
+        """Send a request to the application, returns the status, headers, and the body messages"""
+        scope = {"type": "http", "method": method, "path": path.split("?")[0], "root_path": "",
+                 "query_string": path.partition("?")[2].encode(), "headers": list(headers),
+                 "server": ("127.0.0.1", 80), "client": ("127.0.0.1", 1234), "scheme": "http"}
+        if extensions:
+            scope["extensions"] = extensions
+        # Bodies are sent in 3 parts like a slow client
+        size = len(body) // 3 + 1
+        parts = [{"type": "http.request", "body": body[i:i + size], "more_body": i + size < len(body)}
+                 for i in range(0, len(body), size)] or [{"type": "http.request", "body": b"", "more_body": False}]
+        messages = []
+        async def receive():
+            if parts:
+                return parts.pop(0)
+            # Wait for the response like a connected client
+            await asyncio.sleep(60)
+        async def send(message):
+            if message["type"] == "http.response.zerocopysend":
+                # The file is closed once it has been sent
+                message = {**message, "body": message["file"].read(message.get("count", -1))}
+            messages.append(message)
+        asyncio.run(self.application(scope, receive, send))
+        start = messages[0]
+        return start["status"], dict(start["headers"]), messages[1:]
+
+    def testRoutes(self):
+        """Test the ASGI application responds the same as the Flask app"""
+        client = server.booklist.test_client()
+        status, headers, messages = self.request("POST", "/api/new", json.dumps(testData[1]).encode(),
+                                                 [(b"content-type", b"application/json")])
+        self.assertEqual(status, 200)
+        bookID = json.loads(b"".join(message["body"] for message in messages))["bookID"]
+        status, headers, messages = self.request("GET", "/api/search?q=orwell")
+        self.assertEqual(json.loads(b"".join(message["body"] for message in messages)),
+                         {**client.get("/api/search?q=orwell").json, "time": json.loads(messages[0]["body"])["time"]})
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(self.request("GET", f"/api/get/{bookID}x")[0], 404)
+        # Bodies already in memory are read by the thread which made them, streamed ones are not
+        scope = {"method": "GET", "path": f"/api/get/{bookID}", "headers": []}
+        status, headers, iterable = self.application.callApp(self.application.environ(scope, io.BytesIO(), 0))
+        self.assertIsInstance(iterable, list)
+        self.assertEqual(json.loads(b"".join(iterable))["title"], testData[1]["title"])
+        scope = {"method": "GET", "path": "/api/export", "query_string": b"format=jsonl", "headers": []}
+        status, headers, iterable = self.application.callApp(self.application.environ(scope, io.BytesIO(), 0))
+        self.assertNotIsInstance(iterable, list)
+        iterable.close()
+
+    def testFiles(self):
+        """Test files are streamed in chunks, or with zerocopysend when the server supports it"""
+        data = os.urandom(3500)
+        bookID = server.db.bookAdd({"title": "ASGI"})
+        status, headers, messages = self.request("POST", f"/api/file/upload/{bookID}/asgi.bin", data)
+        hashName = json.loads(messages[0]["body"])["hashName"]
+        status, headers, messages = self.request("GET", f"/book/file/{bookID}/{hashName}")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-length"], b"3500")
+        self.assertEqual([len(message["body"]) for message in messages], [1000, 1000, 1000, 500, 0])
+        self.assertEqual(b"".join(message["body"] for message in messages), data)
+        status, headers, messages = self.request("GET", f"/book/file/{bookID}/{hashName}",
+                                                 extensions={"http.response.zerocopysend": {}})
+        self.assertEqual(messages[0]["type"], "http.response.zerocopysend")
+        self.assertEqual(messages[0]["body"], data)
+        # Ranges stop before the end of the file
+        status, headers, messages = self.request("GET", f"/book/file/{bookID}/{hashName}",
+                                                 headers=[(b"range", b"bytes=500-2999")])
+        self.assertEqual(status, 206)
+        self.assertEqual([len(message["body"]) for message in messages], [1000, 1000, 500, 0])
+        self.assertEqual(b"".join(message["body"] for message in messages), data[500:3000])
+        status, headers, messages = self.request("GET", f"/book/file/{bookID}/{hashName}",
+                                                 headers=[(b"range", b"bytes=-100")],
+                                                 extensions={"http.response.zerocopysend": {}})
+        self.assertEqual(messages[0]["count"], 100)
+        self.assertEqual(messages[0]["body"], data[-100:])
+        # Not modified, and HEAD requests have no body
+        status, headers, messages = self.request("GET", f"/book/file/{bookID}/{hashName}",
+                                                 headers=[(b"if-none-match", headers[b"etag"])])
+        self.assertEqual(status, 304)
+        status, headers, messages = self.request("HEAD", f"/book/file/{bookID}/{hashName}")
+        self.assertEqual(messages, [{"type": "http.response.body", "body": b"", "more_body": False}])
+        # Streamed responses
+        status, headers, messages = self.request("GET", "/api/export?format=jsonl")
+        self.assertIn(bookID, b"".join(message["body"] for message in messages).decode())
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2, exit=False)